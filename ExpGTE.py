@@ -1,7 +1,7 @@
+import os
 import warnings
 import h5py
 import numpy as np
-import pickle
 from scipy.stats import zscore
 from utils_gte import *
 from utils_cabmi import *
@@ -12,7 +12,8 @@ class ExpGTE:
     reward_threshold = 4.0
     whole_exp_threshold = 10.0
 
-    def __init__(self, folder, animal, day, sec_var=''):
+    def __init__(self, folder, animal, day, sec_var='', nproc=1,
+            timeout=None, backend='binary', cache_dir=None, cache_size=2**31):
         self.folder = folder
         self.animal = animal
         self.day = day
@@ -27,69 +28,251 @@ class ExpGTE:
             sec_var + '_data.hdf5', 'r'
             )
         self.blen = self.exp_file.attrs['blen']
+        self.sec_var = sec_var
+        # Concurrency of te-extended jobs and per-job timeout in seconds
+        self.nproc = nproc
+        self.timeout = timeout
+        # 'binary' runs te-extended, 'numpy' the in-process estimator
+        self.backend = backend
+        # Content-addressed store of GTE results; CACHE_SIZE=0 disables it
+        if cache_dir is None:
+            cache_dir = folder + 'gte_cache/'
+        self.cache = GTECache(cache_dir, cache_size) if cache_size else None
+        # Preprocessed signals, loaded on first use (see ExpGTE.signal)
+        self.signal_dir = os.path.join(cache_dir, 'signals')
+        self._signal = None
+        self._zscored_signal = None
+        self._reward_trials = None
 
-    def baseline(self, parameters=None, pickle_results = True):
+    def _signal_file(self, name):
+        # Memory-mapped arrays are rebuilt when the HDF5 file is newer
+        file_name = os.path.join(self.signal_dir, '_'.join(
+            [self.animal, self.day, self.sec_var, name]) + '.npy')
+        if os.path.isfile(file_name) and os.path.getmtime(file_name) >= \
+                os.path.getmtime(self.exp_file.filename):
+            return file_name, np.load(file_name, mmap_mode='r')
+        return file_name, None
+
+    def _store_signal(self, file_name, data):
+        if not os.path.isdir(self.signal_dir):
+            os.makedirs(self.signal_dir)
+        tmp_name = file_name + '.tmp.npy'
+        np.save(tmp_name, data.astype(np.float32))
+        os.replace(tmp_name, file_name)
+        return np.load(file_name, mmap_mode='r')
+
+    @property
+    def signal(self):
+        '''
+        The (neurons x frames) activity C of the 'nerden' neurons as a
+        read-only, memory-mapped float32 array. It is read from the HDF5
+        file once and shared by all analyses.
+        '''
+        if self._signal is None:
+            file_name, self._signal = self._signal_file('C')
+            if self._signal is None:
+                exp_data = np.array(self.exp_file['C'])
+                exp_data = exp_data[np.array(self.exp_file['nerden']),:]
+                self._signal = self._store_signal(file_name, exp_data)
+        return self._signal
+
+    @property
+    def zscored_signal(self):
+        '''
+        SELF.SIGNAL z-scored over the whole session and clipped at
+        SELF.WHOLE_EXP_THRESHOLD, memory-mapped as float32.
+        '''
+        if self._zscored_signal is None:
+            file_name, self._zscored_signal = self._signal_file('zscored')
+            if self._zscored_signal is None:
+                self._zscored_signal = self._store_signal(file_name,
+                    self.zscore_segment())
+        return self._zscored_signal
+
+    def zscore_segment(self, start=None, stop=None, threshold=None):
+        '''
+        Returns frames START:STOP of SELF.SIGNAL z-scored over that segment,
+        with NaNs set to 0 and clipped at THRESHOLD (by default
+        SELF.WHOLE_EXP_THRESHOLD), as a float32 (neurons x frames) array.
+        '''
+        if threshold is None:
+            threshold = self.whole_exp_threshold
+        exp_data = zscore(self.signal[:,start:stop], axis=1)
+        exp_data = np.nan_to_num(exp_data)
+        exp_data = np.clip(exp_data, -1*threshold, threshold)
+        return exp_data.astype(np.float32)
+
+    def reward_trials(self, frame_size=300):
+        '''
+        Returns the activity of SELF.SIGNAL over the FRAME_SIZE frames up to
+        and including each hit, as a (rewards x neurons x FRAME_SIZE+1)
+        float32 array, NaN-padded before the trial start. The time-locked
+        tensor is computed once per session (for at least 300 frames, as
+        used by the sliding and shuffled analyses) and shorter requests are
+        views of it.
+        '''
+        if self._reward_trials is None or \
+                self._reward_trials.shape[2] < frame_size + 1:
+            exp_file = {
+                'trial_start': self.exp_file['trial_start'],
+                'trial_end': self.exp_file['trial_end'],
+                'C': self.signal
+                }
+            # Memoized on disk next to the signal it was built from
+            exp_data = time_lock_activity(exp_file,
+                t_size=[max(frame_size, 300),0], cache_dir=self.signal_dir,
+                session=self._signal_file('C')[0])
+            array_t1 = np.array(self.exp_file['array_t1'])
+            self._reward_trials = exp_data[array_t1,:,:].astype(np.float32)
+        return self._reward_trials[:,:,-(frame_size + 1):]
+
+    def run(self, exp_name, exp_data, parameters, backend=None,
+            to_zscore=False, zscore_threshold=0.0, cache=True):
+        '''
+        Runs GTE over each trial of EXP_DATA (trials x neurons x frames)
+        with the selected backend. BACKEND defaults to SELF.BACKEND.
+        Trials whose processed signal was already run with the same
+        parameters are read from SELF.CACHE instead of rerun, unless CACHE
+        is False, e.g. for random surrogates that never recur.
+        '''
+        if backend is None:
+            backend = self.backend
+        if backend not in ('numpy', 'binary'):
+            raise ValueError("Unknown GTE backend: {}".format(backend))
+        trials = list(prepare_gte_trials(exp_data, to_zscore,
+            zscore_threshold))
+        results = [None]*len(trials)
+        misses = []
+        for i, (idx, signal) in enumerate(trials):
+            key = None
+            if cache and self.cache is not None:
+                key = GTECache.key(signal, parameters, backend=backend)
+                results[i] = self.cache.get(key)
+            if results[i] is None:
+                misses.append((i, key))
+        if not misses:
+            return results
+
+        if backend == 'numpy':
+            for i, key in misses:
+                results[i] = transfer_entropy_matrix(trials[i][1], parameters)
+                if key is not None:
+                    self.cache.put(key, results[i], evict=False)
+            if cache and self.cache is not None:
+                self.cache.evict()
+            return results
+
+        # Only the missing trials are written out and run through te-extended
+        miss_idxs = [trials[i][0] for i, _ in misses]
+        control_file_names, exclude_file_names, output_file_names = \
+            create_gte_input_files(exp_name, exp_data[miss_idxs], parameters,
+                to_zscore=to_zscore, zscore_threshold=zscore_threshold)
+        failed = []
+        for job, result in iter_gte(control_file_names, exclude_file_names,
+                output_file_names, nproc=self.nproc, timeout=self.timeout):
+            i, key = misses[job]
+            if result is None:
+                failed.append(control_file_names[job])
+                continue
+            results[i] = result
+            if key is not None:
+                self.cache.put(key, result, evict=False)
+        if cache and self.cache is not None:
+            self.cache.evict()
+        if failed:
+            raise RuntimeError("GTE failed for: " + ", ".join(failed))
+        return results
+
+    def run_sliding(self, exp_name, exp_data, parameters, frame_size,
+            frame_step, backend=None):
+        '''
+        Runs GTE with a sliding window over EXP_DATA (neurons x frames) with
+        the selected backend. BACKEND defaults to SELF.BACKEND. The numpy
+        backend bins each window on its own, matching te-extended (see
+        run_gte_numpy_sliding). The stacked window results are cached as a
+        whole; an interrupted binary run resumes from the windows its
+        experiment directory already holds.
+        '''
+        if backend is None:
+            backend = self.backend
+        if backend not in ('numpy', 'binary'):
+            raise ValueError("Unknown GTE backend: {}".format(backend))
+        key = None
+        if self.cache is not None:
+            key = GTECache.key(exp_data, parameters, backend=backend,
+                frame_size=frame_size, frame_step=frame_step)
+            results = self.cache.get(key)
+            if results is not None:
+                return list(results)
+        if backend == 'numpy':
+            results = run_gte_numpy_sliding(exp_data, parameters, frame_size,
+                frame_step=frame_step)
+        else:
+            control_file_names, exclude_file_names, output_file_names = \
+                create_gte_input_files_sliding(exp_name, exp_data,
+                    parameters, frame_size, frame_step=frame_step)
+            results = run_gte(control_file_names, exclude_file_names,
+                output_file_names, nproc=self.nproc, timeout=self.timeout)
+        if key is not None and len(results) > 0:
+            self.cache.put(key, np.stack(results))
+        return results
+
+    def save_results(self, analysis, results, parameters, **attrs):
+        '''
+        Stores RESULTS as dataset ANALYSIS of this session's GTE result file,
+        along with the GTE parameters and any extra ATTRS. Stored results
+        are read back with utils_gte.load_gte_results.
+        '''
+        attrs.update({'animal': self.animal, 'day': self.day,
+            'parameters': parameters})
+        save_gte_results(self.folder_path, analysis, results, attrs)
+
+    def baseline(self, parameters=None, pickle_results = True,
+            backend=None):
         '''
         Run GTE over all neurons, over the baseline.
         Inputs:
             PARAMETERS: Dictionary; parameters for GTE
             PICKLE_RESULTS: Boolean; whether or not to save the results matrix
+            BACKEND: 'binary' (te-extended) or 'numpy'; see ExpGTE.run
         Outputs:
             RESULTS: An array of numpy matrices (GTE connectivity matrices)
         '''
         exp_name = self.animal + '_' + self.day + '_' + 'baseline'
-        exp_data = np.array(self.exp_file['C']) # (neurons x frames)
-        exp_data = exp_data[:,:self.blen] # Isolate the baseline
-        exp_data = exp_data[np.array(self.exp_file['nerden']),:]
-        exp_data = zscore(exp_data, axis=1)
-        exp_data = np.nan_to_num(exp_data)
-        exp_data = np.maximum(exp_data, -1*self.whole_exp_threshold)
-        exp_data = np.minimum(exp_data, self.whole_exp_threshold)
+        exp_data = self.zscore_segment(stop=self.blen) # (neurons x frames)
         exp_data = np.expand_dims(exp_data, axis=0) # (1 x neurons x frames)
         neuron_locations = np.array(self.exp_file['com_cm'])
         if parameters is None:
             parameters = self.parameters
-        control_file_names, exclude_file_names, output_file_names = \
-            create_gte_input_files(exp_name, exp_data, parameters)
-        results = run_gte(control_file_names, exclude_file_names,
-            output_file_names)
+        results = self.run(exp_name, exp_data, parameters, backend=backend)
         if pickle_results:
-            with open(self.folder_path + 'baseline.p', 'wb') as p_file:
-                pickle.dump(results, p_file)
+            self.save_results('baseline', results, parameters)
         return results
 
-    def whole_experiment(self, parameters=None, pickle_results = True):
+    def whole_experiment(self, parameters=None, pickle_results = True,
+            backend=None):
         '''
         Run GTE over all neurons, over the whole experiment.
         Inputs:
             PARAMETERS: Dictionary; parameters for GTE
             PICKLE_RESULTS: Boolean; whether or not to save the results matrix
+            BACKEND: 'binary' (te-extended) or 'numpy'; see ExpGTE.run
         Outputs:
             RESULTS: An array of numpy matrices (GTE connectivity matrices)
         '''
         exp_name = self.animal + '_' + self.day + '_' + 'whole'
-        exp_data = np.array(self.exp_file['C']) # (neurons x frames)
-        exp_data = exp_data[:,self.blen:] # Isolate the experiment
-        exp_data = exp_data[np.array(self.exp_file['nerden']),:]
-        exp_data = zscore(exp_data, axis=1)
-        exp_data = np.nan_to_num(exp_data)
-        exp_data = np.maximum(exp_data, -1*self.whole_exp_threshold)
-        exp_data = np.minimum(exp_data, self.whole_exp_threshold)
+        exp_data = self.zscore_segment(start=self.blen) # Isolate the experiment
         exp_data = np.expand_dims(exp_data, axis=0) # (1 x neurons x frames)
         neuron_locations = np.array(self.exp_file['com_cm'])
         if parameters is None:
             parameters = self.parameters
-        control_file_names, exclude_file_names, output_file_names = \
-            create_gte_input_files(exp_name, exp_data, parameters)
-        results = run_gte(control_file_names, exclude_file_names,
-            output_file_names)
+        results = self.run(exp_name, exp_data, parameters, backend=backend)
         if pickle_results:
-            with open(self.folder_path + 'whole_experiment.p', 'wb') as p_file:
-                pickle.dump(results, p_file)
+            self.save_results('whole_experiment', results, parameters)
         return results
 
     def experiment_end(self, end_frame=0, length=0,
-            parameters=None, pickle_results = True):
+            parameters=None, pickle_results = True, backend=None):
         '''
         Run GTE over all neurons, over the end of the experiment.
         Inputs:
@@ -101,33 +284,27 @@ class ExpGTE:
                 If not overwritten, SELF.BLEN will be used by default.
             PARAMETERS: Dictionary; parameters for GTE
             PICKLE_RESULTS: Boolean; whether or not to save the results matrix
+            BACKEND: 'binary' (te-extended) or 'numpy'; see ExpGTE.run
         Outputs:
             RESULTS: An array of numpy matrices (GTE connectivity matrices)
         '''
         if length == 0:
             length = self.blen
         exp_name = self.animal + '_' + self.day + '_' + 'expend'
-        exp_data = np.array(self.exp_file['C']) # (neurons x frames)
-        exp_data = exp_data[:,end_frame-length:] # Isolate the experiment
-        exp_data = exp_data[np.array(self.exp_file['nerden']),:]
-        exp_data = zscore(exp_data, axis=1)
-        exp_data = np.nan_to_num(exp_data)
-        exp_data = np.maximum(exp_data, -1*self.whole_exp_threshold)
-        exp_data = np.minimum(exp_data, self.whole_exp_threshold)
+        # Isolate the experiment
+        exp_data = self.zscore_segment(start=end_frame-length)
         exp_data = np.expand_dims(exp_data, axis=0) # (1 x neurons x frames)
         neuron_locations = np.array(self.exp_file['com_cm'])
         if parameters is None:
             parameters = self.parameters
-        control_file_names, exclude_file_names, output_file_names = \
-            create_gte_input_files(exp_name, exp_data, parameters)
-        results = run_gte(control_file_names, exclude_file_names,
-            output_file_names)
+        results = self.run(exp_name, exp_data, parameters, backend=backend)
         if pickle_results:
-            with open(self.folder_path + 'experiment_end.p', 'wb') as p_file:
-                pickle.dump(results, p_file)
+            self.save_results('experiment_end', results, parameters,
+                end_frame=end_frame, length=length)
         return results
     
-    def reward_end(self, frame_size, parameters=None, pickle_results=True):
+    def reward_end(self, frame_size, parameters=None, pickle_results=True,
+            backend=None):
         '''
         Run general transfer of entropy in the last FRAME_SIZE frames before
         a hit, over all reward trials. Return an array of connectivity matrices
@@ -136,32 +313,27 @@ class ExpGTE:
             FRAME_SIZE: Integer; number of frames before the hit to consider.
             PARAMETERS: Dictionary; parameters for GTE
             PICKLE_RESULTS: Boolean; whether or not to save the results matrix 
+            BACKEND: 'binary' (te-extended) or 'numpy'; see ExpGTE.run
         Outputs:
             RESULTS: An array of numpy matrices (GTE connectivity matrices) 
         '''
         exp_name = self.animal + '_' + self.day + '_' + 'rewardend'
-        exp_data = time_lock_activity(self.exp_file, t_size=[frame_size,0])
-        array_t1 = np.array(self.exp_file['array_t1'])
-        exp_data = exp_data[array_t1,:,:]
-        exp_data = exp_data[:,np.array(self.exp_file['nerden']),:]
+        exp_data = self.reward_trials(frame_size)
         neuron_locations = np.array(self.exp_file['com_cm'])
         if parameters is None:
             parameters = self.parameters
 
-        control_file_names, exclude_file_names, output_file_names = \
-            create_gte_input_files(
-                exp_name, exp_data, parameters,
-                to_zscore=True, zscore_threshold=self.reward_threshold
-                )
-        results = run_gte(control_file_names, exclude_file_names,
-            output_file_names)
+        results = self.run(
+            exp_name, exp_data, parameters, backend=backend,
+            to_zscore=True, zscore_threshold=self.reward_threshold
+            )
         if pickle_results:
-            with open(self.folder_path + 'reward_end.p', 'wb') as p_file:
-                pickle.dump(results, p_file)
+            self.save_results('reward_end', results, parameters,
+                frame_size=frame_size)
         return results
 
     def reward_sliding(self, reward_idx, frame_size, frame_step, parameters=None,
-        pickle_results=True):
+        pickle_results=True, backend=None):
         '''
         Run general transfer of entropy over reward trial REWARD_IDX, with a
         sliding window of size FRAME_SIZE, from the last 300 frames of each
@@ -171,15 +343,13 @@ class ExpGTE:
             FRAME_STEP: Integer; number of frames for each step through signal.
             PARAMETERS: Dictionary; parameters for GTE.
             PICKLE_RESULTS: Boolean; whether or not to save the results matrix.
+            BACKEND: 'binary' (te-extended) or 'numpy'; see ExpGTE.run
         Outputs:
             RESULTS: An array of numpy matrices (GTE connectivity matrices)
         '''
         exp_name = self.animal + '_' + self.day + '_' +\
             'rewardsliding' + str(frame_size) + '_'
-        exp_data = time_lock_activity(self.exp_file, t_size=[300,0])
-        array_t1 = np.array(self.exp_file['array_t1'])
-        exp_data = exp_data[array_t1,:,:]
-        exp_data = exp_data[:,np.array(self.exp_file['nerden']),:]
+        exp_data = self.reward_trials(300)
         num_rewards, num_neurons, num_frames = exp_data.shape
         neuron_locations = np.array(self.exp_file['com_cm'])
         if parameters is None:
@@ -203,30 +373,27 @@ class ExpGTE:
         reward_data = np.nan_to_num(reward_data)
         reward_data = np.maximum(reward_data, -1*self.reward_threshold)
         reward_data = np.minimum(reward_data, self.reward_threshold)
-        control_file_names, exclude_file_names, output_file_names = \
-            create_gte_input_files_sliding(
-                exp_name_idx, reward_data, parameters,
-                frame_size, frame_step=frame_step
-                )
-        results = run_gte(
-            control_file_names, exclude_file_names, output_file_names
+        results = self.run_sliding(
+            exp_name_idx, reward_data, parameters,
+            frame_size, frame_step, backend=backend
             )
         if pickle_results:
-            with open(self.folder_path + 'reward_sliding_'\
-                    + str(reward_idx) + '.p', 'wb') as p_file:
-                pickle.dump(results, p_file)
+            self.save_results('reward_sliding_' + str(reward_idx), results,
+                parameters, frame_size=frame_size, frame_step=frame_step)
         return results
 
-    def reward_sliding_full(self, frame_size, frame_step, parameters=None):
+    def reward_sliding_full(self, frame_size, frame_step, parameters=None,
+        backend=None):
         '''
         Runs reward_sliding over each reward trial, with a sliding
         window of size FRAME_SIZE, from the last 300 frames of each trial.
         Due to memory constraints, this function does not return anything and
-        will instead automatically pickle the results of each reward trial.
+        will instead automatically store the results of each reward trial.
         Inputs:
             FRAME_SIZE: Integer; number of frames to process in GTE.
             FRAME_STEP: Integer; number of frames for each step through signal.
             PARAMETERS: Dictionary; parameters for GTE.
+            BACKEND: 'binary' (te-extended) or 'numpy'; see ExpGTE.run
         '''
         exp_name = self.animal + '_' + self.day + '_' + 'rewardsliding'
         array_t1 = np.array(self.exp_file['array_t1'])
@@ -236,11 +403,35 @@ class ExpGTE:
         for reward_idx in range(num_rewards):
             self.reward_sliding(
                 reward_idx, frame_size, frame_step,
-                parameters=parameters, pickle_results=True
+                parameters=parameters, pickle_results=True, backend=backend
                 )
 
+    def run_shuffled(self, exp_name, exp_data, frame_size, iters,
+            parameters, backend=None, chunk_size=None, seed=None):
+        '''
+        Runs GTE over ITERS surrogates drawn with
+        utils_gte.shuffled_windows from EXP_DATA (trials x neurons x frames,
+        already z-scored), CHUNK_SIZE surrogates at a time (by default all
+        at once). Only the running moments of the results are kept, and
+        the surrogates bypass SELF.CACHE as they are never drawn twice.
+        Outputs:
+            MOMENTS: see utils_gte.result_moments
+        '''
+        rng = np.random.default_rng(seed)
+        if chunk_size is None:
+            chunk_size = iters
+        moments = None
+        for start in range(0, iters, chunk_size):
+            shuffled_data = shuffled_windows(exp_data, frame_size,
+                min(chunk_size, iters - start), rng=rng)
+            results = self.run(exp_name, shuffled_data, parameters,
+                backend=backend, cache=False)
+            moments = result_moments(results, moments)
+        return moments
+
     def shuffled_results(self, frame_size, parameters=None,
-        iters=100, pickle_results=True):
+        iters=100, pickle_results=True, backend=None, chunk_size=None,
+        seed=None):
         '''
         Runs GTE over 'shuffled' instances of neurons over reward trials.
         Returns the average over many of these results.
@@ -248,83 +439,35 @@ class ExpGTE:
             FRAME_SIZE: Integer; number of frames to process in GTE
             PARAMETERS: Dictionary; parameters for GTE.
             ITERS: Number of 'shuffled' samples to take and average over.
+            BACKEND: 'binary' (te-extended) or 'numpy'; see ExpGTE.run
+            CHUNK_SIZE: Number of shuffles run at once; see run_shuffled
+            SEED: Seed of the shuffles
         Outputs:
             RESULT: A GTE connectivity matrix
         '''
 
         exp_name = self.animal + '_' + self.day + '_' + 'rewardshuffled'
-        exp_data = time_lock_activity(self.exp_file, t_size=[300,0])
-        array_t1 = np.array(self.exp_file['array_t1'])
-        exp_data = exp_data[array_t1,:,:]
-        exp_data = exp_data[:,np.array(self.exp_file['nerden']),:]
-
-        # Extract only reward trials that are long enough to sample from
-        sufficient_trials = []
-        for i in range(exp_data.shape[0]):
-            if np.sum(np.isnan(exp_data[i,0,:])) == 0:
-                sufficient_trials.append(i)
-                continue
-            non_nan_idx = np.where(np.isnan(exp_data[i,0,:]))[0][-1] + 1
-            if (exp_data.shape[2] - non_nan_idx) >= frame_size:
-                sufficient_trials.append(i)
-        exp_data = exp_data[sufficient_trials,:,:]
-        
-        # Extract out 'shuffled' windows to use
-        num_rewards = exp_data.shape[0]
-        num_neurons = exp_data.shape[1]
-        num_frames = exp_data.shape[2]
-        shuffled_data = np.zeros((iters, num_neurons, frame_size))
-        for i in range(iters):
-            for j in range(num_neurons):
-                # Sample the reward trial to use
-                reward_idx = np.random.choice(num_rewards)
-                # Sample the frame to start on, excluding Nans
-                full_signal = exp_data[reward_idx,j,:]
-                if np.sum(np.isnan(full_signal)) > 0:
-                    non_nan_idx = np.where(np.isnan(full_signal))[0][-1] + 1
-                else:
-                    non_nan_idx = 0
-                full_signal = full_signal[non_nan_idx:]
-                frame_idx = np.random.choice(np.arange(0,full_signal.size-frame_size+1))
-                full_signal = zscore(full_signal)
-                full_signal = np.nan_to_num(full_signal)
-                full_signal = np.maximum(full_signal, -1*self.reward_threshold)
-                full_signal = np.minimum(full_signal, self.reward_threshold)
-                shuffled_data[i,j,:] = \
-                    full_signal[frame_idx:frame_idx+frame_size]
-        neuron_locations = np.array(self.exp_file['com_cm'])
+        # Each neuron is z-scored within each reward trial
+        exp_data = zscore_trials(self.reward_trials(300),
+            self.reward_threshold)
         if parameters is None:
             parameters = self.parameters
-        
-        # Run GTE on shuffled data
-        control_file_names, exclude_file_names, output_file_names = \
-            create_gte_input_files(exp_name, shuffled_data, parameters)
-        results = run_gte(control_file_names, exclude_file_names,
-            output_file_names)
-        
-        # Compute the average information transfer over shuffled instances.
-        reward_shuffled_results = np.ones(results[0].shape)*np.nan
-        num_results = len(results)
-        for i in range(num_neurons):
-            for j in range(num_neurons):
-                num_samples = 0.0
-                value_sum = 0.0
-                for result_idx in range(num_results): # Loop over all results
-                    val = results[result_idx][i][j]
-                    if np.isnan(val):
-                        continue
-                    else:
-                        num_samples += 1.0
-                        value_sum += val
-                if num_samples > 0: # Calculate the average
-                    reward_shuffled_results[i][j] = value_sum/num_samples
+        moments = self.run_shuffled(exp_name, exp_data, frame_size, iters,
+            parameters, backend=backend, chunk_size=chunk_size, seed=seed)
+
+        # The average information transfer over shuffled instances.
+        reward_shuffled_results, reward_shuffled_std = \
+            moments_mean_std(moments)
         if pickle_results:
-            with open(self.folder_path + 'reward_shuffled.p', 'wb') as p_file:
-                pickle.dump(reward_shuffled_results, p_file)
+            self.save_results('reward_shuffled', reward_shuffled_results,
+                parameters, frame_size=frame_size, iters=iters)
+            self.save_results('reward_shuffled_std', reward_shuffled_std,
+                parameters, frame_size=frame_size, iters=iters)
         return reward_shuffled_results
 
     def shuffled_whole(self, frame_size, parameters=None,
-        iters=100, pickle_results=True):
+        iters=100, pickle_results=True, backend=None, chunk_size=None,
+        seed=None):
         '''
         Runs GTE over 'shuffled' instances of neurons over the whole experiment.
         Returns the average over many of these results.
@@ -332,55 +475,26 @@ class ExpGTE:
             FRAME_SIZE: Integer; number of frames to process in GTE
             PARAMETERS: Dictionary; parameters for GTE.
             ITERS: Number of 'shuffled' samples to take and average over.
+            BACKEND: 'binary' (te-extended) or 'numpy'; see ExpGTE.run
+            CHUNK_SIZE: Number of shuffles run at once; see run_shuffled
+            SEED: Seed of the shuffles
         Outputs:
             RESULT: A GTE connectivity matrix
         '''
 
         exp_name = self.animal + '_' + self.day + '_' + 'wholeshuffled' + str(frame_size)
-        exp_data = np.array(self.exp_file['C']) # (neurons x frames)
-        exp_data = exp_data[np.array(self.exp_file['nerden']),:]
-        exp_data = zscore(exp_data, axis=1)
-        exp_data = np.nan_to_num(exp_data)
-        exp_data = np.maximum(exp_data, -1*self.whole_exp_threshold)
-        exp_data = np.minimum(exp_data, self.whole_exp_threshold)
-        
-        # Extract out 'shuffled' windows to use
-        num_neurons = exp_data.shape[0]
-        num_frames = exp_data.shape[1]
-        shuffled_data = np.zeros((iters, num_neurons, frame_size))
-        for i in range(iters):
-            for j in range(num_neurons):
-                # Sample the frame to start on
-                full_signal = exp_data[j,:]
-                frame_idx = np.random.choice(np.arange(0,full_signal.size-frame_size+1))
-                shuffled_data[i,j,:] = \
-                    full_signal[frame_idx:frame_idx+frame_size]
+        # The whole session as a single (1 x neurons x frames) trial
+        exp_data = self.zscored_signal[np.newaxis,:,:]
         if parameters is None:
             parameters = self.parameters
-        
-        # Run GTE on shuffled data
-        control_file_names, exclude_file_names, output_file_names = \
-            create_gte_input_files(exp_name, shuffled_data, parameters)
-        results = run_gte(control_file_names, exclude_file_names,
-            output_file_names)
-        
-        # Compute the average information transfer over shuffled instances.
-        whole_shuffled_results = np.ones(results[0].shape)*np.nan
-        num_results = len(results)
-        for i in range(num_neurons):
-            for j in range(num_neurons):
-                num_samples = 0.0
-                value_sum = 0.0
-                for result_idx in range(num_results): # Loop over all results
-                    val = results[result_idx][i][j]
-                    if np.isnan(val):
-                        continue
-                    else:
-                        num_samples += 1.0
-                        value_sum += val
-                if num_samples > 0: # Calculate the average
-                    whole_shuffled_results[i][j] = value_sum/num_samples
+        moments = self.run_shuffled(exp_name, exp_data, frame_size, iters,
+            parameters, backend=backend, chunk_size=chunk_size, seed=seed)
+
+        # The average information transfer over shuffled instances.
+        whole_shuffled_results, whole_shuffled_std = moments_mean_std(moments)
         if pickle_results:
-            with open(self.folder_path + 'whole_shuffled.p', 'wb') as p_file:
-                pickle.dump(whole_shuffled_results, p_file)
+            self.save_results('whole_shuffled', whole_shuffled_results,
+                parameters, frame_size=frame_size, iters=iters)
+            self.save_results('whole_shuffled_std', whole_shuffled_std,
+                parameters, frame_size=frame_size, iters=iters)
         return whole_shuffled_results
@@ -14,7 +14,12 @@ import math
 import random
 import copy
 import shutil, traceback
+import pickle
+import json
+import warnings
 import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 # data
 from skimage import io
@@ -29,6 +34,7 @@ import sklearn
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
 from sklearn.linear_model import LinearRegression
+from sklearn.feature_selection import RFECV
 
 # caiman
 try:
@@ -58,7 +64,7 @@ interactive(True)
 import utils_cabmi as ut
 from utils_loading import get_PTIT_over_days, parse_group_dict, encode_to_filename, load_A
 from utils_loading import path_prefix_free, file_folder_path
-from utils_cabmi import std_filter, median_filter
+from utils_cabmi import DCache, OnlineDFFEstimator
 from pipeline import separate_planes, separate_planes_multiple_baseline
 from preprocessing import get_roi_type
 
@@ -256,82 +262,273 @@ def activity_hits(folder, animal, day, sec_var=''):
     # in average (of all trials) + evolution over trials 
 
 
-def frequency_tuning(folder, animal, day, to_plot=True):
+def digitize_frequency(frequency, edges=None):
+    """
+    Bin index of each frame of the cursor FREQUENCY, -1 for NaN frames or frames outside EDGES
+    frequency: np.ndarray (T,)
+    edges: None to give each distinct frequency value its own bin, or the bin edges
+    return
+    bins: np.ndarray (T,) of ints
+    values: frequency value (or bin center) of each bin
+    """
+    frequency = np.asarray(frequency, dtype=np.float64)
+    valid = ~np.isnan(frequency)
+    bins = np.full(frequency.shape, -1, dtype=np.int64)
+    if edges is None:
+        values, bins[valid] = np.unique(frequency[valid], return_inverse=True)
+        return bins, values
+    edges = np.asarray(edges, dtype=np.float64)
+    inside = valid & (frequency >= edges[0]) & (frequency <= edges[-1])
+    bins[inside] = np.clip(np.digitize(frequency[inside], edges) - 1, 0, edges.size - 2)
+    return bins, (edges[:-1] + edges[1:]) / 2
+
+
+def tuning_curves(activity, labels, num_labels, lags=(0,), n_boot=0, ci=95, seed=None):
+    """
+    Mean, variance and count of the activity of every neuron over the frames of each label (e.g. a
+    frequency bin from digitize_frequency), computed for all neurons at once with one bincount per
+    statistic. NaN activity and frames labelled -1 are left out.
+    activity: np.ndarray (N, T)
+    labels: np.ndarray (T,) of ints in [-1, num_labels)
+    lags: frame offsets; with lag L the activity at frame t + L is paired with the label at frame t
+    n_boot: number of bootstrap resamples of the frames for the confidence intervals, 0 for none
+    ci: width of the confidence intervals in percent
+    return
+    dict with 'mean', 'var' (ddof 1) and 'count' arrays (num_lags, N, num_labels) and, if n_boot, 'ci'
+    (num_lags, 2, N, num_labels) with the lower and upper percentiles of the bootstrapped means
+    """
+    activity = np.asarray(activity, dtype=np.float64)
+    labels = np.asarray(labels)
+    N, T = activity.shape
+    rng = np.random.default_rng(seed)
+    out = {k: np.full((len(lags), N, num_labels), np.nan) for k in ('mean', 'var', 'count')}
+    if n_boot:
+        out['ci'] = np.full((len(lags), 2, N, num_labels), np.nan)
+    for l, lag in enumerate(lags):
+        act = activity[:, max(lag, 0):T + min(lag, 0)]
+        lab = labels[max(-lag, 0):T - max(lag, 0)]
+        keep = lab >= 0
+        act, lab = act[:, keep], lab[keep]
+        valid = ~np.isnan(act)
+        act = np.where(valid, act, 0.0)
+        # One flat bincount over (neuron, label) pairs sums every neuron at once
+        idx = (lab[np.newaxis, :] + num_labels * np.arange(N)[:, np.newaxis]).ravel()
+
+        def grouped_sum(values):
+            return np.bincount(idx, weights=values.ravel(), minlength=N * num_labels).reshape(N, num_labels)
+
+        count = grouped_sum(valid.astype(np.float64))
+        total = grouped_sum(act)
+        total_sq = grouped_sum(act ** 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out['mean'][l] = np.where(count > 0, total / count, np.nan)
+            out['var'][l] = np.where(count > 1, (total_sq - total ** 2 / count) / (count - 1), np.nan)
+        out['count'][l] = count
+        if n_boot:
+            boot_means = np.empty((n_boot, N, num_labels))
+            for b in range(n_boot):
+                # Frame resampling with replacement as frame weights
+                w = np.bincount(rng.integers(0, lab.size, lab.size), minlength=lab.size)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    boot_means[b] = grouped_sum(act * w) / grouped_sum(valid * w)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                out['ci'][l] = np.nanpercentile(boot_means, [(100 - ci) / 2, (100 + ci) / 2], axis=0)
+    return out
+
+
+def frequency_tuning(folder, animal, day, sec_var='', lags=(0,), edges=None, n_boot=0, ci=95, seed=None,
+                     to_plot=True, window_sld=5):
     #function to check if there is any tuning to different frequencies
+    # The frequency (see pipeline.obtainfreq) covers the BMI part of the session, after blen frames of
+    # baseline; tuning is computed for every lag of LAGS (see tuning_curves) over the whole session and
+    # over each trial, and saved with the frequency value of each bin
     folder_path = folder +  'processed/' + animal + '/' + day + '/'
     folder_dest = folder +  'analysis/' + animal + '/'
     if not os.path.exists(folder_dest):
         os.makedirs(folder_dest)
-    f = h5py.File(
+    with h5py.File(
         folder_path + 'full_' + animal + '_' + day + '_' +
         sec_var + '_data.hdf5', 'r'
-        )
-    frequency_data = np.asarray(f['frequency'])
-    dff_data = np.asarray(f['dff'])
-    blen = f.attrs['blen']
-    end_trial = f['trial_end'][0] + 1
-    
-    f = h5py.File(
-        folder_dest + 'tuning_' + animal + '_' + day + '_' +
-        sec_var + '_freq.hdf5', 'w-'
-        )
+        ) as f:
+        # put_together saves the output of obtainfreq as 'freq'
+        frequency_data = np.asarray(f['freq'] if 'freq' in f else f['frequency'])
+        dff_data = np.asarray(f['dff'])
+        blen = f.attrs['blen']
+        end_trial = np.asarray(f['trial_end']).astype(int)
     
     dff = dff_data[:, blen:]
-    frequencies = np.unique(frequency_data)
-    num_neurons = dff.shape[0]
-    num_frequencies = frequencies.shape[0]
-    num_trials = end_trial.shape[0]
-    tuning_session = np.ones((num_neurons, num_frequencies)) + np.nan
-    tuning_session_er = np.ones((num_neurons, num_frequencies)) + np.nan
-    tuning_trial = np.ones((num_neurons, num_trials, num_frequencies)) + np.nan
-    ind_ts = np.ones(frequencies.shape[0]) + np.nan 
-    ind_tt = np.ones((end_trial, frequencies.shape[0])) + np.nan
-    
     # control check, frequency should be as long as dff
-    if frequency.shape[0] != dff.shape[1]:
+    if frequency_data.shape[0] != dff.shape[1]:
         print('Warning: arrays length mismatch')
-        frequency = frequency[:dff.shape[1]]
-        
+        T = min(frequency_data.shape[0], dff.shape[1])
+        frequency_data, dff = frequency_data[:T], dff[:, :T]
+    bins, frequencies = digitize_frequency(frequency_data, edges)
+    num_frequencies = frequencies.shape[0]
+    num_trials = end_trial.shape[0]
+
     # to calculate average dff for different frequencies
-    for ind,freq  in enumerate(frequencies):
-        ind_freq = np.flatnonzero(frequency_data == freq)
-        tuning_session[:, ind] = np.nanmean(dff[:, ind_freq], 1)
-        tuning_session_er[:, ind] = \
-            pd.DataFrame(dff[:, ind_freq]).sem(0).values # std of the mean
-        ind_ts[ind] = ind_freq.shape[0]
-    
-    # to calculate dff for different frequencies over trials
-    trials = np.concatenate(([[0], end_trial[:-1]]))
-    for tt, trial in enumerate(trials):
-        aux_dff = dff[:, trial:end_trial[tt]]
-        aux_freq = frequency_data[trial:end_trial[tt]]
-        for ind,freq in enumerate(frequencies):
-            ind_freq = np.flatnonzero(aux_freq == freq)
-            tuning_trial[:, tt, ind] = np.nanmean(aux_dff[:, ind_freq], 1)
-            ind_ts[tt, ind] = ind_freq.shape[0]
-
-    f.create_dataset('tuning_session', tuning_session)
-    f.create_dataset('tuning_trial', tuning_trial)
-    f.create_dataset('ind_ts', ind_ts)
-    f.create_dataset('ind_tt', ind_tt)
+    session = tuning_curves(dff, bins, num_frequencies, lags, n_boot, ci, seed)
+
+    # to calculate dff for different frequencies over trials; trial_end is in session frames and
+    # frames after the last trial are left out
+    trial = np.searchsorted(end_trial, np.arange(dff.shape[1]) + blen)
+    trial_bins = np.where((bins >= 0) & (trial < num_trials), trial * num_frequencies + bins, -1)
+    per_trial = tuning_curves(dff, trial_bins, num_trials * num_frequencies, lags)
+    trial_shape = (len(lags), dff.shape[0], num_trials, num_frequencies)
+
+    with h5py.File(
+        folder_dest + 'tuning_' + animal + '_' + day + '_' +
+        sec_var + '_freq.hdf5', 'w-'
+        ) as f:
+        f['frequencies'] = frequencies
+        f['lags'] = np.asarray(lags)
+        f['tuning_session'] = session['mean']
+        f['tuning_session_var'] = session['var']
+        f['ind_ts'] = session['count']
+        if n_boot:
+            f['tuning_session_ci'] = session['ci']
+        f['tuning_trial'] = per_trial['mean'].reshape(trial_shape)
+        f['ind_tt'] = per_trial['count'].reshape(trial_shape)
     
     if to_plot:
+        lag0 = list(lags).index(0) if 0 in lags else 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tuning_session_er = np.sqrt(session['var'][lag0] / session['count'][lag0]) # std of the mean
         for n in np.arange(dff.shape[0]):
-            sm_data = ut.sliding_mean(tuning_session[n,:], window=window_sld)
-            sm_error = sliding_mean(tuning_session_er[n,:], window=window_sld)
+            sm_data = ut.sliding_mean(session['mean'][lag0, n, :], window=window_sld)
+            sm_error = ut.sliding_mean(tuning_session_er[n, :], window=window_sld)
+            plt.figure()
             plt.fill_between(
-                frequency_values, sm_data - sm_error, sm_data + sm_error,
+                frequencies, sm_data - sm_error, sm_data + sm_error,
                 color="#3F5D7D"
                 )
-            plt.plot(frequency_values, sm_data, color="white", lw=1)
+            plt.plot(frequencies, sm_data, color="white", lw=1)
             plt.savefig(
-                folder_dest + day + '_' + n + '_smtuning_curve.png',
+                folder_dest + day + '_' + str(n) + '_smtuning_curve.png',
                 bbox_inches="tight"
                 )
+            plt.close()
+    return session
+
+
+def _rfecv_bin(data, classif, cv, n_jobs, threads):
+    # Fits RFECV on the activity of one time bin, with at most THREADS BLAS threads per process
+    try:
+        from threadpoolctl import threadpool_limits
+        limits = threadpool_limits(limits=threads)
+    except ImportError:
+        limits = None
+    try:
+        lr = sklearn.linear_model.LogisticRegression()
+        selector = RFECV(lr, step=1, cv=cv, scoring='balanced_accuracy', n_jobs=n_jobs)
+        selector.fit(data, classif)
+    finally:
+        if limits is not None:
+            limits.restore_original_limits()
+    if hasattr(selector, 'cv_results_'):
+        scores = np.asarray(selector.cv_results_['mean_test_score'])
+    else:
+        scores = np.asarray(selector.grid_scores_)
+        if scores.ndim == 2: # (feature subsets x folds)
+            scores = scores.mean(axis=1)
+    return selector.ranking_.astype(np.int32), selector.support_.astype(bool), scores.astype(np.float64)
+
+
+def rfecv_selected(results, score_min=0.9):
+    """
+    Neurons selected in any time bin whose best RFECV score is above SCORE_MIN
+    results: dict of feature selection arrays, see feature_select_sessions
+    """
+    good = results['scores'].max(axis=1) > score_min
+    return np.any(results['support'][good], axis=0)
+
+
+def load_feature_selection(day_path):
+    """
+    Loads the feature selection arrays saved by feature_select_sessions in the session folder DAY_PATH,
+    converting the pickled RFECV models (rfecv_model.p) of older runs; None if there are neither.
+    """
+    npz_file = os.path.join(day_path, 'rfecv_results.npz')
+    if os.path.exists(npz_file):
+        with np.load(npz_file) as saved:
+            return dict(saved)
+    model_file = os.path.join(day_path, 'rfecv_model.p')
+    if not os.path.exists(model_file):
+        return None
+    with open(model_file, 'rb') as f:
+        models = pickle.load(f)
+    scores = [np.asarray(m.grid_scores_) for m in models]
+    return {'ranking': np.array([m.ranking_ for m in models]),
+            'support': np.array([m.support_ for m in models]),
+            'scores': np.array([sc.mean(axis=1) if sc.ndim == 2 else sc for sc in scores])}
+
+
+def feature_select_sessions(folder, sessions, sec_bin=[30, 0], step=5, score_min=0.9, nproc=1, n_jobs=1,
+                            threads=None, cv=5, save=True, cache_dir=None):
+    """Feature selection of feature_select for several sessions, with every (session, time bin) RFECV fit
+    run in one pool of NPROC processes
+    folder (str): folder where the input/output is/will be stored
+    sessions: list of (animal, day)
+    sec_bin (tuple): frames before and after exp.
+    score_min: minimum value to consider the feature selection
+    nproc (int): processes fitting time bins in parallel
+    n_jobs (int): processes for the cross-validation folds of each fit
+    threads (int): BLAS threads per process, by default the cpus left over by nproc * n_jobs
+    save (bool): whether to save each session's arrays as rfecv_results.npz in its processed folder
+    cache_dir (str): folder memoizing the time-locked activity (see ut.time_lock_activity), by default
+    folder + 'time_lock_cache/'
+    return
+    list of (results, neur) per session: results is a dict of arrays over time bins, ranking
+    (bins x neurons), support (bins x neurons) and scores (bins x number of features, the CV score with
+    each number of features), plus the bin edges steps; neur the neurons selected (see rfecv_selected)
+    """
+    if threads is None:
+        threads = max((os.cpu_count() or 1) // (nproc * n_jobs), 1)
+    if cache_dir is None:
+        cache_dir = folder + 'time_lock_cache/'
+    tasks, session_bins = [], []
+    for animal, day in sessions:
+        folder_path = folder +  'processed/' + animal + '/' + day + '/'
+        with h5py.File(folder_path + 'full_' + animal + '_' + day + '__data.hdf5', 'r') as f:
+            # obtain C divided by trial
+            C_ord = ut.time_lock_activity(f, sec_bin, cache_dir=cache_dir)
+            array_t1 = np.asarray(f['array_t1'])
+        # trial label
+        classif = np.zeros(C_ord.shape[0])
+        classif[array_t1] = 1
+        # steps to run throuhg C_ord
+        steps = np.arange(0, np.nansum(sec_bin) + step, step)
+        for ind, s in enumerate(steps[1::]):
+            tasks.append((np.nansum(C_ord[:, :, steps[ind]:s], 2), classif, cv, n_jobs, threads))
+        session_bins.append((folder_path, steps, C_ord.shape[1]))
+
+    if nproc == 1:
+        fits = [_rfecv_bin(*task) for task in tasks]
+    else:
+        # Executor workers, unlike mp.Pool ones, can start the fold processes of n_jobs
+        with ProcessPoolExecutor(nproc) as executor:
+            fits = list(executor.map(_rfecv_bin, *zip(*tasks)))
+
+    out = []
+    k = 0
+    for folder_path, steps, N in session_bins:
+        nbins = steps.shape[0] - 1
+        session_fits = fits[k:k + nbins]
+        k += nbins
+        results = {
+            'ranking': np.array([fit[0] for fit in session_fits], dtype=np.int32).reshape((nbins, N)),
+            'support': np.array([fit[1] for fit in session_fits], dtype=bool).reshape((nbins, N)),
+            'scores': np.array([fit[2] for fit in session_fits]).reshape((nbins, -1)),
+            'steps': steps}
+        if save:
+            np.savez(folder_path + 'rfecv_results.npz', **results)
+        out.append((results, rfecv_selected(results, score_min)))
+    return out
 
 
 def feature_select(folder, animal, day, sec_var='', sec_bin=[30, 0], step=5,
-    score_min=0.9, toplot=True):
+    score_min=0.9, toplot=True, nproc=1, n_jobs=1, save=True):
     """Function to select neurons that are relevant to the task, it goes iteratively through a
     temporal vector defined by sec_bin with bins of step
     folder (str): folder where the input/output is/will be stored 
@@ -340,59 +537,59 @@ def feature_select(folder, animal, day, sec_var='', sec_bin=[30, 0], step=5,
     sec_var (str): secondary variable to identify type of experiment
     sec_bin (tuple): frames before and after exp.
     score_min: minimum value to consider the feature selection
+    nproc, n_jobs, save: see feature_select_sessions
     return 
-    sel_neurs: an array of the fitted RFECV models
+    results: the RFECV rankings, support masks and CV scores of each time bin (see feature_select_sessions)
     neur : index of neurons to consider
     and number of neurons selected
     """
-    folder_path = folder +  'processed/' + animal + '/' + day + '/'
-    f = h5py.File(folder_path + 'full_' + animal + '_' + day + '__data.hdf5','r')
- 
-    # obtain C divided by trial
-    C_ord = ut.time_lock_activity(f, sec_bin)
-    array_t1 = np.asarray(f['array_t1'])
-    
-    # trial label 
-    classif = np.zeros(C_ord.shape[0])
-    classif[array_t1] = 1
-    
-    # steps to run throuhg C_ord
-    steps = np.arange(0, np.nansum(sec_bin) + step, step)
-        
-    # prepare models
-    lr = sklearn.linear_model.LogisticRegression()
-    selector = sklearn.feature_selection.RFECV(
-        lr, step=1, cv=5, scoring='balanced_accuracy'
-        )
-    
-    # init neur
-    neur = np.zeros(C_ord.shape[1]).astype('bool')
-    succesful_steps = np.zeros(steps.shape[0])
-    sel_neurs = []
-    
-    # run models through each step
-    for ind, s in enumerate(steps[1::]):
-        data = np.nansum(C_ord[:, :, steps[ind]:s], 2)
-        sel_neur = selector.fit(data, classif)
-        # if the info is good keep the neurons
-        if max(sel_neur.grid_scores_) > score_min:
-            neur = np.logical_or(sel_neur.support_, neur)
-        succesful_steps[ind] = max(sel_neur.grid_scores_)
-        if toplot:
-            plt.plot(sel_neur.grid_scores_, label=str(ind))
-        sel_neurs.append(sel_neur)
-    
+    [(results, neur)] = feature_select_sessions(folder, [(animal, day)], sec_bin, step, score_min,
+                                                nproc=nproc, n_jobs=n_jobs, save=save)
     if toplot:
+        for ind, scores in enumerate(results['scores']):
+            plt.plot(scores, label=str(ind))
         plt.legend()
     
-    return sel_neurs, neur, np.sum(neur)
+    return results, neur, np.sum(neur)
 
 
 # def tdmodel(folder, animal, day, sec_var='', to_plot=True):
     # Create TD model and compare V(t) and d(T) to activity of neurons
     # IT/PT/REST
 
-def raw_activity_tuning_single_session(folder, animal, day, i, window=3000, itype='dff', metric='raw', zcap=None):
+def binned_means(S, windows):
+    """
+    Means of S (N, T) over consecutive bins of every size in WINDOWS, the last bin of each size holding
+    the remaining frames, all from one prefix sum over time. NaNs are left out, as in np.nanmean.
+    return: list of (N, number of bins) arrays, one per size in WINDOWS
+    """
+    S = np.asarray(S, dtype=np.float64)
+    N, T = S.shape
+    valid = ~np.isnan(S)
+    csum = np.zeros((N, T + 1))
+    np.cumsum(np.where(valid, S, 0.0), axis=1, out=csum[:, 1:])
+    ccount = np.zeros((N, T + 1), dtype=np.int64)
+    np.cumsum(valid, axis=1, out=ccount[:, 1:])
+    avgs = []
+    for window in windows:
+        edges = np.append(np.arange(0, T, window), T)
+        sums, counts = np.diff(csum[:, edges], axis=1), np.diff(ccount[:, edges], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            avgs.append(np.where(counts > 0, sums / counts, np.nan))
+    return avgs
+
+
+def _activity_metric(S, metric, zcap):
+    # Activity used by raw_activity_tuning; the z-score is per neuron, so any slice of neurons can be used
+    if metric == 'mean' and zcap is not None:
+        zscoreS = zscore(S, axis=1)
+        if zcap != -1:
+            zscoreS = np.minimum(zscoreS, np.full_like(S, zcap))
+        return np.ma.filled(zscoreS, np.nan)
+    return S
+
+
+def _load_raw_activity(processed, animal, day, itype):
     hf = encode_to_filename(processed, animal, day)
     if not os.path.exists(hf):
         print("Not found:, ", hf)
@@ -400,39 +597,51 @@ def raw_activity_tuning_single_session(folder, animal, day, i, window=3000, ityp
         S = np.array(fp[itype])
         # TODO: maybe include trial activity tuning
         #array_hit, array_miss = np.array(fp['array_t1']), np.array(fp['array_miss'])
-        ens_neur = np.array(fp['ens_neur'])
-        e2_neur = ens_neur[fp['e2_neur']] if 'e2_neur' in fp else None
-        redlabel, nerden = np.array(fp['redlabel']), np.array(fp['nerden'])
         rois = get_roi_type(fp, animal, day)
-    if metric == 'mean' and zcap is not None:
-        zscoreS = zscore(S, axis=1)
-        if zcap != -1:
-            zscoreS = np.minimum(zscoreS, np.full_like(S, zcap))
-    else:
-        zscoreS = S
-    N = S.shape[0]
-    nsessions = S.shape[1] // window
-    remainder = S.shape[1] - nsessions * window
-    Sfirst = (zscoreS[:, :nsessions * window]).reshape((S.shape[0], nsessions, window), order='C')
-    avg_S = np.nanmean(Sfirst, axis=2)
-    if remainder > 0:
-        Sremain = zscoreS[:, nsessions * window:]
-        avg_S = np.concatenate((avg_S, np.nanmean(Sremain, keepdims=True, axis=1)), axis=1)
-
-    # N, sw, st = probeW.shape[0], probeW.shape[1], probeT.shape[1]
-    # ROI_type
-    sw = nsessions + (1 if remainder else 0)
-    
-    # DF Window
-    results = [np.tile(np.arange(sw), N), np.repeat(rois, sw), np.repeat(np.arange(N), sw), avg_S.ravel(order='C'),
-    np.full(N * sw, animal[:2]), np.full(N * sw, animal), np.full(N * sw, day), np.full(N*sw, i+1)]
+    return S, rois
+
+
+def _raw_activity_results(avgs, rois, animal, day, i, windows):
+    # Columns of the raw_activity_tuning table for the binned means AVGS of one session
+    columns = []
+    for window, avg_S in zip(windows, avgs):
+        N, sw = avg_S.shape
+        # DF Window
+        columns.append([np.tile(np.arange(sw), N), np.repeat(rois, sw), np.repeat(np.arange(N), sw),
+                        avg_S.ravel(order='C'), np.full(N * sw, animal[:2]), np.full(N * sw, animal),
+                        np.full(N * sw, day), np.full(N * sw, i + 1), np.full(N * sw, window)])
+    return [np.concatenate(column) for column in zip(*columns)]
+
+
+def _raw_activity_chunk(shm_name, shape, dtype, start, stop, windows, metric, zcap):
+    # Binned means of neurons START:STOP of a session shared by raw_activity_tuning
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        S = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[start:stop].copy()
+    finally:
+        shm.close()
+    return binned_means(_activity_metric(S, metric, zcap), windows)
+
+
+def raw_activity_tuning_single_session(folder, animal, day, i, window=3000, itype='dff', metric='raw', zcap=None):
+    """Binned mean activity of every neuron of one session, for one or several bin sizes WINDOW; returns
+    the columns of the raw_activity_tuning table, the last one being the bin size"""
+    processed = os.path.join(folder, 'CaBMI_analysis/processed')
+    windows = [int(w) for w in np.atleast_1d(window)]
+    S, rois = _load_raw_activity(processed, animal, day, itype)
+    results = _raw_activity_results(binned_means(_activity_metric(S, metric, zcap), windows), rois,
+                                    animal, day, i, windows)
     print(animal, day, 'done')
     return results
 
 
-def raw_activity_tuning(folder, groups, window=3000, itype='dff', metric='mean', zcap=None, test=True, nproc=1):
+def raw_activity_tuning(folder, groups, window=3000, itype='dff', metric='mean', zcap=None, test=True, nproc=1,
+                        chunk_size=256):
     # TODO: ADD OPTION TO PASS IN A LIST OF METHODS FOR COMPARING THE PLOTS!
-    """Calculates Peak Timing and Stores them in csvs for all animal sessions in groups located in folder."""
+    """Calculates Peak Timing and Stores them in csvs for all animal sessions in groups located in folder.
+    WINDOW may be a list of bin sizes, all computed from one prefix sum per session. With NPROC > 1 each
+    session is read once, shared with the workers, and its neurons split into tasks of CHUNK_SIZE rows;
+    the next session is read while the workers process the current one."""
     if nproc == 0:
         nproc = mp.cpu_count()
     processed = os.path.join(folder, 'CaBMI_analysis/processed')
@@ -441,78 +650,88 @@ def raw_activity_tuning(folder, groups, window=3000, itype='dff', metric='mean',
     else:
         all_files = {g: parse_group_dict(processed, groups[g], g) for g in groups.keys()}
     print(all_files)
-    hp = 'window{}_zcap{}'.format(window, zcap)
+    windows = [int(w) for w in np.atleast_1d(window)]
+    hp = 'window{}_zcap{}'.format('-'.join(str(w) for w in windows), zcap)
     S_OPT = metric + 'Z' if zcap is not None else '' + itype
     Z_OPT = S_OPT + 'zcap{}'.format(zcap) if zcap != -1 else ''
-    resW = {n: [] for n in ['window', 'roi_type', 'N', S_OPT, 'group', 'animal',
-       'date', 'session']}
-    def helper(animal):
-        ress = []
-        for i, day in enumerate(sorted(group_dict[animal])):
-            ress.append(raw_activity_tuning_single_session(folder, animal, day, i, window, itype, metric, zcap))
-        return ress
+    columns = ['window', 'roi_type', 'N', S_OPT, 'group', 'animal', 'date', 'session', 'binsize']
+    resW = {n: [] for n in columns}
+    sessions = [(animal, day, i) for group in all_files for animal in all_files[group]
+                for i, day in enumerate(sorted(all_files[group][animal]))]
     if nproc == 1:
-        for group in all_files:
-            group_dict = all_files[group]
-            for animal in group_dict:
-                results = helper(animal)
-                for result in results:
-                    resW['window'].append(result[0])
-                    resW['roi_type'].append(result[1])
-                    resW['N'].append(result[2])
-                    resW[S_OPT].append(result[3])
-                    resW['group'].append(result[4])
-                    resW['animal'].append(result[5])
-                    resW['date'].append(result[6])
-                    resW['session'].append(result[7])
-
-                # # DF TRIAL
-                # trials = np.arange(1, st + 1)
-                # tempm = trials[array_miss]
-                # temph = trials[array_hit]
-                # misses = np.empty_like(tempm)
-                # hits = np.empty_like(temph)
-                # sortedm = np.argsort(tempm)
-                # sortedh = np.argsort(temph)
-                # for i in range(len(sortedm)):
-                #     misses[sortedm[i]] = -i - 1
-                # for i in range(len(sortedh)):
-                #     hits[sortedh[i]] = i + 1
-                # hm_trial = np.empty_like(trials)
-                # hm_trial[array_hit] = hits
-                # hm_trial[array_miss] = misses
-                # # trials[array_miss] = -trials[array_miss]
-                # # awhere = np.where(trials < 0)[0]
-                # # assert np.array_equal(awhere, array_miss), "NOt alligned {} {}".format(awhere, array_miss)
-                # resT['trial'] = np.tile(trials, N)  # 1-indexed
-                # resT['HM_trial'] = np.tile(hm_trial, N)  # 1-indexed
-                # resT['roi_type'] = np.repeat(rois, st)
-                # resT['N'] = np.repeat(np.arange(N), st)
-                # for k in mets_window:
-                #     resW[k] = mets_window[k].ravel(order='C')
-                #     resT[k] = mets_trial[k].ravel(order='C')
-
-                # print(N, sw, st)
-                # def debug_print(res):
-                #     for k in res.keys():
-                #         print(k, res[k].shape)
-                # debug_print(resW)
-                # debug_print(resT)
-                # df_trial = pd.DataFrame(resT)
+        results = [raw_activity_tuning_single_session(folder, animal, day, i, windows, itype, metric, zcap)
+                   for animal, day, i in sessions]
     else:
-        p = mp.Pool(nproc)
-        series = [(folder, animal, day, i, window, itype, metric, zcap) 
-        for group in all_files for animal in all_files[group] for i, day in enumerate(sorted(all_files[group][animal]))]
-        results = p.starmap_async(raw_activity_tuning_single_session, series).get()
-        for result in results:
-            resW['window'].append(result[0])
-            resW['roi_type'].append(result[1])
-            resW['N'].append(result[2])
-            resW[S_OPT].append(result[3])
-            resW['group'].append(result[4])
-            resW['animal'].append(result[5])
-            resW['date'].append(result[6])
-            resW['session'].append(result[7])
+        results = []
+        pending = []
+
+        def finish(entry):
+            shm, rois, (animal, day, i), async_result = entry
+            try:
+                chunks = async_result.get()
+            finally:
+                shm.close()
+                shm.unlink()
+            avgs = [np.concatenate([chunk[k] for chunk in chunks]) for k in range(len(windows))]
+            results.append(_raw_activity_results(avgs, rois, animal, day, i, windows))
+            print(animal, day, 'done')
+
+        with mp.Pool(nproc) as p:
+            try:
+                for animal, day, i in sessions:
+                    S, rois = _load_raw_activity(processed, animal, day, itype)
+                    shm = shared_memory.SharedMemory(create=True, size=max(S.nbytes, 1))
+                    np.ndarray(S.shape, dtype=S.dtype, buffer=shm.buf)[:] = S
+                    tasks = [(shm.name, S.shape, S.dtype.str, a, min(a + chunk_size, S.shape[0]), windows,
+                              metric, zcap) for a in range(0, S.shape[0], chunk_size)]
+                    pending.append((shm, rois, (animal, day, i), p.starmap_async(_raw_activity_chunk, tasks)))
+                    del S
+                    if len(pending) > 1:
+                        finish(pending.pop(0))
+                while pending:
+                    finish(pending.pop(0))
+            finally:
+                for shm, _, _, _ in pending:
+                    shm.close()
+                    shm.unlink()
+
+    for result in results:
+        for k, column in zip(columns, result):
+            resW[k].append(column)
+
+    # # DF TRIAL
+    # trials = np.arange(1, st + 1)
+    # tempm = trials[array_miss]
+    # temph = trials[array_hit]
+    # misses = np.empty_like(tempm)
+    # hits = np.empty_like(temph)
+    # sortedm = np.argsort(tempm)
+    # sortedh = np.argsort(temph)
+    # for i in range(len(sortedm)):
+    #     misses[sortedm[i]] = -i - 1
+    # for i in range(len(sortedh)):
+    #     hits[sortedh[i]] = i + 1
+    # hm_trial = np.empty_like(trials)
+    # hm_trial[array_hit] = hits
+    # hm_trial[array_miss] = misses
+    # # trials[array_miss] = -trials[array_miss]
+    # # awhere = np.where(trials < 0)[0]
+    # # assert np.array_equal(awhere, array_miss), "NOt alligned {} {}".format(awhere, array_miss)
+    # resT['trial'] = np.tile(trials, N)  # 1-indexed
+    # resT['HM_trial'] = np.tile(hm_trial, N)  # 1-indexed
+    # resT['roi_type'] = np.repeat(rois, st)
+    # resT['N'] = np.repeat(np.arange(N), st)
+    # for k in mets_window:
+    #     resW[k] = mets_window[k].ravel(order='C')
+    #     resT[k] = mets_trial[k].ravel(order='C')
+
+    # print(N, sw, st)
+    # def debug_print(res):
+    #     for k in res.keys():
+    #         print(k, res[k].shape)
+    # debug_print(resW)
+    # debug_print(resT)
+    # df_trial = pd.DataFrame(resT)
 
     for k in resW:
         print(k, len(resW[k]))
@@ -534,13 +753,37 @@ def raw_activity_tuning(folder, groups, window=3000, itype='dff', metric='mean',
     return df_window
 
 
-def coactivation_single_session(inputs, window=3000, mlag=10, include_dend=False, source='dff', out=None):
-    # N * N * w * d
+def _write_coactivation_progress(progress, progress_file):
+    tmp = progress_file + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(progress, fp)
+    os.replace(tmp, progress_file)
+
+
+def load_coactivation(savepath):
+    """Opens a result of coactivation_single_session as a read-only memmap
+    of shape (N, N, nW, 2 * mlag + 1)."""
+    with open(savepath + '.json') as fp:
+        progress = json.load(fp)
+    return np.memmap(savepath, dtype=progress['dtype'], mode='r', shape=tuple(progress['shape']))
+
+
+def coactivation_single_session(inputs, window=3000, mlag=10, include_dend=False, source='dff', out=None,
+                                memory_budget=2**30, dtype=np.float32):
+    """
+    Lagged cross-correlation of every pair of neurons within consecutive windows of WINDOW frames, for
+    lags -MLAG..MLAG only. Entry [i, j, w, MLAG + d] is sum_n S[i, n + d] * S[j, n] over window w, the
+    value scipy.signal.correlate(S_i, S_j, mode='same') has at lag d. Windows are FFT'd and
+    correlated in batches, by blocks of neurons, so that the spectra and products stay within
+    MEMORY_BUDGET bytes; each finished block is recorded in a '<savepath>.json' progress file so an
+    interrupted run resumes where it stopped.
+    :return: path of the (N, N, nW, 2 * MLAG + 1) memmap of DTYPE; see load_coactivation
+    """
     if isinstance(inputs, np.ndarray):
         S = inputs
         animal, day = None, None
         path = './'
-        savename = 'sample_{}_coactivation_w{}.dat'.format(source, window)
+        savename = 'sample_{}_coactivation_w{}_lag{}.dat'.format(source, window, mlag)
         if out is None:
             out = path
         savepath = os.path.join(out, savename)
@@ -562,13 +805,11 @@ def coactivation_single_session(inputs, window=3000, mlag=10, include_dend=False
             f = inputs
         else:
             raise RuntimeError("Input Format Unknown!")
-        savename = '{}_{}_{}_coactivation_w{}{}.dat'\
-            .format(animal, day, source, window, '_nerden' if include_dend else '')
+        savename = '{}_{}_{}_coactivation_w{}_lag{}{}.dat'\
+            .format(animal, day, source, window, mlag, '_nerden' if include_dend else '')
         if out is None:
             out = path
         savepath = os.path.join(out, savename)
-        if os.path.exists(savepath):
-            return
         if f is None:
             f = h5py.File(hfile, 'r')
 
@@ -580,13 +821,52 @@ def coactivation_single_session(inputs, window=3000, mlag=10, include_dend=False
         os.makedirs(out)
     N, T = S.shape
     nW = int(np.ceil(T/window))
-    neurcorr = np.memmap(savepath, mode='w+', shape=(N, N, nW, T))
-    for i in range(N):
-        for j in range(N):
-            for w in range(nW):
-                b = window*w
-                l = T-b if w == nW-1 else window
-                neurcorr[i, j, w, :l] = correlate(S[i, b: b + l], S[j, b: b + l], mode='same')
+    shape = [N, N, nW, 2 * mlag + 1]
+    progress_file = savepath + '.json'
+    progress = None
+    if os.path.exists(progress_file) and os.path.exists(savepath):
+        with open(progress_file) as fp:
+            progress = json.load(fp)
+        if progress['shape'] != shape or progress['dtype'] != np.dtype(dtype).str:
+            progress = None # Stale output from other data or settings
+        elif progress['complete']:
+            return savepath
+
+    # Zero-padding the last window and to NFFT >= WINDOW + MLAG adds no products within the lag band
+    nfft = 1 << (window + mlag - 1).bit_length()
+    lag_idx = np.arange(-mlag, mlag + 1) % nfft
+    # Complex products plus their inverse transform, per pair and window
+    pair_bytes = nfft * 24
+    # Spectra of every neuron, per window
+    spectrum_bytes = N * (nfft // 2 + 1) * 16
+    if progress is None:
+        block_size = int(np.clip(memory_budget // (pair_bytes * N * nW), 1, N))
+        progress = {'shape': shape, 'dtype': np.dtype(dtype).str, 'block_size': block_size,
+                    'done_blocks': [], 'complete': False}
+        neurcorr = np.memmap(savepath, dtype=dtype, mode='w+', shape=tuple(shape))
+        _write_coactivation_progress(progress, progress_file)
+    else:
+        block_size = progress['block_size']
+        neurcorr = np.memmap(savepath, dtype=dtype, mode='r+', shape=tuple(shape))
+    window_batch = int(np.clip(memory_budget // (pair_bytes * N * block_size + spectrum_bytes), 1, nW))
+
+    for b, start in enumerate(range(0, N, block_size)):
+        if b in progress['done_blocks']:
+            continue
+        block = slice(start, min(start + block_size, N))
+        for w in range(0, nW, window_batch):
+            ws = slice(w, min(w + window_batch, nW))
+            windows = np.zeros((N, (ws.stop - w) * window))
+            frames = S[:, w * window:ws.stop * window]
+            windows[:, :frames.shape[1]] = frames
+            S_f = np.fft.rfft(windows.reshape((N, -1, window)), n=nfft, axis=2)
+            prod = S_f[block, np.newaxis] * np.conj(S_f[np.newaxis])
+            neurcorr[block, :, ws, :] = np.fft.irfft(prod, n=nfft, axis=-1)[..., lag_idx]
+        neurcorr.flush()
+        progress['done_blocks'].append(b)
+        _write_coactivation_progress(progress, progress_file)
+    progress['complete'] = True
+    _write_coactivation_progress(progress, progress_file)
     del neurcorr
     return savepath
 
@@ -604,25 +884,43 @@ def extract_clean_dff(A, C, B, F, raw=True):
         return C / F0
 
 
-def MF_infer_f0(A, C, B, Yr, efficient=True):
+def _frame_chunks(T, chunk_size):
+    # Consecutive (start, stop) frame ranges covering T frames
+    if chunk_size is None:
+        chunk_size = T
+    return [(t, min(t + chunk_size, T)) for t in range(0, T, max(int(chunk_size), 1))]
+
+
+def MF_infer_f0(A, C, B, Yr, efficient=True, chunk_size=1000):
     # A, C, B, Yr numpy arrays of the same orders
+    # Yr (or the memmap of the movie) is read CHUNK_SIZE frames at a time
     B_inv = np.linalg.inv(B.T @ B)
     if B.shape[0] != A.shape[0]:
         A = A.T
+    T = Yr.shape[1]
+    F = np.empty((B.shape[1], T))
     if efficient:
-        return B_inv @ (B.T @ Yr - (B.T @ A) @ C)
+        BA = B.T @ A
+        for start, stop in _frame_chunks(T, chunk_size):
+            F[:, start:stop] = B_inv @ (B.T @ Yr[:, start:stop] - BA @ C[:, start:stop])
     else:
-        R = Yr - A @ C
-        return B_inv @ (B.T @ R)
+        for start, stop in _frame_chunks(T, chunk_size):
+            R = Yr[:, start:stop] - A @ C[:, start:stop]
+            F[:, start:stop] = B_inv @ (B.T @ R)
+    return F
 
 
-def compute_residuals(Yr, A, C, b, f, block_size=5000, num_blocks_per_run=20, dview=None):
+def compute_residuals(Yr, A, C, b, f, block_size=5000, num_blocks_per_run=20, dview=None,
+                      chunk_size=1000):
     # adapted from caiman/source_extraction/cnmf/cnmf.py
     """compute residual for each component (variable YrA)
 
      Args:
          Yr :    np.ndarray
                  movie in format pixels (d) x frames (T)
+         chunk_size :  int
+                 without a dview, Yr is projected on the sparse components CHUNK_SIZE frames
+                 at a time, so only one chunk of the movie is in memory
 
     """
     if 'csc_matrix' not in str(type(A)):
@@ -639,29 +937,36 @@ def compute_residuals(Yr, A, C, b, f, block_size=5000, num_blocks_per_run=20, dv
     nA2_inv_mat = scipy.sparse.spdiags(
         1. / nA2, 0, nA2.shape[0], nA2.shape[0])
     Cf = np.vstack((C, f))
-    if 'numpy.ndarray' in str(type(Yr)):
-        YA = (Ab.T.dot(Yr)).T * nA2_inv_mat
-    else:
+    AA = Ab.T.dot(Ab) * nA2_inv_mat
+    if dview is not None and 'numpy.ndarray' not in str(type(Yr)):
         YA = cm.mmapping.parallel_dot_product(Yr, Ab, dview=dview, block_size=block_size,
                                               transpose=True,
                                               num_blocks_per_run=num_blocks_per_run) * nA2_inv_mat
+        return (YA - (AA.T.dot(Cf)).T)[:, :A.shape[-1]].T
 
-    AA = Ab.T.dot(Ab) * nA2_inv_mat
-    return (YA - (AA.T.dot(Cf)).T)[:, :A.shape[-1]].T
+    AtT = Ab.T.tocsr()
+    YrA = np.empty((A.shape[-1], Yr.shape[1]))
+    for start, stop in _frame_chunks(Yr.shape[1], chunk_size):
+        YA = (AtT.dot(np.asarray(Yr[:, start:stop]))).T * nA2_inv_mat
+        YrA[:, start:stop] = (YA - (AA.T.dot(Cf[:, start:stop])).T)[:, :A.shape[-1]].T
+    return YrA
 
 
 def compute_SNR_from_traces(A, C, b, f, Yr, pix, fr=4, decay_time=0.4, gSig=(3, 3), min_SNR=2.5, rval_thr=0.8,
-                            cnn_thr=0.8, block_size=5000, num_blocks_per_run=20, dview=None):
+                            cnn_thr=0.8, block_size=5000, num_blocks_per_run=20, dview=None, YrA=None):
     """
     Args:
          Yr :    np.ndarray
                  movie in format pixels (d) x frames (T)
+         YrA :   np.ndarray or None
+                 residuals of the same frames, computed from Yr if None
     compare with cnm.estimates.YrA: mean: 0.9688151430842026 max:  0.99811120903548 min:  0.8694174255835385
     """
     dims = (pix, pix)
     T = Yr.shape[1]
     images = np.reshape(Yr, dims + (T,), order='F')
-    YrA = compute_residuals(Yr, A, C, b, f, block_size, num_blocks_per_run, dview)
+    if YrA is None:
+        YrA = compute_residuals(Yr, A, C, b, f, block_size, num_blocks_per_run, dview)
     idx_components, idx_components_bad, SNR_comp, r_values, cnn_preds = \
         estimate_components_quality_auto(images, A, C, b, f, YrA, fr, decay_time, gSig, dims,
                                          dview=dview, min_SNR=min_SNR,
@@ -669,10 +974,41 @@ def compute_SNR_from_traces(A, C, b, f, Yr, pix, fr=4, decay_time=0.4, gSig=(3,
     return SNR_comp
 
 
+def segment_SNRs(A, C, b, f, Yr, pix, segments, YrA=None, block_size=5000, num_blocks_per_run=20,
+                 dview=None, **kwargs):
+    """
+    SNR_comp of several time segments of one plane, all derived from the residuals of the
+    whole movie: the residuals of frames start:stop are the columns start:stop of YrA, so
+    the movie is only projected once.
+    Args:
+         segments :  dict {name: (start, stop)}; stop None for the end of the movie
+         YrA :       np.ndarray or None
+                     residuals of the whole movie, computed from Yr if None
+         kwargs :    passed to compute_SNR_from_traces
+    Returns:
+         dict {name: SNR_comp}
+    """
+    if YrA is None:
+        YrA = compute_residuals(Yr, A, C, b, f, block_size, num_blocks_per_run, dview)
+    SNRs = {}
+    for name, (start, stop) in segments.items():
+        seg = slice(start, stop)
+        SNRs[name] = compute_SNR_from_traces(A, C[:, seg], b, f[:, seg], Yr[:, seg], pix,
+                                             dview=dview, YrA=YrA[:, seg], **kwargs)
+    return SNRs
+
+
 def estimate_SNR_hfile(fnames, hfile, fr, used_planes=1, numplanes=1, pixel=256, decay_time=0.4,
                        gSig=(3, 3), min_SNR=2.5, rval_thr=0.8, cnn_thr=0.8, block_size=5000,
-                       num_blocks_per_run=20, dview=None, baseline=True, motion=True, ORDER='F'):
-    """Given single plane [tiff fnames] and hfile, get SNR_comp"""
+                       num_blocks_per_run=20, dview=None, baseline=True, motion=True, ORDER='F',
+                       segments=None, baseline_len=9000, chunk_size=1000):
+    """Given single plane [tiff fnames] and hfile, get SNR_comp
+    The residuals are computed once for the whole movie and every segment (the whole movie,
+    the first BASELINE_LEN frames if BASELINE, and each of SEGMENTS, {name: (start, stop)})
+    takes its SNR from them.
+    Returns SNR_comp, SNR_comp_base (if BASELINE), Fhat; or, if SEGMENTS is given, a dict of
+    SNR_comp per segment name ('full', 'baseline' and SEGMENTS) and Fhat
+    The movie is streamed CHUNK_SIZE frames at a time"""
 
     # Params
     # motion correct
@@ -700,6 +1036,7 @@ def estimate_SNR_hfile(fnames, hfile, fr, used_planes=1, numplanes=1, pixel=256,
     first_file = fnames[0]
     if isinstance(fnames, np.ndarray):
         Yr, p = fnames, pixel
+        T = Yr.shape[1]
     elif '.mmap' in first_file or '.tif' in first_file:
         if motion:
             print('***************Starting motion correction*************')
@@ -742,23 +1079,26 @@ def estimate_SNR_hfile(fnames, hfile, fr, used_planes=1, numplanes=1, pixel=256,
     else:
         raise NotImplementedError("currently only supports mmap, tif, and numpy array")
 
-    Fhat = MF_infer_f0(A, C[:, :T], B, Yr)  
+    Fhat = MF_infer_f0(A, C[:, :T], B, Yr, chunk_size=chunk_size)
+    YrA = compute_residuals(Yr, A, C[:, :T], B, Fhat, block_size, num_blocks_per_run, dview,
+                            chunk_size=chunk_size)
 
-    SNR_comp = compute_SNR_from_traces(A, C[:, :T], B, Fhat, Yr, p, fr=fr, decay_time=decay_time, gSig=gSig,
-                                       min_SNR=min_SNR, rval_thr=rval_thr, cnn_thr=cnn_thr,
-                                       block_size=block_size, num_blocks_per_run=num_blocks_per_run,
-                                       dview=dview)
+    all_segments = {'full': (0, T)}
+    if baseline:
+        all_segments['baseline'] = (0, baseline_len)
+    if segments is not None:
+        all_segments.update(segments)
+    SNRs = segment_SNRs(A, C[:, :T], B, Fhat, Yr, p, all_segments, YrA=YrA, dview=dview, fr=fr,
+                        decay_time=decay_time, gSig=gSig, min_SNR=min_SNR, rval_thr=rval_thr,
+                        cnn_thr=cnn_thr)
+    if segments is not None:
+        return SNRs, Fhat
     if baseline:
-        blen = 9000
-        SNR_comp_base = compute_SNR_from_traces(A, C[:, :blen], B, Fhat[:, :blen], Yr[:, :blen], p, fr=fr, decay_time=decay_time, gSig=gSig,
-                                           min_SNR=min_SNR, rval_thr=rval_thr, cnn_thr=cnn_thr,
-                                           block_size=block_size, num_blocks_per_run=num_blocks_per_run,
-                                           dview=dview)
-        return SNR_comp, SNR_comp_base, Fhat
-    return SNR_comp, Fhat
+        return SNRs['full'], SNRs['baseline'], Fhat
+    return SNRs['full'], Fhat
 
 
-def calc_SNR_all_planes(folder, animal, day, num_files, num_files_b, number_planes=4):
+def calc_SNR_all_planes(folder, animal, day, num_files, num_files_b, number_planes=4, segments=None):
     """
     Function to analyze every plane and get the result in a hdf5 file. It uses caiman_main
     Folder(str): folder where the input/output is/will be stored
@@ -769,7 +1109,9 @@ def calc_SNR_all_planes(folder, animal, day, num_files, num_files_b, number_plan
     number_planes_total(int): number of planes given back by the recording system, it may differ from number_planes
     to provide time for the objective to return to origen
     dend(bool): Boleean to change parameters to look for neurons or dendrites
-    display_images(bool): to display and save different plots"""
+    display_images(bool): to display and save different plots
+    segments(dict): extra {name: (start, stop)} frame segments, saved as SNR_<name>; each plane
+    computes its residuals once for all of them"""
 
     folder_path = folder + 'raw/' + animal + '/' + day + '/separated/'
     finfo = folder + 'raw/' + animal + '/' + day + '/wmat.mat'  # file name of the mat
@@ -780,6 +1122,7 @@ def calc_SNR_all_planes(folder, animal, day, num_files, num_files_b, number_plan
     print('*************Starting with analysis*************')
     SNR_mats = []
     SNR_basemats = []
+    SNR_segmats = {name: [] for name in (segments or {})}
     planes = []
     fHats = []
 
@@ -798,9 +1141,12 @@ def calc_SNR_all_planes(folder, animal, day, num_files, num_files_b, number_plan
         hf = h5py.File(folder + 'raw/' + animal + '/' + day + '/' + 'bmi_' +  '_' + str(plane) + '.hdf5', 'r')
 
         print(fnames)
-        SNRcomps, SNR_comp_base, fHat = estimate_SNR_hfile(fnames, hf, fr)
+        SNRs, fHat = estimate_SNR_hfile(fnames, hf, fr, segments=segments or {})
+        SNRcomps = SNRs['full']
         SNR_mats.append(SNRcomps)
-        SNR_basemats.append(SNR_comp_base)
+        SNR_basemats.append(SNRs['baseline'])
+        for name in SNR_segmats:
+            SNR_segmats[name].append(SNRs[name])
         fHats.append(fHat)
         planes = planes + len(SNRcomps) * [plane]
         hf.close()
@@ -811,20 +1157,23 @@ def calc_SNR_all_planes(folder, animal, day, num_files, num_files_b, number_plan
         with h5py.File(snr_out, 'w-') as snrhf:
             snrhf['SNR'] = np.concatenate(SNR_mats)
             snrhf['SNR_baseline'] = np.concatenate(SNR_basemats)
+            for name, mats in SNR_segmats.items():
+                snrhf['SNR_' + name] = np.concatenate(mats)
             snrhf['F_hat'] = np.vstack(fHats)
             snrhf['plane'] = planes
     except IOError:
         print(" OOPS!: The file already existed ease try with another file, new results will NOT be saved")
 
 
-def all_run_SNR(folder, animal, day, number_planes=4, number_planes_total=6):
+def all_run_SNR(folder, animal, day, number_planes=4, number_planes_total=6, segments=None):
     """
     Function to run all the different functions of the pipeline that gives back the analyzed data
     Folder (str): folder where the input/output is/will be stored
     animal/day (str) to be analyzed
     number_planes (int): number of planes that carry information
     number_planes_total (int): number of planes given back by the recording system, it may differ from number_planes
-    to provide time for the objective to return to origen"""
+    to provide time for the objective to return to origen
+    segments (dict): extra {name: (start, stop)} frame segments to get the SNR of; see calc_SNR_all_planes"""
 
     folder_path = folder + 'raw/' + animal + '/' + day + '/'
     folder_final = folder + 'processed/' + animal + '/' + day + '/'
@@ -871,7 +1220,7 @@ def all_run_SNR(folder, animal, day, number_planes=4, number_planes_total=6):
     # readme.close()
 
     try:
-        calc_SNR_all_planes(folder, animal, day, num_files, num_files_b, number_planes)
+        calc_SNR_all_planes(folder, animal, day, num_files, num_files_b, number_planes, segments)
     except Exception as e:
         tb = sys.exc_info()[2]
         err_file.write("\n{}\n".format(folder_path))
@@ -893,44 +1242,146 @@ def all_run_SNR(folder, animal, day, number_planes=4, number_planes_total=6):
 #################################################################
 def f0_filter_sig(xs, ys, method=2, width=30):
     """
+    ys: np.ndarray (T,) or (N, T), all N signals are filtered together
     Return:
-        dff: np.ndarray (T, 2)
+        dff: np.ndarray (T, 2), or (N, T, 2)
             col0: dff
             col1: boundary scale for noise level
     """
     if method < 10:
-        mf, mDC = median_filter(width, method)
+        dc = DCache(width, method, buffer=True, ftype='median')
     else:
-        mf, mDC = std_filter(width, method%10, buffer=True)
-    dff = np.array([(mf(ys, i), mDC.get_dev()) for i in range(len(ys))])
-    return dff
+        dc = DCache(width, method%10, buffer=True)
+    return np.stack(dc.run(ys), axis=-1)
 
 
 def calcium_dff(xs, ys, method=2, width=30):
-    f0 =f0_filter_sig(xs, ys, method=method, width=width)[:, 0]
+    f0 =f0_filter_sig(xs, ys, method=method, width=width)[..., 0]
     return (ys-f0) / f0
 
 
-def caiman_SNR(xs, ys, source='raw', verbose=False):
+# Inputs of the deconvolution workers, attached once per process
+_DECONV_INPUTS = {}
+
+
+def _attach_deconv_inputs(specs):
+    """Pool initializer: maps the shared-memory blocks described by SPECS
+    ({key: (shm_name, shape, dtype)}) into numpy arrays."""
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _DECONV_INPUTS[key] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+
+def _deconvolve_chunk(start, stop, p, method, kwargs, chunk_file):
+    # Deconvolves traces START:STOP of the attached inputs
+    traces = _DECONV_INPUTS['traces'][1]
+    baselines = _DECONV_INPUTS['baselines'][1] if 'baselines' in _DECONV_INPUTS else None
+    res = {k: [] for k in ('c', 's', 'sn', 'g', 'bl', 'lam')}
+    for i in range(start, stop):
+        bl0 = None if baselines is None else baselines[i]
+        c, bl, c1, g, sn, sp, lam = constrained_foopsi(traces[i], bl=bl0, p=p,
+                                                       method_deconvolution=method, **kwargs)
+        g = np.ravel(g)
+        res['c'].append(c)
+        res['s'].append(sp)
+        res['sn'].append(sn)
+        res['g'].append(np.pad(g, (0, max(p - g.size, 0)), constant_values=np.nan)[:p])
+        # A baseline trace given as input is not repeated in the output
+        res['bl'].append(bl if np.ndim(bl) == 0 else np.nan)
+        res['lam'].append(np.nan if lam is None else lam)
+    res = {k: np.array(v, dtype=np.float64) for k, v in res.items()}
+    if chunk_file is not None:
+        tmp = chunk_file + '.tmp.npz'
+        np.savez(tmp, **res)
+        os.replace(tmp, chunk_file)
+    return res
+
+
+def deconvolve_traces(traces, baselines=None, p=2, nproc=1, chunk_size=32, out=None, **kwargs):
     """
-    method: str
-        raw: raw caiman SNR
-        dff: feed dff to caiman
-        dbl: specify baseline in foopsi
-        df: feed filtered signal to caiman
+    Runs constrained_foopsi over every row of TRACES, CHUNK_SIZE traces per task, over NPROC
+    processes that read the traces from shared memory. OASIS is used for AR orders it supports
+    (P <= 2), and CVXPY otherwise.
+    :param traces: np.ndarray (N, T)
+    :param baselines: None or np.ndarray (N, T); fixed baseline of each trace (foopsi bl)
+    :param out: None or directory; each finished chunk is saved there as
+        deconv_<start>_<stop>.npz and reused by later calls, so an interrupted run resumes.
+        Use one directory per input.
+    :param kwargs: passed to constrained_foopsi
+    :return: dict of arrays stacked in trace order: c (N, T), s (N, T), sn (N,), g (N, p),
+        bl (N,), lam (N,)
     """
+    traces = np.ascontiguousarray(traces, dtype=np.float64)
+    N = traces.shape[0]
+    method = 'oasis' if p <= 2 else 'cvxpy'
+    chunks = [(a, min(a + chunk_size, N)) for a in range(0, N, chunk_size)]
+    chunk_files = [None] * len(chunks)
+    results = [None] * len(chunks)
+    if out is not None:
+        if not os.path.exists(out):
+            os.makedirs(out)
+        for k, (a, b) in enumerate(chunks):
+            chunk_files[k] = os.path.join(out, 'deconv_{:06d}_{:06d}.npz'.format(a, b))
+            if os.path.exists(chunk_files[k]):
+                with np.load(chunk_files[k]) as saved:
+                    results[k] = dict(saved)
+    pending = [k for k in range(len(chunks)) if results[k] is None]
+    inputs = {'traces': traces}
+    if baselines is not None:
+        inputs['baselines'] = np.ascontiguousarray(baselines, dtype=np.float64)
+    tasks = [chunks[k] + (p, method, kwargs, chunk_files[k]) for k in pending]
+
+    if nproc == 1 or len(pending) <= 1:
+        _DECONV_INPUTS.update({key: (None, arr) for key, arr in inputs.items()})
+        try:
+            done = [_deconvolve_chunk(*task) for task in tasks]
+        finally:
+            _DECONV_INPUTS.clear()
+    else:
+        blocks, specs = [], {}
+        try:
+            for key, arr in inputs.items():
+                shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+                blocks.append(shm)
+                np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+                specs[key] = (shm.name, arr.shape, arr.dtype.str)
+            with mp.Pool(nproc, initializer=_attach_deconv_inputs, initargs=(specs,)) as pool:
+                done = pool.starmap(_deconvolve_chunk, tasks) # Keeps the task order
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+    for k, res in zip(pending, done):
+        results[k] = res
+    if not results:
+        return {k: np.empty((0,)) for k in ('c', 's', 'sn', 'g', 'bl', 'lam')}
+    return {k: np.concatenate([res[k] for res in results]) for k in results[0]}
+
+
+def _SNR_input(xs, ys, source):
+    # Trace and fixed baseline deconvolved for each caiman_SNR source, of one or several (N, T) signals
     if source == 'raw':
-        c, bl, c1, g, sn, sp, lam = constrained_foopsi(ys, p=2)
+        return ys, None
     elif source == 'dff':
-        dff = calcium_dff(xs, ys)
-        c, bl, c1, g, sn, sp, lam = constrained_foopsi(dff, p=2)
+        return calcium_dff(xs, ys), None
     elif source == 'dbl':
-        bl0 = f0_filter_sig(xs, ys)[:, 0]
-        c, bl, c1, g, sn, sp, lam = constrained_foopsi(ys, bl=bl0, p=2)
+        return ys, f0_filter_sig(xs, ys)[..., 0]
     elif source == 'df':
-        c, bl, c1, g, sn, sp, lam = constrained_foopsi(ys-f0_filter_sig(xs, ys)[:, 0], p=2)
+        return ys-f0_filter_sig(xs, ys)[..., 0], None
     else:
         raise NotImplementedError(f"source method {source} not recognized")
+
+
+def caiman_SNR(xs, ys, source='raw', verbose=False):
+    """
+    method: str
+        raw: raw caiman SNR
+        dff: feed dff to caiman
+        dbl: specify baseline in foopsi
+        df: feed filtered signal to caiman
+    """
+    trace, bl0 = _SNR_input(xs, ys, source)
+    c, bl, c1, g, sn, sp, lam = constrained_foopsi(trace, bl=bl0, p=2)
     sigpower = np.mean(np.square(c))
     snr = sigpower / (sn ** 2)
     if verbose:
@@ -939,14 +1390,27 @@ def caiman_SNR(xs, ys, source='raw', verbose=False):
     return snr
 
 
-def online_SNR_single_session(folder, animal, day, out):
+def caiman_SNR_batch(xs, Ys, source='raw', nproc=1, chunk_size=32, out=None):
+    """
+    caiman_SNR of every row of Ys, deconvolved with deconvolve_traces
+    :param Ys: np.ndarray (N, T)
+    :return: np.ndarray (N,) of SNRs
+    """
+    traces, baselines = _SNR_input(xs, np.atleast_2d(Ys), source)
+    res = deconvolve_traces(traces, baselines, p=2, nproc=nproc, chunk_size=chunk_size, out=out)
+    return np.mean(np.square(res['c']), axis=1) / (res['sn'] ** 2)
+
+
+def online_SNR_single_session(folder, animal, day, out, nproc=1):
     # Calculates SNR for single session then saves it to 4 decimal accuracy and saves in hdf5 file
+    # SNR_stream is the SNR the streaming estimator reaches replaying the online samples as they came
     dayfile = encode_to_filename(folder, animal, day)
     print(f'processing {dayfile}')
     outpath = os.path.join(out, animal, day)
     targetfile = os.path.join(outpath, f'onlineSNR_{animal}_{day}.hdf5')
     if os.path.exists(targetfile):
         print(f'{animal} {day} already done, skipping...')
+        return
     with h5py.File(dayfile, 'r') as session:
         if not os.path.exists(outpath):
             os.makedirs(outpath)
@@ -955,30 +1419,35 @@ def online_SNR_single_session(folder, animal, day, out):
         frame = np.array(od[:, 1]).astype(np.int32) // 6
         datamat = np.array(od[:, 2:])
         Tdf = frame[-1] + 1
-        SNRs = []
+        all_online_frames = np.arange(Tdf)
+        traces = []
         for i in range(Nens):
             data = datamat[:, i]
             sclean = ~np.isnan(data)
             f = interpolate.interp1d(frame[sclean], data[sclean], fill_value='extrapolate')
-            all_online_frames = np.arange(Tdf)
-            interp_online = f(all_online_frames)
-            SNRs.append(caiman_SNR(all_online_frames, interp_online))
+            traces.append(f(all_online_frames))
+        SNRs = caiman_SNR_batch(all_online_frames, np.vstack(traces), nproc=nproc)
+        stream = OnlineDFFEstimator(Nens).replay(datamat.T)
         try:
             with h5py.File(targetfile, 'w-') as osnr:
                 osnr['SNR_ens'] = np.around(SNRs, 4)
+                osnr['SNR_stream'] = np.around(stream['snr'], 4)
         except IOError:
             print(" OOPS!: The file already existed please try with another file, "
                   "new results will NOT be saved")
 
 
-def dff_SNR_single_session(folder, animal, day, out):
+def dff_SNR_single_session(folder, animal, day, out, nproc=1, chunk_size=32):
     # Calculates SNR for single session then saves it to 4 decimal accuracy and saves in hdf5 file
+    # Deconvolved chunks are kept in a side folder until the session is done, so reruns resume
     dayfile = encode_to_filename(folder, animal, day)
     print(f'processing {dayfile}')
     outpath = os.path.join(out, animal, day)
     targetfile = os.path.join(outpath, f'dffSNR_{animal}_{day}.hdf5')
+    chunkpath = os.path.join(outpath, f'dffSNR_{animal}_{day}_chunks')
     if os.path.exists(targetfile):
         print(f'{animal} {day} already done, skipping...')
+        return
     with h5py.File(dayfile, 'r') as session:
         if not os.path.exists(outpath):
             os.makedirs(outpath)
@@ -986,19 +1455,20 @@ def dff_SNR_single_session(folder, animal, day, out):
         Nneur = dff.shape[0]
         T = dff.shape[1]
         frame = np.arange(T)
-        SNRs = np.empty(Nneur, dtype=np.float64)
+        traces = np.empty((Nneur, T), dtype=np.float64)
         for i in range(Nneur):
             data = dff[i, :]
             sclean = ~np.isnan(data)
             if sum(sclean) != T:
                 f = interpolate.interp1d(frame[sclean], data[sclean], fill_value='extrapolate')
-                trace = f(frame)
+                traces[i] = f(frame)
             else:
-                trace = data
-            SNRs[i] = caiman_SNR(frame, trace)
+                traces[i] = data
+        SNRs = caiman_SNR_batch(frame, traces, nproc=nproc, chunk_size=chunk_size, out=chunkpath)
         try:
             with h5py.File(targetfile, 'w-') as osnr:
                 osnr['SNR_ens'] = np.around(SNRs, 4)
+            shutil.rmtree(chunkpath)
         except IOError:
             print(" OOPS!: The file already existed please try with another file, "
                   "new results will NOT be saved")
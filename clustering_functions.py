@@ -5,6 +5,7 @@ import pdb
 import community
 #from networkx.algorithms import community
 import networkx as nx
+import scipy.sparse
 import markov_clustering as mc
 from sklearn.cluster import KMeans, AgglomerativeClustering
 from sklearn.cluster import DBSCAN
@@ -23,7 +24,11 @@ def agglomerative_clustering_elbow_plot(mat):
         MAT: The (neurons x frames) calcium activity matrix
     """
 
-    z = hac.linkage(mat, method='average', metric=normalized_cc)
+    # Condensed matrix of normalized_cc over all pairs i < j, as pdist
+    # would compute it
+    cc_mat = normalized_cc_mat(mat)
+    z = hac.linkage(cc_mat[np.triu_indices(cc_mat.shape[0], 1)],
+        method='average')
     plt.figure()
     plt.plot(range(1, len(z)+1), z[::-1,2])
     plt.xlabel('k')
@@ -46,32 +51,53 @@ def agglomerative_clustering(mat):
         ).fit(mat)
     return clustering
 
-def community_louvain(distance_mat):
+def sparse_similarity_graph(distance_mat, k=None, threshold=None):
+    """
+    Returns DISTANCE_MAT as a scipy sparse matrix. Dense matrices are
+    sparsified with knn_graph if K or THRESHOLD is given; sparse matrices,
+    e.g. from lagged_cc_graph, are used as they are.
+    """
+    if scipy.sparse.issparse(distance_mat):
+        return distance_mat.tocsr()
+    if k is None and threshold is None:
+        return scipy.sparse.csr_matrix(distance_mat)
+    return knn_graph(np.asarray(distance_mat), k=k, threshold=threshold)
+
+def community_louvain(distance_mat, k=None, threshold=None):
     """
     Runs the Louvain community detection algorithm on the input distance matrix.
     Inputs:
         DISTANCE_MAT: A (neurons x neurons) numpy matrix calculated by some
-            distance metric.
+            distance metric, or a scipy sparse graph (see knn_graph).
+        K: An int; if given, only each neuron's K strongest edges are kept
+        THRESHOLD: A float; if given, only edges at least this strong are kept
     Output:
         PARTITION: A dictionary where the keys are zero-indexed, numbered
             communities, and the values are the array of vertices belonging in
             the community.
     """
 
-    G = nx.from_numpy_matrix(distance_mat)
+    graph = sparse_similarity_graph(distance_mat, k, threshold).tocoo()
+    # Only the kept edges become networkx objects
+    G = nx.Graph()
+    G.add_nodes_from(range(graph.shape[0]))
+    G.add_weighted_edges_from(zip(graph.row.tolist(), graph.col.tolist(),
+        graph.data.tolist()))
     partition = community.best_partition(G)
     return partition
 
-def markov_clustering(distance_mat, inflation):
+def markov_clustering(distance_mat, inflation, k=None, threshold=None):
     """
     Runs the Markov Clustering algorithm on the input distance matrix.
     Inputs:
         DISTANCE_MAT: A (neurons x neurons) numpy matrix calculated by some
-            distance metric.
+            distance metric, or a scipy sparse graph (see knn_graph).
         INFLATION: An int; the Hadamarde power to take during the inflation step.
             In general, values from 1.1 to 10.0 can be tried, with higher
             values generally resulting in more clusters. Inflation boosts the
             probabilities of intra-cluster walks and demotes inter-cluster walks.
+        K: An int; if given, only each neuron's K strongest edges are kept
+        THRESHOLD: A float; if given, only edges at least this strong are kept
     Outputs:
         CLUSTERS: A (neurons x neurons) numpy matrix of the final remaining
             clusters.
@@ -82,8 +108,7 @@ def markov_clustering(distance_mat, inflation):
             were randomly distributed.
     """
 
-    G = nx.from_numpy_matrix(distance_mat)
-    sparse_G = nx.to_scipy_sparse_matrix(G)
+    sparse_G = sparse_similarity_graph(distance_mat, k, threshold)
     result = mc.run_mcl(sparse_G, inflation=inflation)
     clusters = mc.get_clusters(result)
     Q = mc.modularity(matrix=result, clusters=clusters)
@@ -417,7 +417,7 @@ def analyze_raw_planes(folder, animal, day, num_files, num_files_b, number_plane
     print('... done') 
      
     
-def put_together(folder, animal, day, number_planes=4, number_planes_total=6, sec_var='', toplot=False, trial_time=30, tocut=False, len_experiment=30000, bmi2=False):       
+def put_together(folder, animal, day, number_planes=4, number_planes_total=6, sec_var='', toplot=False, trial_time=30, tocut=False, len_experiment=30000, bmi2=False, fill_method='previous', fill_limit=2):       
     """
     Function to put together the different hdf5 files obtain for each plane and convey all the information in one and only hdf5
     it requires somo files in the original folder
@@ -429,7 +429,9 @@ def put_together(folder, animal, day, number_planes=4, number_planes_total=6, se
     number_planes_total(int): number of planes given back by the recording system, it may differ from number_planes
     to provide time for the objective to return to origen
     sec_var(str): secondary variable to save file. For extra information
-    toplot(bool): to allow plotting/saving of some results"""
+    toplot(bool): to allow plotting/saving of some results
+    fill_method(str): policy to fill the nan gaps of the frequency, cursor and online data (see fill_nans)
+    fill_limit(int): maximum number of consecutive nans filled after each value"""
     
     # Folder to load/save
     folder_path = folder + 'raw/' + animal + '/' + day + '/'
@@ -540,6 +542,11 @@ def put_together(folder, animal, day, number_planes=4, number_planes_total=6, se
         vars.len_bmi += np.round(last_frame/number_planes_total).astype(int)
     else:
         online_data = pd.read_csv(folder_path + matinfo['fcsv'][0])
+
+    # gaps in the cursor and ensemble activity are filled once, for every use below
+    cursor = fill_nans(matinfo['cursor'][0], fill_method, fill_limit)
+    ens_keys = online_data.keys()[2:]
+    online_data[ens_keys] = fill_nans(online_data[ens_keys].to_numpy(), fill_method, fill_limit)
         
     try:
         mask = matinfo['allmask']
@@ -571,12 +578,10 @@ def put_together(folder, animal, day, number_planes=4, number_planes_total=6, se
     
     # obtain the frequency
     try:
-        frequency = obtainfreq(matinfo['frequency'][0], vars.len_bmi)
+        frequency = obtainfreq(matinfo['frequency'][0], vars.len_bmi, fill_limit, fill_method)
     except KeyError:
         frequency = np.nan
     
-    cursor = matinfo['cursor'][0]
-    
     # finding the correct E2 neurons
     e2_neur = get_best_e2_combo(ens_neur, online_data, cursor, trial_start, trial_end, vars.len_base)
     
@@ -1147,22 +1152,59 @@ def calculate_zvalues(folder, plane):
     return z
 
 
-def obtainfreq(origfreq, len_bmi=36000, iterat=2):
+def fill_nans(data, method='previous', limit=None, axis=0, leading=None):
+    """ Function to fill the NaN gaps of a signal without looping over samples
+    data(array): signal(s), with time along axis
+    method(str): 'previous' repeats the last valid value, 'linear' interpolates between the valid values
+    around the gap and 'nearest' takes the closest of them (the previous one on ties). After the last valid
+    value all of them repeat it
+    limit(int): only the first LIMIT samples after each valid value are filled, None for all
+    axis(int): time axis
+    leading: value for the samples before the first valid value, None to leave them as nan
+    returns
+    filled(array): float copy of data with the gaps filled"""
+    filled = np.moveaxis(np.array(data, dtype=np.float64), axis, -1)
+    shape = filled.shape
+    filled = filled.reshape((-1, shape[-1]))
+    T = filled.shape[1]
+    t = np.arange(T)
+    valid = ~np.isnan(filled)
+    # index of the last valid sample up to each sample (-1 if none) and of the next one (T if none)
+    last = np.maximum.accumulate(np.where(valid, t, -1), axis=1)
+    nxt = np.minimum.accumulate(np.where(valid, t, T)[:, ::-1], axis=1)[:, ::-1]
+    prev_vals = np.take_along_axis(filled, np.maximum(last, 0), axis=1)
+    next_vals = np.take_along_axis(filled, np.minimum(nxt, T - 1), axis=1)
+    has_next = nxt < T
+    if method == 'previous':
+        vals = prev_vals
+    elif method == 'nearest':
+        vals = np.where(has_next & (nxt - t < t - last), next_vals, prev_vals)
+    elif method == 'linear':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vals = np.where(has_next, prev_vals + (next_vals - prev_vals) * (t - last) / (nxt - last), prev_vals)
+    else:
+        raise ValueError("Unknown fill method: {}".format(method))
+    fill = ~valid & (last >= 0)
+    if limit is not None:
+        fill &= (t - last) <= limit
+    filled[fill] = vals[fill]
+    if leading is not None:
+        filled[last < 0] = leading
+    return np.moveaxis(filled.reshape(shape), -1, axis)
+
+
+def obtainfreq(origfreq, len_bmi=36000, iterat=2, method='previous'):
     """ Function to remove NANs from the frequency vector. First values will be 0
     origfreq(array): vector of original frequency recorded, full of nans
     len_bmi(int): lenght of the recording bmi
-    iterat(int): maximum number of iterations to find consecutive nans
+    iterat(int): maximum number of consecutive nans filled after each value
+    method(str): fill policy, see fill_nans
     returns
     freq(array): vector of frequencies without nans. Nans before the experiment are changed as 0,
     nans during the experiment are change to the previous frequency value"""
-    freq = copy.deepcopy(origfreq)
-    freq[:np.where(~np.isnan(origfreq))[0][0]] = 0
+    freq = np.asarray(origfreq)
     if len_bmi<freq.shape[0]: freq = freq[:len_bmi]
-    for it in np.arange(iterat):
-        nanarray = np.where(np.isnan(freq))[0]
-        for inan in nanarray[-1::-1]:
-            freq[inan] = freq[inan-1]
-    return freq
+    return fill_nans(freq, method=method, limit=iterat, leading=0)
 
 
 def plot_Cs(fanal, C, nerden):
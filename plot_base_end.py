@@ -45,12 +45,10 @@ def count_experiments():
         num_expend = 0
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            baseline_path = day_path + 'baseline.p'
-            expend_path = day_path + 'experiment_end.p'
-            if os.path.isfile(baseline_path):
+            if load_gte_results(day_path, 'baseline') is not None:
                 num_baseline += 1
                 include_animal = True
-            if os.path.isfile(expend_path):
+            if load_gte_results(day_path, 'experiment_end') is not None:
                 num_expend += 1
                 include_animal = True
         if include_animal:
@@ -90,32 +88,25 @@ def plot_learning():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            baseline_path = day_path + 'baseline.p'
-            expend_path = day_path + 'experiment_end.p'
-            if not isfile(baseline_path) or not isfile(expend_path):
+            baseline = load_gte_results(day_path, 'baseline')
+            expend = load_gte_results(day_path, 'experiment_end')
+            if baseline is None or expend is None:
                 continue
-            with open(baseline_path, 'rb') as f:
-                baseline = pickle.load(f)[0]
-            with open(expend_path, 'rb') as f:
-                expend = pickle.load(f)[0]
-            baseline = [val for val in baseline.flatten() if not np.isnan(val)]
-            expend = [val for val in expend.flatten() if not np.isnan(val)]
+            baseline, expend = baseline[0], expend[0]
+            baseline = baseline[~np.isnan(baseline)]
+            expend = expend[~np.isnan(expend)]
             try:
                 _, _, reg = learning_params('./', animal_dir, day_dir, bin_size=5)
             except: # In case another process is already accessing this file
                 continue
             slope = reg.coef_[0]
             if slope < 0.2:
-                for val in baseline:
-                    non_learning_baseline.handle(val)
-                for val in expend:
-                    non_learning_expend.handle(val)
+                non_learning_baseline.handle(baseline)
+                non_learning_expend.handle(expend)
                 num_non_learning += 1
             if slope > 0.4:
-                for val in baseline:
-                    learning_baseline.handle(val)
-                for val in expend:
-                    learning_expend.handle(val)
+                learning_baseline.handle(baseline)
+                learning_expend.handle(expend)
                 num_learning += 1
     means = [
         learning_baseline.mean(), learning_expend.mean(),
@@ -161,27 +152,20 @@ def plot_ITPT():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            baseline_path = day_path + 'baseline.p'
-            expend_path = day_path + 'experiment_end.p'
-            if not isfile(baseline_path) or not isfile(expend_path):
+            baseline = load_gte_results(day_path, 'baseline')
+            expend = load_gte_results(day_path, 'experiment_end')
+            if baseline is None or expend is None:
                 continue
-            with open(baseline_path, 'rb') as f:
-                baseline = pickle.load(f)[0]
-            with open(expend_path, 'rb') as f:
-                expend = pickle.load(f)[0]
-            baseline = [val for val in baseline.flatten() if not np.isnan(val)]
-            expend = [val for val in expend.flatten() if not np.isnan(val)]
+            baseline, expend = baseline[0], expend[0]
+            baseline = baseline[~np.isnan(baseline)]
+            expend = expend[~np.isnan(expend)]
             if animal_dir.startswith('PT'):
-                for val in baseline:
-                    PT_baseline.handle(val)
-                for val in expend:
-                    PT_expend.handle(val)
+                PT_baseline.handle(baseline)
+                PT_expend.handle(expend)
                 num_pt += 1
             if animal_dir.startswith('IT'):
-                for val in baseline:
-                    IT_baseline.handle(val)
-                for val in expend:
-                    IT_expend.handle(val)
+                IT_baseline.handle(baseline)
+                IT_expend.handle(expend)
                 num_it += 1
     means = [
         IT_baseline.mean(), IT_expend.mean(),
@@ -234,14 +218,11 @@ def plot_E2_learning():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            baseline_path = day_path + 'baseline.p'
-            expend_path = day_path + 'experiment_end.p'
-            if not isfile(baseline_path) or not isfile(expend_path):
+            baseline = load_gte_results(day_path, 'baseline')
+            expend = load_gte_results(day_path, 'experiment_end')
+            if baseline is None or expend is None:
                 continue
-            with open(baseline_path, 'rb') as f:
-                baseline = pickle.load(f)[0]
-            with open(expend_path, 'rb') as f:
-                expend = pickle.load(f)[0]
+            baseline, expend = baseline[0], expend[0]
             num_neurons = baseline.shape[0]
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
@@ -343,14 +324,11 @@ def plot_E2_ITPT():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            baseline_path = day_path + 'baseline.p'
-            expend_path = day_path + 'experiment_end.p'
-            if not isfile(baseline_path) or not isfile(expend_path):
+            baseline = load_gte_results(day_path, 'baseline')
+            expend = load_gte_results(day_path, 'experiment_end')
+            if baseline is None or expend is None:
                 continue
-            with open(baseline_path, 'rb') as f:
-                baseline = pickle.load(f)[0]
-            with open(expend_path, 'rb') as f:
-                expend = pickle.load(f)[0]
+            baseline, expend = baseline[0], expend[0]
             num_neurons = baseline.shape[0]
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
@@ -453,29 +453,22 @@ def analyze_feature_selection(rfecv_accuracy_threshold=.7):
             day_path = animal_path + day + '/'
             if not os.path.isdir(day_path):
                 continue
-            path_to_models = './processed/' + animal + '/' + day + '/rfecv_model.p'
             try:
-                with open(path_to_models, 'rb') as f:
-                    rfecv_models = pickle.load(f)
+                rfecv_results = load_feature_selection(day_path)
                 f = h5py.File(
                     day_path + "full_" + animal + "_" + day + "__data.hdf5"
                     )
             except:
                 continue
+            if rfecv_results is None:
+                continue
 
-            # This is a boolean mask over neurons/dendrites considered significant
-            selected_features = np.zeros(
-                rfecv_models[0].support_.size
-                ).astype('bool')
-
-            # For one experiment, we iterate over each time-shifted RFECV model
-            for rfecv_model in rfecv_models:
-                # We collect the results of RFECV models that exceeded some
-                # accuracy threshold
-                if max(rfecv_model.grid_scores_) > rfecv_accuracy_threshold:
-                    selected_features = np.logical_or(
-                        rfecv_model.support_, selected_features 
-                    )
+            # This is a boolean mask over neurons/dendrites considered
+            # significant: those supported in any time-shifted RFECV fit that
+            # exceeded some accuracy threshold
+            selected_features = rfecv_selected(
+                rfecv_results, rfecv_accuracy_threshold
+                )
 
 
             # Now, we extract the depth information of selected_features.
@@ -579,15 +572,15 @@ def plot_rfecv_thresholds():
             day_path = animal_path + day + '/'
             if not os.path.isdir(day_path):
                 continue
-            path_to_models = './processed/' + animal + '/' + day + '/rfecv_model.p'
             try:
-                with open(path_to_models, 'rb') as f:
-                    rfecv_models = pickle.load(f)
+                rfecv_models = load_feature_selection(day_path)
                 f = h5py.File(
                     day_path + "full_" + animal + "_" + day + "__data.hdf5"
                     )
             except:
                 continue
+            if rfecv_models is None:
+                continue
             if animal.startswith('IT'):
                 IT_rfecv_models.append(rfecv_models)
                 IT_experiment_files.append(f)
@@ -609,10 +602,7 @@ def plot_rfecv_thresholds():
         # over all experiments?
         for index, experiment_models in enumerate(IT_rfecv_models):
             exp_file = IT_experiment_files[index]
-            neur = np.zeros(experiment_models[0].support_.size).astype('bool')
-            for rfecv_model in experiment_models: # Iterates over time shifts
-                if max(rfecv_model.grid_scores_) > score_min:
-                    neur = np.logical_or(rfecv_model.support_, neur)
+            neur = rfecv_selected(experiment_models, score_min) # Over time shifts
             redlabel = np.array(exp_file['redlabel'])
             neur = np.logical_and(redlabel, neur)
             IT_num_neur += np.sum(neur)
@@ -626,10 +616,7 @@ def plot_rfecv_thresholds():
         PT_total_neurs = 0
         for index, experiment_models in enumerate(PT_rfecv_models):
             exp_file = PT_experiment_files[index]
-            neur = np.zeros(experiment_models[0].support_.size).astype('bool')
-            for rfecv_model in experiment_models: # Iterates over time shifts
-                if max(rfecv_model.grid_scores_) > score_min:
-                    neur = np.logical_or(rfecv_model.support_, neur)
+            neur = rfecv_selected(experiment_models, score_min) # Over time shifts
             redlabel = np.array(exp_file['redlabel'])
             neur = np.logical_and(redlabel, neur)
             PT_num_neur += np.sum(neur)
@@ -20,6 +20,7 @@ from utils_cabmi import *
 from plotting_functions import *
 from analysis_functions import *
 from utils_gte import *
+from utils_connectivity import *
 from utils_clustering import *
 
 def count_experiments():
@@ -44,11 +45,9 @@ def count_experiments():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             num_reward_trials += len(reward_end)
             include_animal = True
             num_experiments += 1
@@ -89,36 +88,22 @@ def plot_earlylate_ITPT():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             total_num_rewards = len(reward_end)
             num_rewards = total_num_rewards//3 # Process first and last third
             early = reward_end[:num_rewards]
             late = reward_end[-num_rewards:]
-            early = [m.flatten().tolist() for m in early]
-            late = [m.flatten().tolist() for m in late]
-            early = [
-                val for sublist in early for val in sublist\
-                if not np.isnan(val)
-                ]
-            late = [
-                val for sublist in late for val in sublist\
-                if not np.isnan(val)
-                ]
+            early = early[~np.isnan(early)]
+            late = late[~np.isnan(late)]
 
             if animal_dir.startswith('IT'):
-                for val in early:
-                    early_it.handle(val)
-                for val in late:
-                    late_it.handle(val)
+                early_it.handle(early)
+                late_it.handle(late)
             else:
-                for val in early:
-                    early_pt.handle(val)
-                for val in late:
-                    late_pt.handle(val)
+                early_pt.handle(early)
+                late_pt.handle(late)
     means = [early_it.mean(), late_it.mean(), early_pt.mean(), late_pt.mean()]
     stds = [early_it.std(), late_it.std(), early_pt.std(), late_pt.std()]
     fig, ax = plt.subplots(1, 1, figsize=(8,5))
@@ -153,23 +138,15 @@ def plot_ITPT():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
-            reward_end = [m.flatten().tolist() for m in reward_end]
-            reward_end = [
-                val for sublist in reward_end for val in sublist\
-                if not np.isnan(val)
-                ]
+            reward_end = reward_end[~np.isnan(reward_end)]
             if animal_dir.startswith('IT'):
-                for val in reward_end:
-                    it.handle(val)
+                it.handle(reward_end)
                 num_it_exp += 1
             else:
-                for val in reward_end:
-                    pt.handle(val)
+                pt.handle(reward_end)
                 num_pt_exp += 1
     means = [it.mean(), pt.mean()]
     stds = [it.std(), pt.std()]
@@ -202,11 +179,9 @@ def plot_IT_redgreen():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
                     '__data.hdf5')
@@ -216,11 +191,9 @@ def plot_IT_redgreen():
             redlabel = np.array(f['redlabel'])
             redlabel = redlabel[nerden]
             redlabel = redlabel.astype(int) # Group 1 is red, Group 0 is green
-            reward_end_rg = [\
-                group_result(m, redlabel, ignore_diagonal=False)\
-                for m in reward_end
-                ] 
-            results += reward_end_rg
+            _, _, reward_end_rg = group_summary(reward_end, redlabel,
+                groups=[0, 1])
+            results += list(reward_end_rg)
     results_means = np.nanmean(results, axis=0)
     results_stds = np.nanstd(results, axis=0)
     results_means = results_means.flatten()
@@ -252,11 +225,9 @@ def plot_PT_redgreen():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
                     '__data.hdf5')
@@ -266,11 +237,9 @@ def plot_PT_redgreen():
             redlabel = np.array(f['redlabel'])
             redlabel = redlabel[nerden]
             redlabel = redlabel.astype(int) # Group 1 is red, Group 0 is green
-            reward_end_rg = [\
-                group_result(m, redlabel, ignore_diagonal=False)\
-                for m in reward_end
-                ] 
-            results += reward_end_rg
+            _, _, reward_end_rg = group_summary(reward_end, redlabel,
+                groups=[0, 1])
+            results += list(reward_end_rg)
     results_means = np.nanmean(results, axis=0)
     results_stds = np.nanstd(results, axis=0)
     results_means = results_means.flatten()
@@ -303,11 +272,9 @@ def plot_IT_e2earlylate():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             num_neurons = reward_end[0].shape[0]
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
@@ -324,11 +291,9 @@ def plot_IT_e2earlylate():
             e2_neur = np.where(e2_mask==1)
             grouping = np.zeros(num_neurons)
             grouping[e2_neur] = 1
-            reward_end_e2 = [\
-                group_result(m, grouping, ignore_diagonal=False)\
-                for m in reward_end
-                ] 
-            results += reward_end_e2
+            _, _, reward_end_e2 = group_summary(reward_end, grouping,
+                groups=[0, 1])
+            results += list(reward_end_e2)
     results_means = np.nanmean(results, axis=0)
     results_stds = np.nanstd(results, axis=0)
     results_means = results_means.flatten()
@@ -361,11 +326,9 @@ def plot_PT_e2earlylate():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             num_neurons = reward_end[0].shape[0]
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
@@ -382,11 +345,9 @@ def plot_PT_e2earlylate():
             e2_neur = np.where(e2_mask==1)
             grouping = np.zeros(num_neurons)
             grouping[e2_neur] = 1
-            reward_end_e2 = [\
-                group_result(m, grouping, ignore_diagonal=False)\
-                for m in reward_end
-                ] 
-            results += reward_end_e2
+            _, _, reward_end_e2 = group_summary(reward_end, grouping,
+                groups=[0, 1])
+            results += list(reward_end_e2)
     results_means = np.nanmean(results, axis=0)
     results_stds = np.nanstd(results, axis=0)
     results_means = results_means.flatten()
@@ -414,10 +375,8 @@ def plot_PT_depth():
     max_depth = 700
     num_depths = max_depth - min_depth + 1
     num_exp = 0
-    depth_mat = [
-        [OnlineNormalEstimator() for _ in range(num_depths)]\
-        for _ in range(num_depths)
-        ]
+    # One estimate per (source depth, target depth) pair
+    depth_mat = OnlineNormalEstimator()
     processed_dir = './processed/'
 
     for animal_dir in os.listdir(processed_dir):
@@ -426,11 +385,9 @@ def plot_PT_depth():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
                     '__data.hdf5')
@@ -441,23 +398,16 @@ def plot_PT_depth():
             depth_location = np.array(f['com_cm'])[:,2]
             depth_location = depth_location[nerden]
             num_neurons = reward_end[0].shape[0]
-            for mat in reward_end:
-                for neuron1 in range(num_neurons):
-                    for neuron2 in range(num_neurons):
-                        if neuron1 == neuron2:
-                            continue
-                        depth1 = int(depth_location[neuron1])
-                        depth2 = int(depth_location[neuron2])
-                        depth1 = min(max(depth1, min_depth), max_depth)
-                        depth2 = min(max(depth2, min_depth), max_depth)
-                        val = mat[neuron1, neuron2]
-                        if np.isnan(val):
-                            continue
-                        depth_mat[depth1-min_depth][depth2-min_depth].handle(val)
-    means = [[estimator.mean() for estimator in row] for row in depth_mat]
-    means = np.array(means)
-    stds = [[estimator.std() for estimator in row] for row in depth_mat]
-    stds = np.array(stds)
+            depth = np.clip(depth_location.astype(int), min_depth, max_depth)
+            depth_pair = (depth[:,np.newaxis] - min_depth)*num_depths + \
+                (depth[np.newaxis,:] - min_depth)
+            reward_end = np.array(reward_end)
+            reward_end[:, np.arange(num_neurons), np.arange(num_neurons)] = \
+                np.nan # Skip self-connections
+            depth_mat.handle_grouped(reward_end,
+                np.broadcast_to(depth_pair, reward_end.shape), num_depths**2)
+    means = np.reshape(depth_mat.mean(), (num_depths, num_depths))
+    stds = np.reshape(depth_mat.std(), (num_depths, num_depths))
     fig, ax = plt.subplots(1, 1, figsize=(8,8))
     im = ax.imshow(means)
     ax.figure.colorbar(im, ax=ax)
@@ -488,10 +438,8 @@ def plot_shallowIT_depth():
     num_depths = max_depth - min_depth + 1
     num_exp = 0
     E2_depth_thresh = 300
-    depth_mat = [
-        [OnlineNormalEstimator() for _ in range(num_depths)]\
-        for _ in range(num_depths)
-        ]
+    # One estimate per (source depth, target depth) pair
+    depth_mat = OnlineNormalEstimator()
     processed_dir = './processed/'
 
     for animal_dir in os.listdir(processed_dir):
@@ -500,11 +448,9 @@ def plot_shallowIT_depth():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
                     '__data.hdf5')
@@ -520,23 +466,16 @@ def plot_shallowIT_depth():
                 continue
             depth_location = depth_location[nerden]
             num_neurons = reward_end[0].shape[0]
-            for mat in reward_end:
-                for neuron1 in range(num_neurons):
-                    for neuron2 in range(num_neurons):
-                        if neuron1 == neuron2:
-                            continue
-                        depth1 = int(depth_location[neuron1])
-                        depth2 = int(depth_location[neuron2])
-                        depth1 = min(max(depth1, min_depth), max_depth)
-                        depth2 = min(max(depth2, min_depth), max_depth)
-                        val = mat[neuron1, neuron2]
-                        if np.isnan(val):
-                            continue
-                        depth_mat[depth1-min_depth][depth2-min_depth].handle(val)
-    means = [[estimator.mean() for estimator in row] for row in depth_mat]
-    means = np.array(means)
-    stds = [[estimator.std() for estimator in row] for row in depth_mat]
-    stds = np.array(stds)
+            depth = np.clip(depth_location.astype(int), min_depth, max_depth)
+            depth_pair = (depth[:,np.newaxis] - min_depth)*num_depths + \
+                (depth[np.newaxis,:] - min_depth)
+            reward_end = np.array(reward_end)
+            reward_end[:, np.arange(num_neurons), np.arange(num_neurons)] = \
+                np.nan # Skip self-connections
+            depth_mat.handle_grouped(reward_end,
+                np.broadcast_to(depth_pair, reward_end.shape), num_depths**2)
+    means = np.reshape(depth_mat.mean(), (num_depths, num_depths))
+    stds = np.reshape(depth_mat.std(), (num_depths, num_depths))
     fig, ax = plt.subplots(1, 1, figsize=(8,8))
     im = ax.imshow(means)
     ax.figure.colorbar(im, ax=ax)
@@ -569,10 +508,8 @@ def plot_deepIT_depth():
     num_depths = max_depth - min_depth + 1
     num_exp = 0
     E2_depth_thresh = 300
-    depth_mat = [
-        [OnlineNormalEstimator() for _ in range(num_depths)]\
-        for _ in range(num_depths)
-        ]
+    # One estimate per (source depth, target depth) pair
+    depth_mat = OnlineNormalEstimator()
     processed_dir = './processed/'
 
     for animal_dir in os.listdir(processed_dir):
@@ -581,11 +518,9 @@ def plot_deepIT_depth():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
             try:
                 f = h5py.File(day_path + 'full_' + animal_dir + '_' + day_dir +\
                     '__data.hdf5')
@@ -601,23 +536,16 @@ def plot_deepIT_depth():
                 continue
             depth_location = depth_location[nerden]
             num_neurons = reward_end[0].shape[0]
-            for mat in reward_end:
-                for neuron1 in range(num_neurons):
-                    for neuron2 in range(num_neurons):
-                        if neuron1 == neuron2:
-                            continue
-                        depth1 = int(depth_location[neuron1])
-                        depth2 = int(depth_location[neuron2])
-                        depth1 = min(max(depth1, min_depth), max_depth)
-                        depth2 = min(max(depth2, min_depth), max_depth)
-                        val = mat[neuron1, neuron2]
-                        if np.isnan(val):
-                            continue
-                        depth_mat[depth1-min_depth][depth2-min_depth].handle(val)
-    means = [[estimator.mean() for estimator in row] for row in depth_mat]
-    means = np.array(means)
-    stds = [[estimator.std() for estimator in row] for row in depth_mat]
-    stds = np.array(stds)
+            depth = np.clip(depth_location.astype(int), min_depth, max_depth)
+            depth_pair = (depth[:,np.newaxis] - min_depth)*num_depths + \
+                (depth[np.newaxis,:] - min_depth)
+            reward_end = np.array(reward_end)
+            reward_end[:, np.arange(num_neurons), np.arange(num_neurons)] = \
+                np.nan # Skip self-connections
+            depth_mat.handle_grouped(reward_end,
+                np.broadcast_to(depth_pair, reward_end.shape), num_depths**2)
+    means = np.reshape(depth_mat.mean(), (num_depths, num_depths))
+    stds = np.reshape(depth_mat.std(), (num_depths, num_depths))
     fig, ax = plt.subplots(1, 1, figsize=(8,8))
     im = ax.imshow(means)
     ax.figure.colorbar(im, ax=ax)
@@ -658,16 +586,10 @@ def plot_learning():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
-            reward_end = [m.flatten().tolist() for m in reward_end]
-            reward_end = [
-                val for sublist in reward_end for val in sublist\
-                if not np.isnan(val)
-                ]
+            reward_end = reward_end[~np.isnan(reward_end)]
             try:
                 _, _, reg = learning_params(
                     './', animal_dir, day_dir, bin_size=5
@@ -676,12 +598,10 @@ def plot_learning():
                 continue
             slope = reg.coef_[0]
             if slope < 0.2:
-                for val in reward_end:
-                    non_learning.handle(val)
+                non_learning.handle(reward_end)
                 num_non_learning += 1
             if slope > 0.4:
-                for val in reward_end:
-                    learning.handle(val)
+                learning.handle(reward_end)
                 num_learning += 1
     means = [learning.mean(), non_learning.mean()]
     stds = [learning.std(), non_learning.std()]
@@ -724,16 +644,10 @@ def plot_itpt_learning():
             continue
         for day_dir in os.listdir(animal_path):
             day_path = animal_path + day_dir + '/'
-            reward_end_path = day_path + 'reward_end.p'
-            if not os.path.isfile(reward_end_path):
+            reward_end = load_gte_results(day_path, 'reward_end')
+            if reward_end is None:
                 continue
-            with open(reward_end_path, 'rb') as f:
-                reward_end = pickle.load(f)
-            reward_end = [m.flatten().tolist() for m in reward_end]
-            reward_end = [
-                val for sublist in reward_end for val in sublist\
-                if not np.isnan(val)
-                ]
+            reward_end = reward_end[~np.isnan(reward_end)]
             try:
                 _, _, reg = learning_params(
                     './', animal_dir, day_dir, bin_size=5
@@ -743,21 +657,17 @@ def plot_itpt_learning():
             slope = reg.coef_[0]
             if slope < 0.2:
                 if animal_dir.startswith('IT'):
-                    for val in reward_end:
-                        it_non_learning.handle(val)
+                    it_non_learning.handle(reward_end)
                     num_it_non_learning += 1
                 else:
-                    for val in reward_end:
-                        pt_non_learning.handle(val)
+                    pt_non_learning.handle(reward_end)
                     num_pt_non_learning += 1
             if slope > 0.4:
                 if animal_dir.startswith('IT'):
-                    for val in reward_end:
-                        it_learning.handle(val)
+                    it_learning.handle(reward_end)
                     num_it_learning += 1
                 else:
-                    for val in reward_end:
-                        pt_learning.handle(val)
+                    pt_learning.handle(reward_end)
                     num_pt_learning += 1
     means = [
         it_learning.mean(), it_non_learning.mean(),
@@ -47,7 +47,8 @@ def plot_trial_end_all(folder, animal, day,
         sec_var + '_data.hdf5', 'r')
 
     t_size = [50,30] # 50 frames before and 30 frames after trial end
-    time_lock_data = time_lock_activity(f, t_size=t_size)
+    time_lock_data = time_lock_activity(f, t_size=t_size,
+        cache_dir=folder + 'time_lock_cache/')
     time_lock_data = time_lock_data[:,np.array(f['nerden']),:]
     if trial_type == 1:
         array_t1 = np.array(f['array_t1'])
@@ -111,7 +112,8 @@ def plot_trial_end_ens(folder, animal, day,
         sec_var + '_data.hdf5', 'r'
         )
     t_size = [30,5]
-    time_lock_data = time_lock_activity(f, t_size=t_size)
+    time_lock_data = time_lock_activity(f, t_size=t_size,
+        cache_dir=folder + 'time_lock_cache/')
     if trial_type == 1:
         array_t1 = np.array(f['array_t1'])
         time_lock_data = time_lock_data[array_t1,:,:]
@@ -178,7 +180,8 @@ def plot_avg_trial_end_ens(folder, animal, day,
         )
 
     t_size = [10,10]
-    time_lock_data = time_lock_activity(f, t_size=t_size)
+    time_lock_data = time_lock_activity(f, t_size=t_size,
+        cache_dir=folder + 'time_lock_cache/')
     if trial_type == 1:
         array_t1 = np.array(f['array_t1'])
         time_lock_data = time_lock_data[array_t1,:,:]
@@ -271,7 +274,8 @@ def plot_zscore_rewards(folder, animal, day, sec_var=''):
         sec_var + '_data.hdf5', 'r'
         )
     t_size = [300,0]
-    time_lock_data = time_lock_activity(f, t_size=t_size)
+    time_lock_data = time_lock_activity(f, t_size=t_size,
+        cache_dir=folder + 'time_lock_cache/')
     time_lock_data = time_lock_data[:,np.array(f['nerden']),:]
     array_t1 = np.array(f['array_t1'])
     time_lock_data = time_lock_data[array_t1,:,:]
@@ -322,7 +326,8 @@ def plot_reward_histograms(folder, animal, day, sec_var=''):
         sec_var + '_data.hdf5', 'r'
         )
     t_size = [300,0]
-    time_lock_data = time_lock_activity(f, t_size=t_size)
+    time_lock_data = time_lock_activity(f, t_size=t_size,
+        cache_dir=folder + 'time_lock_cache/')
     time_lock_data = time_lock_data[:,np.array(f['nerden']),:]
     array_t1 = np.array(f['array_t1'])
     time_lock_data = time_lock_data[array_t1,:,:]
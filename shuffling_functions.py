@@ -63,25 +63,183 @@ def shuffle_peaks(data_array, sf, ef, ipi_proc, axis=0):
 def shuffle_peaks_1d(data_array, ipi_proc, perc=50, debug=False):
     data_array = data_array[~np.isnan(data_array)]
     if debug:
-        peak_regions, IPIs = signal_partition(data_array, perc, debug)
-    else:
         peak_regions, IPIs, points = signal_partition(data_array, perc, debug)
-    IPI = np.concatenate(IPIs)
-    np.random.shuffle(peak_regions)
-    newIPI = ipi_proc(IPI)
-    #IPI_old = np.concatenate(IPI)
-    s_inds = np.sort(np.random.choice(len(IPI)+1, len(peak_regions)))
-    shuffled = np.empty(0)
-    cursor = 0
-    for i, s in enumerate(s_inds):
-        p_start, p_end = peak_regions[i]
-        shuffled = np.concatenate((shuffled, newIPI[cursor:s],
-                                   data_array[p_start:p_end]))
-        cursor = s
+    else:
+        peak_regions, IPIs = signal_partition(data_array, perc, debug)
+    shuffled = shuffle_peaks_batch(data_array, peak_regions, 1, ipi_proc,
+                                   rng=np.random)[0]
     if debug:
-        return np.concatenate((shuffled, newIPI[cursor:])), points
+        return shuffled, points
+    else:
+        return shuffled
+
+
+def surrogate_streams(seed, n_streams):
+    """
+    Spawns independent, reproducible random generators, one per fixed
+    chunk of surrogates in shuffle_peaks_1d_batch. Streams depend only on
+    SEED and N_STREAMS, not on the worker a chunk runs in.
+    Input:
+        seed: int or None
+            root entropy for the streams
+        n_streams: int
+            number of generators to spawn
+    Returns:
+        rngs: list of np.random.Generator
+    """
+    children = np.random.SeedSequence(seed).spawn(n_streams)
+    return [np.random.default_rng(c) for c in children]
+
+
+def partition_indices(peak_regions, T):
+    """
+    Converts a partition into index arrays usable for gathering.
+    Input:
+        peak_regions: array of tuples
+            peak regions denoted as (start, end), as returned by
+            signal_partition
+        T: int
+            length of the partitioned signal
+    Output:
+        starts: ndarray (P,)
+            start index of each peak region
+        lens: ndarray (P,)
+            length of each peak region
+        ipi_idx: ndarray (L,)
+            indices of all samples outside of peak regions, in order
+    """
+    pr = np.asarray(peak_regions, dtype=np.int64).reshape((-1, 2))
+    starts, lens = pr[:, 0], pr[:, 1] - pr[:, 0]
+    in_peak = np.zeros(T, dtype=bool)
+    if len(starts):
+        in_peak[_concat_ranges(starts, lens)] = True
+    return starts, lens, np.flatnonzero(~in_peak)
+
+
+def _concat_ranges(starts, lens):
+    """Equivalent to np.concatenate([np.arange(s, s+l) for s, l in ...])"""
+    lens = np.asarray(lens, dtype=np.int64)
+    offsets = np.cumsum(lens) - lens
+    return np.repeat(np.asarray(starts, dtype=np.int64) - offsets, lens) \
+        + np.arange(np.sum(lens))
+
+
+def shuffle_peaks_batch(data_array, peak_regions, K, ipi_proc=None,
+                        rng=None, out=None):
+    """
+    Generates K surrogates of a partitioned 1d signal at once. Each
+    surrogate randomly permutes the peak regions and reinserts them at
+    random sorted positions in the (optionally processed) IPI sequence, the
+    same procedure as shuffle_peaks_1d. Instead of concatenating region by
+    region, every surrogate is described by an index array into one source
+    array, and all K of them are filled with a single gather.
+    Input:
+        data_array: ndarray (T,)
+            signal without NaNs, the one that was partitioned
+        peak_regions: array of tuples
+            peak regions (start, end) from signal_partition
+        K: int
+            number of surrogates
+        ipi_proc: function or None
+            randomizing procedure applied to the concatenated IPI of every
+            surrogate; None keeps the IPI samples as they are
+        rng: np.random.Generator, RandomState or None
+            random source; see surrogate_streams for per-chunk streams
+        out: ndarray (K, T) or None
+            preallocated output buffer
+    Returns:
+        shuffled: ndarray (K, T)
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    data_array = np.asarray(data_array)
+    T = data_array.shape[0]
+    starts, lens, ipi_idx = partition_indices(peak_regions, T)
+    P, L = len(starts), len(ipi_idx)
+    if out is None:
+        out = np.empty((K, T), dtype=data_array.dtype)
+
+    # Source array: the signal itself, followed by K processed IPI copies
+    if ipi_proc is None:
+        src = data_array
+        ipi_src = np.broadcast_to(ipi_idx, (K, L))
+    else:
+        IPI = data_array[ipi_idx]
+        src = np.empty(T + K * L, dtype=data_array.dtype)
+        src[:T] = data_array
+        for k in range(K):
+            src[T + k * L:T + (k + 1) * L] = ipi_proc(IPI)
+        ipi_src = T + np.arange(K * L).reshape((K, L))
+
+    # Random peak order and sorted insertion points for all surrogates
+    perm = np.argsort(rng.random((K, P)), axis=1)
+    s_inds = np.sort(rng.choice(L + 1, (K, P)), axis=1)
+    lens_p = lens[perm]
+    cum_lens = np.zeros((K, P + 1), dtype=np.int64)
+    np.cumsum(lens_p, axis=1, out=cum_lens[:, 1:])
+
+    # IPI sample m lands after every region inserted at s <= m
+    n_before = np.zeros((K, L + 1), dtype=np.int64)
+    np.add.at(n_before, (np.repeat(np.arange(K), P), s_inds.ravel()), 1)
+    np.cumsum(n_before, axis=1, out=n_before)
+    ipi_pos = np.arange(L) + np.take_along_axis(cum_lens, n_before[:, :L],
+                                                axis=1)
+    is_ipi = np.zeros((K, T), dtype=bool)
+    np.put_along_axis(is_ipi, ipi_pos, True, axis=1)
+
+    gather = np.empty((K, T), dtype=np.int64)
+    gather[is_ipi] = ipi_src.ravel()
+    gather[~is_ipi] = _concat_ranges(starts[perm].ravel(), lens_p.ravel())
+    np.take(src, gather, out=out)
+    return out
+
+
+def _shuffle_peaks_worker(args):
+    data_array, peak_regions, K, ipi_proc, rng = args
+    return shuffle_peaks_batch(data_array, peak_regions, K, ipi_proc, rng=rng)
+
+
+def shuffle_peaks_1d_batch(data_array, K, ipi_proc=None, perc=50, seed=None,
+                           nproc=1, chunk_size=64):
+    """
+    Partitions data_array once and generates K shuffled surrogates from it.
+    Input:
+        data_array: ndarray (T,)
+            calcium signal, NaNs are dropped as in shuffle_peaks_1d
+        K: int
+            number of surrogates
+        ipi_proc: function or None
+            randomizing procedure for ipi data shuffling; must be picklable
+            when nproc > 1
+        perc: float
+            partition hyperparameter, see signal_partition
+        seed: int or None
+            root seed; the same seed and chunk_size give the same
+            surrogates for any nproc
+        nproc: int
+            number of worker processes the chunks are spread over
+        chunk_size: int
+            surrogates per random stream; surrogates are generated in
+            chunks of this size, each with its own stream
+    Returns:
+        shuffled: ndarray (K, T')
+            T' is the number of non-NaN samples in data_array
+    """
+    data_array = data_array[~np.isnan(data_array)]
+    peak_regions, _ = signal_partition(data_array, perc)
+    sizes = [min(chunk_size, K - k) for k in range(0, K, chunk_size)]
+    rngs = surrogate_streams(seed, len(sizes))
+    jobs = [(data_array, peak_regions, k, ipi_proc, rng)
+            for k, rng in zip(sizes, rngs)]
+    if not jobs:
+        return np.empty((0, data_array.shape[0]), dtype=data_array.dtype)
+    if nproc <= 1:
+        blocks = [_shuffle_peaks_worker(job) for job in jobs]
     else:
-        return np.concatenate((shuffled, newIPI[cursor:]))
+        import multiprocessing as mp
+        with mp.Pool(nproc) as p:
+            blocks = p.map(_shuffle_peaks_worker, jobs)
+    return np.concatenate(blocks, axis=0)
 
 
 def background_processing(data_array, perc, debug):
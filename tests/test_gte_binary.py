@@ -0,0 +1,91 @@
+import os
+import stat
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils_gte
+
+# Stands in for te-extended: logs each call, fails on a 'fail' line, hangs
+# on a 'hang' line and otherwise writes a size x size matrix counting from 0
+STUB = r"""#!/bin/sh
+echo "$1" >> "$(dirname "$1")/calls.log"
+grep -q '^fail' "$1" && exit 1
+grep -q '^hang' "$1" && exec sleep 5
+out=$(sed -n 's/^outputfile = "\(.*\)";$/\1/p' "$1")
+n=$(sed -n 's/^size = \(.*\);$/\1/p' "$1")
+awk -v n="$n" 'BEGIN { printf "{"; for (i = 0; i < n; i++) {
+    printf "%s{", (i ? ",\n " : ""); for (j = 0; j < n; j++)
+    printf "%s%d", (j ? ", " : ""), i * n + j; printf "}" } print "}" }' \
+    > "$out"
+"""
+
+
+@pytest.fixture
+def gte_files(tmp_path, monkeypatch):
+    stub = tmp_path / "te-extended"
+    stub.write_text(STUB)
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(utils_gte, "GTE_EXPERIMENTS_DIR",
+        str(tmp_path) + "/")
+    exp_data = np.random.default_rng(0).standard_normal((4, 3, 40))
+    files = utils_gte.create_gte_input_files("stub", exp_data, {})
+    return str(stub), files
+
+
+def mark(control_file_name, line):
+    with open(control_file_name, "a") as f:
+        f.write(line + ";\n")
+
+
+def calls(control_file_names):
+    log = os.path.join(os.path.dirname(control_file_names[0]), "calls.log")
+    with open(log) as f:
+        return f.read().split()
+
+
+def test_run_gte_results_in_input_order(gte_files):
+    stub, (control, exclude, output) = gte_files
+    results = utils_gte.run_gte(control, exclude, output, nproc=3,
+        executable=stub)
+    assert len(results) == 4
+    for result in results:
+        np.testing.assert_array_equal(result, np.arange(9).reshape((3, 3)))
+    assert sorted(calls(control)) == sorted(control)
+
+
+def test_failed_jobs_are_collected(gte_files):
+    stub, (control, exclude, output) = gte_files
+    mark(control[1], "fail = 1")
+    mark(control[3], "hang = 1")
+    results = dict(utils_gte.iter_gte(control, exclude, output, nproc=2,
+        timeout=0.5, executable=stub))
+    assert results[1] is None and results[3] is None
+    assert results[0] is not None and results[2] is not None
+    manifest = utils_gte.load_gte_manifest(
+        os.path.join(os.path.dirname(control[0]), "manifest.json"))
+    assert manifest[output[0]] == "done"
+    assert manifest[output[1]] == "exit code 1"
+    assert manifest[output[3]].startswith("timeout")
+    with pytest.raises(RuntimeError, match="2 of 4 jobs"):
+        utils_gte.run_gte(control, exclude, output, nproc=2, timeout=0.5,
+            executable=stub)
+
+
+def test_resume_only_reruns_unfinished_jobs(gte_files):
+    stub, (control, exclude, output) = gte_files
+    mark(control[2], "fail = 1")
+    with pytest.raises(RuntimeError):
+        utils_gte.run_gte(control, exclude, output, executable=stub)
+    # Fix the failing job and resume from the manifest
+    with open(control[2]) as f:
+        lines = [l for l in f if not l.startswith("fail")]
+    with open(control[2], "w") as f:
+        f.writelines(lines)
+    results = utils_gte.run_gte(control, exclude, output, executable=stub)
+    assert all(result is not None for result in results)
+    assert calls(control).count(control[2]) == 2
+    assert all(calls(control).count(c) == 1
+        for c in control if c != control[2])
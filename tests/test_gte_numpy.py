@@ -0,0 +1,67 @@
+import os
+import sys
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import utils_gte
+
+
+def binary_entropy(p):
+    return -p * np.log2(p) - (1 - p) * np.log2(1 - p)
+
+
+def plugin_te(source, target):
+    """Order-1 plug-in transfer entropy source -> target, from counts."""
+    triples = Counter(zip(target[1:], target[:-1], source[:-1]))
+    pairs = Counter(zip(target[1:], target[:-1]))
+    past_source = Counter(zip(target[:-1], source[:-1]))
+    past = Counter(target[:-1])
+    n = len(target) - 1
+    te = 0.0
+    for (future, prev, src), count in triples.items():
+        te += count / n * np.log2(count * past[prev] /
+            (past_source[(prev, src)] * pairs[(future, prev)]))
+    return te
+
+
+def test_discretize_ties_share_a_bin():
+    signal = np.array([[0, 0, 0, 0, 1, 2, 3, 4, 5, 0]])
+    binned = utils_gte.discretize_signal(signal, bins=3, auto_bins=True)
+    np.testing.assert_array_equal(binned, [[0, 0, 0, 0, 1, 1, 2, 2, 2, 0]])
+
+
+def test_discretize_equal_occupancy():
+    signal = np.array([[5., 1., 4., 2., 6., 3.]])
+    binned = utils_gte.discretize_signal(signal, bins=3, auto_bins=True)
+    np.testing.assert_array_equal(binned, [[2, 0, 1, 0, 2, 1]])
+
+
+def test_transfer_entropy_copied_signal():
+    # The target copies the source with a one frame delay, so the TE from
+    # source to target is the target's conditional entropy H(y_t | y_t-1)
+    x = np.array([0, 0, 1, 1, 0, 0, 1, 1, 0])
+    y = np.concatenate(([0], x[:-1]))
+    result = utils_gte.transfer_entropy_matrix(np.vstack((x, y)), bins=2)
+    expected = 5 / 8 * binary_entropy(2 / 5) + 3 / 8 * binary_entropy(1 / 3)
+    assert np.isclose(result[0, 1], expected)
+    assert np.isclose(result[0, 1], plugin_te(x, y))
+    assert np.isclose(result[1, 0], plugin_te(y, x))
+    assert np.isclose(result[0, 0], plugin_te(x, x))
+
+
+def test_sliding_matches_per_window_on_unclipped_input():
+    rng = np.random.default_rng(0)
+    signal = rng.standard_normal((4, 200))
+    signal[:, 150:] *= 5
+    windows = utils_gte.gte_windows(signal.shape[1], 40, 10)
+    for auto_bins in (False, True):
+        parameters = {'AutoBinNumberQ': auto_bins, 'SourceMarkovOrder': 2,
+            'TargetMarkovOrder': 2, 'StartSampleIndex': 2}
+        results = utils_gte.run_gte_numpy_sliding(signal, parameters, 40,
+            frame_step=10)
+        expected = [utils_gte.transfer_entropy_matrix(
+            signal[:, start:start + length], parameters)
+            for start, length in windows]
+        np.testing.assert_allclose(results, expected)
@@ -8,9 +8,14 @@ __author__ = 'Nuria & Ching & Albert'
 
 
 import numpy as np
-import pdb, os, h5py
+import pdb, os, h5py, time
+import hashlib
 from math import sqrt
-from collections import deque
+import warnings
+
+# Default time_lock_activity cache for callers passing no CACHE_DIR;
+# None disables it
+TIME_LOCK_CACHE_DIR = None
 
 def calc_pvalue(p_value):
     if p_value < 0.0005:
@@ -72,7 +77,23 @@ def time_lock_activity_old(f, t_size=(300,30)):
     return neuron_activity
 
 
-def time_lock_activity(f, t_size=(300,30), order='T'):
+def _time_lock_cache_file(f, signal, t_size, cache_dir, session):
+    # Keyed by the session file, its mtime, SIGNAL and T_SIZE
+    if cache_dir is None:
+        cache_dir = TIME_LOCK_CACHE_DIR
+    if session is None:
+        session = getattr(f, 'filename', None)
+    if cache_dir is None or session is None:
+        return None
+    session = os.path.abspath(session)
+    mtime = os.path.getmtime(session) if os.path.isfile(session) else None
+    key = hashlib.sha1(repr((session, mtime, signal, int(t_size[0]),
+        int(t_size[1]))).encode())
+    return os.path.join(cache_dir, 'time_lock_' + key.hexdigest() + '.npy')
+
+
+def time_lock_activity(f, t_size=(300,30), order='T', signal='C',
+        cache_dir=None, session=None):
     """
     Creates a 3d matrix time-locking activity to trial end.
     Input:
@@ -82,30 +103,48 @@ def time_lock_activity(f, t_size=(300,30), order='T'):
             is the number of frames after the trial end to keep.
         order: char
             order of returned matrix
+        SIGNAL: the dataset of F to time-lock
+        CACHE_DIR: folder memoizing the result (TIME_LOCK_CACHE_DIR
+            if None)
+        SESSION: path keying the cache, by default F.filename
     Output:
         NEURON_ACTIVITY: a numpy matrix; (neurons x trials x frames)
         in size if order == 'N' else (trials x neurons x frames) .
     """
-    trial_start = np.asarray(f['trial_start']).astype('int')
-    trial_end = np.asarray(f['trial_end']).astype('int')
-    C = f['C']
-    assert(np.sum(np.isnan(C)) == 0)
-    if order == 'T':
-        neuron_activity = np.full(
-            (trial_end.shape[0], C.shape[0], np.sum(t_size) + 1),
-            np.nan)
+    cache_file = _time_lock_cache_file(f, signal, t_size, cache_dir, session)
+    if cache_file is not None and os.path.isfile(cache_file):
+        neuron_activity = np.load(cache_file)
     else:
-        neuron_activity = np.full(
-            (C.shape[0], trial_end.shape[0], np.sum(t_size) + 1),
-            np.nan)
-    for ind, trial in enumerate(trial_end):
-        start_idx = max(trial - t_size[0], trial_start[ind])
-        aux_act = C[:, start_idx:trial + 1 + t_size[1]]
-        if order == 'T':
-            neuron_activity[ind, :, np.sum(t_size) + 1-aux_act.shape[1]:] = aux_act
-        else:
-            neuron_activity[:, ind, np.sum(t_size) + 1-aux_act.shape[1]:] = aux_act
-    return neuron_activity
+        trial_start = np.asarray(f['trial_start']).astype('int')
+        trial_end = np.asarray(f['trial_end']).astype('int')
+        C = f[signal]
+        pre, post = int(t_size[0]), int(t_size[1])
+        # One read of the frames spanned by all trials
+        first = (int(trial_end.min()) if trial_end.size else 0) - pre
+        last = (int(trial_end.max()) if trial_end.size else 0) + post + 1
+        lo, hi = max(first, 0), min(last, C.shape[1])
+        span = np.asarray(C[:, lo:hi], dtype=np.float64)
+        assert(np.sum(np.isnan(span)) == 0)
+        left, right = lo - first, last - hi
+        if left or right:
+            span = np.pad(span, ((0, 0), (left, right)),
+                constant_values=np.nan)
+        windows = np.lib.stride_tricks.sliding_window_view(span,
+            pre + post + 1, axis=1)
+        # trials x neurons x frames
+        neuron_activity = windows.transpose(1, 0, 2)[trial_end - pre - first]
+        frames = trial_end[:, np.newaxis] + np.arange(-pre, post + 1)
+        before = frames < trial_start[:, np.newaxis]
+        np.copyto(neuron_activity, np.nan, where=before[:, np.newaxis, :])
+        if cache_file is not None:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            tmp_file = cache_file + '.tmp.npy'
+            np.save(tmp_file, neuron_activity)
+            os.replace(tmp_file, cache_file)
+    if order == 'T':
+        return neuron_activity
+    return np.ascontiguousarray(neuron_activity.transpose(1, 0, 2))
 
 
 class OnlineNormalEstimator(object):
@@ -113,10 +152,14 @@ class OnlineNormalEstimator(object):
     A class to allow rolling calculation of mean and standard deviation.
     Useful especially when processing many GTE matrices. Thanks to:
     http://alias-i.com/lingpipe/docs/api/com/aliasi/stats/
+    HANDLE accepts a scalar or a numpy array, whose non-NaN values are added
+    in one batched update. Estimators fed separately (e.g. per day or per
+    process) are combined with MERGE.
     """
 
     def __init__(self, algor='welford'):
         # Constructs an instance that has seen no data
+        self.algor = algor
         self.mN = 0 # Number of samples
         self.mM = 0.0 # Mean
         self.mS = 0.0 # Sum of squared differences from mean
@@ -135,6 +178,12 @@ class OnlineNormalEstimator(object):
 
     def handle_welford(self, x):
         # Adds X to the collection of samples for this estimator
+        if isinstance(x, np.ndarray):
+            x = x[~np.isnan(x)]
+            if x.size > 0:
+                mean = np.mean(x)
+                self._merge_welford(x.size, mean, np.sum((x - mean)**2))
+            return
         self.mN += 1
         nextM = self.mM + (x - self.mM)/self.mN
         self.mS += (x - self.mM)*(x - nextM)
@@ -152,10 +201,66 @@ class OnlineNormalEstimator(object):
         self.mM = mOld
         self.mN -= 1
 
+    def _merge_welford(self, n, mean, m2):
+        # Adds a batch of N samples of mean MEAN and sum of squared
+        # differences M2 (Chan et al.'s pairwise update). Elementwise for
+        # the per-group arrays of handle_grouped.
+        total = self.mN + n
+        if np.ndim(total) == 0:
+            weight = n/total if total > 0 else 0.0
+        else:
+            weight = n/np.maximum(total, 1)
+        delta = mean - self.mM
+        self.mS = self.mS + m2 + delta**2*self.mN*weight
+        self.mM = self.mM + delta*weight
+        self.mN = total
+
+    def handle_grouped(self, x, groups, num_groups):
+        """
+        Welford only. Keeps a separate estimate for each of NUM_GROUPS
+        groups: the non-NaN values of the array X are added to the group
+        given by the integer array GROUPS (same size as X), all in one
+        batch. MEAN and STD then return arrays of NUM_GROUPS size.
+        """
+        if self.algor != 'welford':
+            raise ValueError("Grouped updates need the welford algorithm")
+        x = np.asarray(x, dtype=np.float64).ravel()
+        groups = np.asarray(groups).ravel()
+        valid = ~np.isnan(x)
+        x, groups = x[valid], groups[valid]
+        n = np.bincount(groups, minlength=num_groups)
+        mean = np.bincount(groups, weights=x, minlength=num_groups)
+        mean = mean/np.maximum(n, 1)
+        m2 = np.bincount(groups, weights=(x - mean[groups])**2,
+            minlength=num_groups)
+        if np.ndim(self.mN) == 0:
+            if self.mN != 0:
+                raise ValueError("Estimator already holds ungrouped data")
+            self.mN = np.zeros(num_groups, dtype=np.int64)
+            self.mM = np.zeros(num_groups)
+            self.mS = np.zeros(num_groups)
+        self._merge_welford(n, mean, m2)
+
+    def merge(self, other):
+        # Adds the samples seen by the estimator OTHER to this one
+        if self.algor != other.algor:
+            raise ValueError("Cannot merge {} and {} estimators".format(
+                self.algor, other.algor))
+        if self.algor == 'welford':
+            self._merge_welford(other.mN, other.mM, other.mS)
+        else:
+            self.mN += other.mN
+            self.mS += other.mS
+            self.mM += other.mM
+        return self
+
     def mean_welford(self):
         return self.mM
 
     def std_welford(self):
+        if np.ndim(self.mN) > 0:
+            return np.where(self.mN > 1,
+                np.sqrt(self.mS/np.maximum(self.mN, 1)), 0.0)
         if self.mN > 1:
             return sqrt(self.mS/self.mN)
         else:
@@ -196,27 +301,30 @@ class OnlineNormalEstimator(object):
 
 
 class DCache:
-    # TODO: AUGMENT IT SUCH THAT IT WORKS FOR MULTIPLE
 
     def __init__(self, size=20, thres=2, buffer=False, ftype='mean'):
         """
         :param size: int, size of the dampening cache
         :param thres: float, threshold for valid data caching, ignore signal if |x - mu_x| > thres * var
+        (None to cache every sample)
         :param buffer: boolean, for whether keeping a dynamic buffer
-        so far cache buffer only accepts 1d input
+        (a ring buffer of SIZE samples per signal; ADD takes a scalar or
+        one sample of every signal)
         """
         self.size = size
         self.thres = thres
         self.counter = 0
         self.bandwidth = None
         self.ftype = ftype
+        self.buffer = buffer
+        self.scalar = False
         if ftype == 'median':
             assert buffer, 'median filter requires buffer'
         else:
             assert ftype == 'mean', 'filter type undefined'
 
         if buffer:
-            self.cache = deque()
+            self.cache = None # allocated with the first sample
             self.avg = 0
             self.dev = 0
         else:
@@ -228,50 +336,133 @@ class DCache:
     def __len__(self):
         return self.size
 
+    def _init_buffer(self, num_signals):
+        self.bandwidth = num_signals
+        self.cache = np.full((num_signals, self.size), np.nan)
+        self.pos = np.zeros(num_signals, dtype=int) # next slot per signal
+        self.counts = np.zeros(num_signals, dtype=int) # non-NaN samples
+        self.avg = np.zeros(num_signals)
+        self.dev = np.zeros(num_signals)
+
+    def _window_stats(self, windows):
+        # avg and dev over the last axis; NaNs are unfilled slots
+        full = not np.isnan(windows).any()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if self.ftype == 'median':
+                median = np.median if full else np.nanmedian
+                avg = median(windows, axis=-1)
+                dev = median(np.abs(windows - avg[..., np.newaxis]),
+                    axis=-1)
+            else:
+                avg = (np.mean if full else np.nanmean)(windows, axis=-1)
+                dev = (np.std if full else np.nanstd)(windows, axis=-1)
+        return avg, dev
+
+    def _update_rows(self, rows):
+        # Recomputes the model of the signals ROWS from their buffers
+        empty = rows[self.counts[rows] == 0]
+        self.avg[empty] = np.nan
+        self.dev[empty] = np.nan
+        rows = rows[self.counts[rows] > 0]
+        if rows.size:
+            self.avg[rows], self.dev[rows] = \
+                self._window_stats(self.cache[rows])
+
     def update_model(self):
-        if self.ftype == 'median':
-            self.avg = np.nanmedian(self.cache)
-            self.dev = np.median(np.abs(np.array(self.cache) - self.avg))
-        elif self.cache is not None:
-            self.avg = np.nanmean(self.cache)
-            self.dev = np.std(self.cache)
+        if self.buffer:
+            if self.cache is not None:
+                self._update_rows(np.arange(self.bandwidth))
         else:
             self.dev = np.sqrt(self.m2 - self.avg ** 2)
 
     def add(self, signal):
         # handle nans:
-        if self.cache is not None:
-            assert np.prod(np.array(signal).shape) == 1, 'cache buffer only supports scalar so far'
-            if not np.isnan(signal):
-                if self.counter < self.size:
-                    self.cache.append(signal)
-                else:
-                    if (signal - self.avg) < self.get_dev() * self.thres:
-                        self.cache.append(signal)
-                        self.cache.popleft()
-                self.counter += 1
-        else:
-            if self.bandwidth is None:
-                self.bandwidth = signal.shape[0]
-            if self.counter < self.size:
-                if np.sum(np.isnan(signal)) > 0:
-                    #print(self.avg, self.avg * (self.counter - 1), (self.avg * self.counter + signal) / (self.counter + 1))
-                    self.avg = (self.avg * self.counter + signal) / (self.counter + 1)
-                    self.m2 = (signal ** 2 + self.m2 * self.counter) / (self.counter+1)
-                    self.counter += 1
+        if self.buffer:
+            signal = np.asarray(signal, dtype=np.float64)
+            if self.cache is None:
+                self.scalar = signal.ndim == 0
+                self._init_buffer(signal.size)
+            x = signal.ravel()
+            valid = ~np.isnan(x)
+            if self.thres is None:
+                accept = valid
             else:
-                targets = (~np.isnan(signal)) & ((signal - self.avg) < self.get_dev() * self.thres)
-                #print(self.avg, self.avg * (self.size - 1), (self.avg * (self.size - 1) + signal) / self.size)
-                self.avg[targets] = (self.avg[targets] * (self.size - 1) + signal[targets]) / self.size
-                self.m2[targets] = (signal[targets] ** 2 + self.m2[targets] * (self.size - 1)) / self.size
+                with np.errstate(invalid='ignore'):
+                    accept = valid & ((self.counts < self.size) |
+                        ((x - self.avg) < self.dev * self.thres))
+            rows = np.flatnonzero(accept)
+            self.cache[rows, self.pos[rows]] = x[rows]
+            self.pos[rows] = (self.pos[rows] + 1) % self.size
+            self.counts[valid] += 1
+            self.counter += 1
+            # Only changed (or still empty) buffers need a new model
+            self._update_rows(np.flatnonzero(accept | (self.counts == 0)))
+            return
+        if self.bandwidth is None:
+            self.bandwidth = signal.shape[0]
+        if self.counter < self.size:
+            if np.sum(np.isnan(signal)) > 0:
+                #print(self.avg, self.avg * (self.counter - 1), (self.avg * self.counter + signal) / (self.counter + 1))
+                self.avg = (self.avg * self.counter + signal) / (self.counter + 1)
+                self.m2 = (signal ** 2 + self.m2 * self.counter) / (self.counter+1)
                 self.counter += 1
+        else:
+            targets = (~np.isnan(signal)) & ((signal - self.avg) < self.get_dev() * self.thres)
+            #print(self.avg, self.avg * (self.size - 1), (self.avg * (self.size - 1) + signal) / self.size)
+            self.avg[targets] = (self.avg[targets] * (self.size - 1) + signal[targets]) / self.size
+            self.m2[targets] = (signal[targets] ** 2 + self.m2[targets] * (self.size - 1)) / self.size
+            self.counter += 1
         self.update_model()
 
+    def run(self, signals, chunk_elems=2**22):
+        """
+        Offline mode: feeds SIGNALS (T,) or (num_signals, T) to an emptied
+        buffer and returns get_val() and get_dev() after every frame.
+        """
+        assert self.buffer, 'offline mode requires buffer'
+        signals = np.asarray(signals, dtype=np.float64)
+        single = signals.ndim == 1
+        signals = np.atleast_2d(signals)
+        N, T = signals.shape
+        self._init_buffer(N)
+        vals, devs = np.empty((N, T)), np.empty((N, T))
+        if self.thres is None and not np.isnan(signals).any():
+            # Plain sliding windows, CHUNK_ELEMS window entries at a time
+            padded = np.concatenate((np.full((N, self.size - 1), np.nan),
+                signals), axis=1)
+            windows = np.lib.stride_tricks.sliding_window_view(padded,
+                self.size, axis=1)
+            step = max(chunk_elems // (N * self.size), 1)
+            # The first SIZE-1 windows are partly unfilled, a chunk apart
+            bounds = sorted(set([0, min(self.size - 1, T), T] +
+                list(range(self.size - 1, T, step))))
+            for t0, t1 in zip(bounds[:-1], bounds[1:]):
+                vals[:, t0:t1], devs[:, t0:t1] = \
+                    self._window_stats(windows[:, t0:t1])
+            # Leaves the buffer as stepping through the frames would
+            last = np.arange(max(T - self.size, 0), T)
+            self.cache[:, last % self.size] = signals[:, last]
+            self.pos[:] = T % self.size
+            self.counts[:] = T
+            self.counter = T
+            if T:
+                self.avg, self.dev = vals[:, -1].copy(), devs[:, -1].copy()
+        else:
+            for t in range(T):
+                self.add(signals[:, t])
+                vals[:, t] = self.avg
+                devs[:, t] = self.dev
+        if single:
+            self.scalar = True
+            return vals[0], devs[0]
+        return vals, devs
+
     def get_val(self):
-        return self.avg
+        return self.avg[0] if self.scalar else self.avg
 
     def get_dev(self):
-        return self.dev
+        return self.dev[0] if self.scalar else self.dev
 
 
 def std_filter(width=20, s=2, buffer=False):
@@ -292,3 +483,85 @@ def median_filter(width=20, s=2):
         # print(sigs[i], dc.get_val())
         return dc.get_val()
     return fil, dc
+
+
+class OnlineDFFEstimator(object):
+    """
+    Streaming dF/F and SNR of N neurons, fed one frame at a time as in the
+    BMI loop. F0 and noise come from a DCache ring buffer per neuron; the
+    SNR is computed as in caiman_SNR.
+    """
+    MAD_TO_STD = 1.4826
+
+    def __init__(self, num_neurons, width=30, thres=2, ftype='median'):
+        self.num_neurons = num_neurons
+        self.cache = DCache(width, thres, buffer=True, ftype=ftype)
+        self.scale = self.MAD_TO_STD if ftype == 'median' else 1.0
+        self.frames = 0
+        self.f0 = np.full(num_neurons, np.nan)
+        self.dff = np.full(num_neurons, np.nan)
+        self.noise = np.full(num_neurons, np.nan)
+        self.power_sum = np.zeros(num_neurons)
+        self.power_count = np.zeros(num_neurons, dtype=int)
+
+    def update(self, frame):
+        # Adds one frame (N,) of fluorescence and returns its dF/F
+        frame = np.asarray(frame, dtype=np.float64).ravel()
+        if frame.size != self.num_neurons:
+            raise ValueError("Expected {} values, got {}".format(
+                self.num_neurons, frame.size))
+        self.cache.add(frame)
+        self.f0 = self.cache.get_val().copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.dff = (frame - self.f0) / self.f0
+            self.noise = self.scale * self.cache.get_dev() / np.abs(self.f0)
+        valid = ~np.isnan(self.dff)
+        self.power_sum[valid] += self.dff[valid] ** 2
+        self.power_count[valid] += 1
+        self.frames += 1
+        return self.dff
+
+    @property
+    def snr(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            power = np.where(self.power_count > 0,
+                self.power_sum / self.power_count, np.nan)
+            noise_power = self.noise ** 2
+            return (power - noise_power) / noise_power
+
+    def replay(self, traces):
+        """
+        Feeds stored TRACES (N, T) frame by frame, as online.
+        :return: dict of (N, T) 'f0', 'dff', 'noise' and the final 'snr'
+        """
+        traces = np.asarray(traces, dtype=np.float64)
+        out = {k: np.empty(traces.shape) for k in ('f0', 'dff', 'noise')}
+        for t in range(traces.shape[1]):
+            self.update(traces[:, t])
+            out['f0'][:, t] = self.f0
+            out['dff'][:, t] = self.dff
+            out['noise'][:, t] = self.noise
+        out['snr'] = self.snr
+        return out
+
+
+def benchmark_online_dff(num_neurons=100, fr=9.72365281, num_frames=2000,
+        seed=0, **kwargs):
+    """
+    Times OnlineDFFEstimator.update on synthetic frames against the frame
+    period 1/FR; returns latency stats (seconds) and the over-budget share.
+    """
+    rng = np.random.RandomState(seed)
+    shape = (num_frames, num_neurons)
+    frames = 100 + rng.standard_normal(shape).cumsum(axis=0) * 0.1 \
+        + rng.exponential(20, shape) * (rng.rand(*shape) < 0.05)
+    estimator = OnlineDFFEstimator(num_neurons, **kwargs)
+    latencies = np.empty(num_frames)
+    for t in range(num_frames):
+        start = time.perf_counter()
+        estimator.update(frames[t])
+        latencies[t] = time.perf_counter() - start
+    budget = 1.0 / fr
+    return {'mean': latencies.mean(), 'median': np.median(latencies),
+            'p99': np.percentile(latencies, 99), 'max': latencies.max(),
+            'budget': budget, 'over_budget': np.mean(latencies > budget)}
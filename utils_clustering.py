@@ -4,14 +4,36 @@ import time
 import pdb
 import matplotlib.pyplot as plt
 import scipy.signal
+import scipy.sparse
 
-def sort_matrix_by_clusters(matrix, labels):
+def intra_cluster_mean(matrix, labels):
+    """
+    Mean of each neuron's entries in MATRIX towards the other neurons of its
+    own cluster (0 for singleton clusters). MATRIX may be scipy sparse.
+    """
+    labels = np.asarray(labels).ravel()
+    clusters, label_idx = np.unique(labels, return_inverse=True)
+    one_hot = np.zeros((labels.size, clusters.size))
+    one_hot[np.arange(labels.size), label_idx] = 1
+    # Row sums of MATRIX over each cluster, without the diagonal
+    cluster_sums = np.asarray(matrix @ one_hot)
+    intra_sums = cluster_sums[np.arange(labels.size), label_idx] - \
+        np.asarray(matrix.diagonal()).ravel()
+    counts = one_hot.sum(axis=0)[label_idx] - 1
+    return np.where(counts > 0, intra_sums/np.maximum(counts, 1), 0.0)
+
+def sort_matrix_by_clusters(matrix, labels, secondary=None):
     """
     Given a square MATRIX, this function will sort the matrix by LABELS.
     Inputs:
-        MATRIX: A numpy matrix; a (neurons x neurons) distance matrix.
+        MATRIX: A numpy matrix; a (neurons x neurons) distance matrix. May be
+            a scipy sparse matrix, which is permuted without densifying.
         LABELS: A numpy array of size (neurons x 1). Contains numerical,
             zero-indexed labels that indicates what cluster each neuron is in.
+        SECONDARY: Order of the neurons within each cluster. None keeps their
+            original order; 'intra_mean' sorts them by decreasing mean
+            value towards their own cluster (see intra_cluster_mean);
+            a numpy array of size (neurons x 1) sorts them by increasing key.
     Outputs:
         SORTED_MAT: The sorted version of MATRIX
         SORTING: A numpy array of size(neurons x 1), indicating the new indices
@@ -19,23 +41,21 @@ def sort_matrix_by_clusters(matrix, labels):
             original matrix will be at index SORTING_i in the sorted matrix.
     """
 
-    sorting = np.zeros(labels.shape)
-    sorted_mat = np.zeros(matrix.shape)
-    grouped_arrays = []
-    num_neurons = labels.size
-    num_clusters = np.max(labels) + 1
-    for i in range(num_clusters):
-        grouped_arrays.append(np.argwhere(labels==i))
-    new_idx = 0
-    for group in grouped_arrays:
-        for old_idx in group:
-            sorting[old_idx] = new_idx
-            new_idx += 1
-    for i in range(num_neurons):
-        for j in range(num_neurons):
-            new_i = sorting[i]
-            new_j = sorting[j]
-            sorted_mat[new_i, new_j] = matrix[i,j]
+    labels = np.asarray(labels).ravel()
+    if secondary is None:
+        order = np.argsort(labels, kind='stable')
+    else:
+        if isinstance(secondary, str):
+            if secondary != 'intra_mean':
+                raise ValueError("Unknown secondary key: {}".format(secondary))
+            secondary = -intra_cluster_mean(matrix, labels)
+        order = np.lexsort((np.asarray(secondary).ravel(), labels))
+    sorting = np.empty(labels.size, dtype=int)
+    sorting[order] = np.arange(labels.size)
+    if scipy.sparse.issparse(matrix):
+        sorted_mat = matrix.tocsr()[order][:, order]
+    else:
+        sorted_mat = np.asarray(matrix)[np.ix_(order, order)]
     return sorted_mat, sorting
 
 def normalized_cc(x, y): # The affinity function
@@ -55,15 +75,167 @@ def normalized_cc(x, y): # The affinity function
             max_cc = cc
     return max_cc
 
-def normalized_cc_mat(X): # The affinity function
-    num_neurons, _ = X.shape
-    distance_mat = np.zeros((num_neurons, num_neurons))
-    for i in range(num_neurons):
-        for j in range(num_neurons):
-            max_cc = normalized_cc(X[i,:], X[j,:])
-            distance_mat[i,j] = max_cc
-    return distance_mat
+def normalized_cc_mat(X, block_size=64): # The affinity function
+    """
+    NORMALIZED_CC(X[i,:], X[j,:]) for every pair of neurons, computed with
+    lagged_cc_mat.
+    """
+    max_cc, _ = lagged_cc_mat(X, padding=1, block_size=block_size)
+    return max_cc
+
+def _window_norms(X, window_len, num_windows):
+    """Sum of squared deviations from the window mean of each of the first
+    NUM_WINDOWS length-WINDOW_LEN windows of each row of X."""
+    csum = np.zeros((X.shape[0], X.shape[1] + 1))
+    csum2 = np.zeros((X.shape[0], X.shape[1] + 1))
+    np.cumsum(X, axis=1, out=csum[:,1:])
+    np.cumsum(X**2, axis=1, out=csum2[:,1:])
+    k = np.arange(num_windows)
+    sums = csum[:,k + window_len] - csum[:,k]
+    sums2 = csum2[:,k + window_len] - csum2[:,k]
+    return np.maximum(sums2 - sums**2/window_len, 0.0)
+
+def iter_lagged_cc_blocks(X, padding=1, block_size=64):
+    """
+    Yields the rows of LAGGED_CC_MAT(X, PADDING) BLOCK_SIZE neurons at a
+    time, as (BLOCK, MAX_CC, LAG) with BLOCK a slice of neurons and MAX_CC,
+    LAG (block x neurons) matrices. Only one block is held in memory.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    num_neurons, num_frames = X.shape
+    min_frames = 100
+    if num_frames < min_frames:
+        raise ValueError("Signal length is not long enough.")
+    frame_size = num_frames - padding
+    num_lags = padding + 1
+    nfft = 1 << (num_frames + frame_size - 1).bit_length()
+    # Correlation at lag k as a sum over frequencies f of
+    # weight_f * conj(T_f) * Y_f * exp(2 pi i f k / nfft)
+    freqs = np.arange(nfft//2 + 1)
+    weights = np.full(freqs.size, 2.0)
+    weights[0] = 1.0
+    weights[-1] = 1.0
+    phases = np.exp(2j*np.pi*np.outer(np.arange(num_lags), freqs)/nfft)
+    Y_f = np.fft.rfft(X, n=nfft, axis=1)
+    y_norms = _window_norms(X, frame_size, num_lags) # (neurons x lags)
+    eps = np.finfo(float).eps
+
+    for start in range(0, num_neurons, block_size):
+        block = slice(start, min(start + block_size, num_neurons))
+        block_len = block.stop - block.start
+        max_cc = np.zeros((block_len, num_neurons))
+        lag = np.zeros((block_len, num_neurons), dtype=int)
+        for i in range(padding): # For different time-shifts of x
+            templates = X[block,i:i + frame_size]
+            templates = templates - np.mean(templates, axis=1, keepdims=True)
+            t_norms = np.sum(templates**2, axis=1)
+            T_f = np.conj(np.fft.rfft(templates, n=nfft, axis=1)) * weights
+            cc = np.empty((num_lags, block_len, num_neurons))
+            for k in range(num_lags):
+                cc[k] = np.real((T_f * phases[k]) @ Y_f.T) / nfft
+            # (lags x block x neurons)
+            norm = np.sqrt(t_norms[np.newaxis, :, np.newaxis] *
+                y_norms.T[:, np.newaxis, :])
+            mask = norm <= eps
+            cc[~mask] /= norm[~mask]
+            cc[mask] = 0
+            best_k = np.argmax(cc, axis=0)
+            best_cc = np.take_along_axis(cc, best_k[np.newaxis], 0)[0]
+            update = np.abs(best_cc) > np.abs(max_cc)
+            max_cc[update] = best_cc[update]
+            lag[update] = best_k[update] - i
+        yield block, max_cc, lag
+
+def lagged_cc_mat(X, padding=1, block_size=64):
+    """
+    All-pairs version of NORMALIZED_CC: for every pair of neurons (i, j),
+    the largest Pearson correlation between a window of X[i,:] and the
+    windows of X[j,:] shifted by 0 to PADDING frames. Each neuron is
+    FFT'd once, and the lagged correlations of a block of BLOCK_SIZE
+    neurons against all neurons are matrix products in frequency space, so
+    memory use scales with BLOCK_SIZE x num_neurons.
+    Inputs:
+        X: A (neurons x frames) numpy matrix
+        PADDING: Integer; the number of frames by which windows are shifted
+        BLOCK_SIZE: Integer; number of neurons correlated at once
+    Outputs:
+        MAX_CC: A (neurons x neurons) matrix; MAX_CC[i,j] equals
+            NORMALIZED_CC(X[i,:], X[j,:]) with the same PADDING
+        LAG: A (neurons x neurons) integer matrix; the shift of X[j,:]
+            relative to X[i,:], in frames, at which MAX_CC is reached
+    """
+    num_neurons = X.shape[0]
+    max_cc = np.zeros((num_neurons, num_neurons))
+    lag = np.zeros((num_neurons, num_neurons), dtype=int)
+    for block, block_cc, block_lag in iter_lagged_cc_blocks(X, padding,
+            block_size):
+        max_cc[block] = block_cc
+        lag[block] = block_lag
+    return max_cc, lag
+
+def _sparsify_rows(rows, row_offset, k=None, threshold=None):
+    """COO entries of the top-K values (and/or those >= THRESHOLD) of each
+    row of ROWS, leaving out self-edges and non-positive weights."""
+    num_rows, num_cols = rows.shape
+    rows = np.array(rows, dtype=np.float64)
+    rows[np.arange(num_rows), np.arange(num_rows) + row_offset] = -np.inf
+    keep = rows > 0
+    if threshold is not None:
+        keep &= rows >= threshold
+    if k is not None and k < num_cols:
+        top = np.argpartition(-rows, k - 1, axis=1)[:, :k]
+        in_top = np.zeros_like(keep)
+        np.put_along_axis(in_top, top, True, axis=1)
+        keep &= in_top
+    r, c = np.nonzero(keep)
+    return r + row_offset, c, rows[r, c]
 
+def knn_graph(similarity, k=None, threshold=None, symmetrize=True,
+        block_size=1024):
+    """
+    Builds a sparse similarity graph keeping, for each neuron, only its K
+    most similar neurons and/or the similarities >= THRESHOLD.
+    Inputs:
+        SIMILARITY: A (neurons x neurons) numpy matrix, or an iterable of
+            (BLOCK, ROWS) pairs giving its rows by blocks, e.g. from
+            ITER_LAGGED_CC_BLOCKS, so the dense matrix is never built
+        K: Integer; number of neighbors kept per neuron
+        THRESHOLD: Float; minimum similarity of a kept edge
+        SYMMETRIZE: If True, an edge kept in either direction is kept in
+            both, with the larger weight, as undirected clustering expects
+    Outputs:
+        GRAPH: A (neurons x neurons) scipy.sparse CSR matrix with positive
+            weights and no self-edges
+    """
+    if isinstance(similarity, np.ndarray):
+        num_neurons = similarity.shape[0]
+        blocks = [(slice(s, min(s + block_size, num_neurons)),
+            similarity[s:s + block_size])
+            for s in range(0, num_neurons, block_size)]
+    else:
+        blocks = similarity
+    rows, cols, vals = [], [], []
+    for block, block_rows in blocks:
+        r, c, v = _sparsify_rows(block_rows, block.start, k, threshold)
+        rows.append(r)
+        cols.append(c)
+        vals.append(v)
+        num_neurons = block_rows.shape[1]
+    graph = scipy.sparse.csr_matrix(
+        (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(num_neurons, num_neurons))
+    if symmetrize:
+        graph = graph.maximum(graph.T).tocsr()
+    return graph
+
+def lagged_cc_graph(X, k=None, threshold=None, padding=1, block_size=64):
+    """
+    KNN_GRAPH of the LAGGED_CC_MAT similarities of X, built block by block
+    so that memory scales with BLOCK_SIZE x neurons plus the kept edges.
+    """
+    blocks = ((block, cc) for block, cc, _ in
+        iter_lagged_cc_blocks(X, padding, block_size))
+    return knn_graph(blocks, k=k, threshold=threshold)
 
 # Below are cross-correlation functions, written by the Github user trichter,
 # and included within this file for sake of a cleaner repo.
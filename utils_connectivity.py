@@ -0,0 +1,127 @@
+import os
+import numpy as np
+import h5py
+
+def one_hot_groups(labels, groups=None):
+    """
+    Encodes a label vector as a (neurons x groups) indicator matrix.
+    Inputs:
+        LABELS: Numpy array of NUM_NEURONS size; the group of each neuron
+        GROUPS: The group values to use, in order. If not provided, the
+            sorted unique values of LABELS are used.
+    Outputs:
+        ONE_HOT: A float (NUM_NEURONS x NUM_GROUPS) numpy matrix
+        GROUPS: The group value of each column
+    """
+    labels = np.asarray(labels).ravel()
+    if groups is None:
+        groups = np.unique(labels)
+    groups = np.asarray(groups)
+    one_hot = (labels[:, np.newaxis] == groups[np.newaxis, :])
+    return one_hot.astype(np.float64), groups
+
+def group_summary(results, labels, groups=None, ignore_diagonal=False):
+    """
+    Sums, counts and means of connectivity between every pair of groups of
+    neurons, for a single GTE matrix or a stack of them. Self-connections
+    (the matrix diagonal) and NaN entries are left out of every group pair.
+    Inputs:
+        RESULTS: A (neurons x neurons) matrix or a (num_results x neurons x
+            neurons) stack; the i,jth entry is the transfer from i to j
+        LABELS: Numpy array of NUM_NEURONS size; the group of each neuron
+        GROUPS: The group values to summarize; see one_hot_groups
+        IGNORE_DIAGONAL: If True, the within-group entries are set to NaN
+    Outputs:
+        SUMS, COUNTS, MEANS: (num_groups x num_groups) matrices, stacked as
+            (num_results x num_groups x num_groups) for a stack of RESULTS.
+            MEANS is NaN for group pairs without any value.
+    """
+    results = np.asarray(results, dtype=np.float64)
+    single = results.ndim == 2
+    if single:
+        results = results[np.newaxis]
+    num_neurons = results.shape[-1]
+    one_hot, groups = one_hot_groups(labels, groups)
+    if one_hot.shape[0] != num_neurons:
+        raise RuntimeError('Wrong dimensions for LABELS')
+
+    valid = ~np.isnan(results)
+    valid[:, np.arange(num_neurons), np.arange(num_neurons)] = False
+    values = np.where(valid, results, 0.0)
+    # One_hot.T @ M @ one_hot for every matrix M of the stack
+    sums = one_hot.T @ values @ one_hot
+    counts = one_hot.T @ valid.astype(np.float64) @ one_hot
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, sums/counts, np.nan)
+    if ignore_diagonal:
+        diag = np.arange(groups.size)
+        for m in (sums, counts, means):
+            m[:, diag, diag] = np.nan
+    if single:
+        return sums[0], counts[0], means[0]
+    return sums, counts, means
+
+def red_labels(exp_file):
+    """Group 1 for red neurons and 0 for green, over the 'nerden' neurons
+    of the experiment HDF5 file EXP_FILE."""
+    nerden = np.array(exp_file['nerden'])
+    return np.array(exp_file['redlabel'])[nerden].astype(int)
+
+def e2_labels(exp_file):
+    """Group 1 for E2 ensemble neurons and 0 for all others, over the
+    'nerden' neurons of the experiment HDF5 file EXP_FILE."""
+    ens_neur = np.array(exp_file['ens_neur'])
+    e2_neur = ens_neur[np.array(exp_file['e2_neur'])]
+    nerden = np.array(exp_file['nerden'])
+    e2_mask = np.zeros(nerden.size, dtype=int)
+    e2_mask[e2_neur] = 1
+    return e2_mask[nerden]
+
+def cohort_group_summary(analysis, label_fn, groups=(0, 1),
+        processed_dir='./processed/', animal_prefix=''):
+    """
+    Summarizes the stored GTE results ANALYSIS (e.g. 'reward_end') of every
+    session of a cohort by neuron group, one stacked matrix product per
+    session.
+    Inputs:
+        ANALYSIS: The name of the stored results; see
+            utils_gte.load_gte_results
+        LABEL_FN: A function of the opened experiment HDF5 file returning
+            the group of each neuron, e.g. red_labels or e2_labels
+        GROUPS: The group values to summarize; fixed so that sessions
+            missing a group still stack
+        PROCESSED_DIR: The folder holding an ANIMAL/DAY folder per session
+        ANIMAL_PREFIX: Only animals whose name starts with this are included,
+            e.g. 'IT' or 'PT'
+    Outputs:
+        SESSIONS: A list of (animal, day) pairs, one per summarized session
+        SUMS, COUNTS, MEANS: Lists of (num_results x num_groups x num_groups)
+            arrays in the order of SESSIONS; see group_summary
+    """
+    from utils_gte import load_gte_results # utils_gte imports this module
+    sessions, sums, counts, means = [], [], [], []
+    for animal_dir in sorted(os.listdir(processed_dir)):
+        animal_path = processed_dir + animal_dir + '/'
+        if not os.path.isdir(animal_path) or \
+                not animal_dir.startswith(animal_prefix):
+            continue
+        for day_dir in sorted(os.listdir(animal_path)):
+            day_path = animal_path + day_dir + '/'
+            results = load_gte_results(day_path, analysis)
+            if results is None:
+                continue
+            try:
+                with h5py.File(day_path + 'full_' + animal_dir + '_' +
+                        day_dir + '__data.hdf5', 'r') as f:
+                    labels = label_fn(f)
+            except (IOError, OSError, KeyError):
+                continue # The file is in use or lacks the labels
+            results = np.asarray(results)
+            if results.ndim == 2:
+                results = results[np.newaxis]
+            s, c, m = group_summary(results, labels, groups)
+            sessions.append((animal_dir, day_dir))
+            sums.append(s)
+            counts.append(c)
+            means.append(m)
+    return sessions, sums, counts, means
@@ -1,17 +1,27 @@
 import re
 import os
 import sys
+import json
+import warnings
+import hashlib
 import subprocess
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import pdb
 import matplotlib.pyplot as plt
 import pickle
+import h5py
 from scipy.stats import zscore
+from utils_connectivity import group_summary
 from matplotlib import animation
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib.widgets import Slider
 
+GTE_EXECUTABLE = "./te-causality/transferentropy-sim/te-extended"
+GTE_RESULTS_FILE = "gte_results.hdf5"
+GTE_EXPERIMENTS_DIR = "./te-causality/transferentropy-sim/experiments/"
+
 def write_params_to_ctrl_file(parameters, control_file_name):
     """
     Writes parameters to a control file.    
@@ -26,9 +36,10 @@ def write_params_to_ctrl_file(parameters, control_file_name):
             f.write(key + " = " + str(parameters[key]) + ";\n")
 
 def write_signal_to_file(signal, idx, frame_size, signal_file_name,
-        exclude_file_name):
+        exclude_file_name, fmt="%.9g", block_size=4096):
     """
-    Writes given neural signals to a signal file.
+    Writes given neural signals to a signal file. SIGNAL is not modified;
+    flat neurons are nudged in a copy of the window so that GTE can bin them.
 
     Input:
         SIGNAL: a Numpy array of the  neural signal, (num_neurons x num_frames)
@@ -38,46 +49,126 @@ def write_signal_to_file(signal, idx, frame_size, signal_file_name,
         SIGNAL_FILE_NAME: a String; the path to the signal file to write to 
         EXCLUDE_FILE_NAME: a String; the path to a file to write the indices of
             neurons with a flat signal. These neurons will be excluded. 
+        FMT: a String; printf-style format of a single value. The default
+            "%.9g" keeps 9 significant digits, fewer than the 17 that str()
+            wrote before, which is far below the resolution of GTE's binning
+        BLOCK_SIZE: an integer; number of frames formatted per write
     """
 
-    flat_signal_idxs = [] 
-    for i in range(signal.shape[0]):
-        signal_window = signal[i,idx:idx+frame_size]
-        if np.max(signal_window) == np.min(signal_window):
-            signal[i,idx] += 0.1
-            flat_signal_idxs.append(i)
+    window = np.array(signal[:,idx:idx+frame_size], dtype=np.float64)
+    num_neurons, num_frames = window.shape
+    flat = np.max(window, axis=1) == np.min(window, axis=1)
+    window[flat,0] += 0.1
+    flat_signal_idxs = np.flatnonzero(flat).tolist()
+    line_fmt = ",".join([fmt] * num_neurons) + "\n"
     with open(signal_file_name, "w+") as f:
-        num_neurons = signal.shape[0]
-        num_frames = frame_size
-        for i in range(idx, idx+frame_size):
-            line = ""
-            for j in range(num_neurons):
-                if j==0:
-                    line += str(signal[j,i])
-                else:
-                    line+=(","+str(signal[j,i]))
-            f.write(line+"\n") 
+        for start in range(0, num_frames, block_size):
+            block = window[:,start:start+block_size]
+            f.write((line_fmt * block.shape[1]) % tuple(block.T.ravel()))
     with open(exclude_file_name, 'wb') as fp:
         pickle.dump(flat_signal_idxs, fp)
 
-def parse_mathematica_list(file_name):
+def parse_mathematica_list(file_name, out=None):
     """
     Parses a mathematica file into a numpy array.
 
     Input:
         FILE_NAME: a String; the path to the file containing a mathematica list
+        OUT: an optional (N x N) Numpy array to parse into, e.g. one row of a
+            stacked HDF5 result dataset
     Output:
         CONNECTIVITY_MATRIX: the corresponding Numpy array
     """
     with open(file_name) as f:
         x = f.read()    # Gets the whole mathematica array
-    x1 = x[1:-2]    #Strip off the outer brackets
-    matches = re.findall('{(.*?)}\\n', x1, flags=0) # Collects each matrix row
-    matrix = [m.split(', ') for m in matches]
-    matrix = [np.array(row).astype(np.float) for row in matrix]
-    connectivity_matrix = np.array(matrix)
+    num_rows = x.count('{') - 1
+    # Drop the brackets and tokenize all values at once; Mathematica writes
+    # exponents as 1.5*^-6
+    x = x.replace('{', ' ').replace('}', ' ').replace('*^', 'e').strip()
+    values = np.array(x.split(','), dtype=np.float64)
+    connectivity_matrix = values.reshape((num_rows, -1))
+    if out is not None:
+        out[...] = connectivity_matrix
+        return out
     return connectivity_matrix
 
+def save_gte_results(folder_path, analysis, results, attrs=None):
+    """
+    Stores GTE results of one session as a stacked dataset in
+    FOLDER_PATH/GTE_RESULTS_FILE, replacing a previous dataset of the same
+    name. The dataset is stored contiguously so load_gte_results can
+    memory-map it.
+
+    Input:
+        FOLDER_PATH: a String; the processed session folder
+        ANALYSIS: a String; dataset name, e.g. 'reward_end' or
+            'reward_sliding_3'. Matches the stem of the former pickle files.
+        RESULTS: an array of (N x N) connectivity matrices, or a single matrix
+        ATTRS: a dictionary of metadata; dictionaries are stored as JSON
+    """
+    results = np.asarray(results, dtype=np.float64)
+    with h5py.File(os.path.join(folder_path, GTE_RESULTS_FILE), 'a') as hf:
+        if analysis in hf:
+            del hf[analysis]
+        dset = hf.create_dataset(analysis, data=results)
+        for key, val in (attrs or {}).items():
+            if isinstance(val, dict):
+                val = json.dumps(val)
+            dset.attrs[key] = val
+
+def load_gte_results(folder_path, analysis, mmap=True):
+    """
+    Loads GTE results stored by save_gte_results. Sessions that were only
+    processed with the former pickle format are read from ANALYSIS.p.
+
+    Input:
+        FOLDER_PATH: a String; the processed session folder
+        ANALYSIS: a String; dataset name, e.g. 'reward_end'
+        MMAP: a boolean; memory-map the dataset instead of reading it
+    Output:
+        RESULTS: a (trials x N x N) array (read-only if memory-mapped), or
+            None if the session has no such results
+    """
+    h5_file_name = os.path.join(folder_path, GTE_RESULTS_FILE)
+    if os.path.isfile(h5_file_name):
+        with h5py.File(h5_file_name, 'r') as hf:
+            if analysis in hf:
+                dset = hf[analysis]
+                offset = dset.id.get_offset()
+                if not mmap or offset is None or dset.size == 0:
+                    return np.array(dset)
+                shape, dtype = dset.shape, dset.dtype
+                return np.memmap(h5_file_name, mode='r', dtype=dtype,
+                    shape=shape, offset=offset)
+    p_file_name = os.path.join(folder_path, analysis + '.p')
+    if os.path.isfile(p_file_name):
+        with open(p_file_name, 'rb') as p_file:
+            return np.asarray(pickle.load(p_file))
+    return None
+
+def convert_gte_pickles(folder_path, remove=False):
+    """
+    Moves all GTE result pickles written by ExpGTE in a session folder into
+    GTE_RESULTS_FILE. Returns the converted analysis names.
+    """
+    gte_pickle = re.compile('(baseline|whole_experiment|experiment_end|'
+        'reward_end|reward_sliding_[0-9]+|reward_shuffled|whole_shuffled)\\.p$')
+    analyses = []
+    for f in sorted(os.listdir(folder_path)):
+        if not gte_pickle.match(f):
+            continue
+        p_file_name = os.path.join(folder_path, f)
+        with open(p_file_name, 'rb') as p_file:
+            results = pickle.load(p_file)
+        if len(results) == 0:
+            continue
+        save_gte_results(folder_path, f[:-2], results,
+            {'source': 'pickle'})
+        analyses.append(f[:-2])
+        if remove:
+            os.remove(p_file_name)
+    return analyses
+
 def heatmap(data, row_labels, col_labels, ax=None,
             cbar_kw={}, cbarlabel="", **kwargs):
     """
@@ -135,6 +226,62 @@ def heatmap(data, row_labels, col_labels, ax=None,
 
     return im, cbar
 
+def make_gte_experiment_dir(exp_name, input_key=None):
+    """
+    Creates a GTE experiment directory (with an outputs folder) and returns
+    its path. INPUT_KEY identifies the data and parameters (see
+    GTECache.key) and is stored in the directory. An existing directory
+    with the same key is kept, so its manifest and finished results let an
+    interrupted run resume; otherwise its contents stem from other inputs
+    and are removed.
+    """
+    exp_path = GTE_EXPERIMENTS_DIR + exp_name
+    key_file_name = exp_path + "/input_key.txt"
+    if os.path.isdir(exp_path):
+        old_key = None
+        if os.path.isfile(key_file_name):
+            with open(key_file_name) as f:
+                old_key = f.read().strip()
+        if input_key is not None and old_key == input_key:
+            return exp_path
+        print("Replacing existing GTE experiment directory " + exp_path)
+        shutil.rmtree(exp_path)
+    os.makedirs(exp_path + "/outputs")
+    if input_key is not None:
+        with open(key_file_name, "w") as f:
+            f.write(input_key)
+    return exp_path
+
+def prepare_gte_trials(exp_data, to_zscore=False, zscore_threshold=0.0):
+    """
+    Yields the trials of EXP_DATA that GTE is run on, processed as GTE
+    input: leading NaNs are removed, trials shorter than 30 frames are
+    skipped and, if TO_ZSCORE, each trial is z-scored and clipped at
+    ZSCORE_THRESHOLD.
+
+    Input:
+        EXP_DATA: a 3D numpy array of size (trials x neurons x frames)
+    Output:
+        Yields (IDX, SIGNAL) pairs, IDX being the trial index in EXP_DATA
+    """
+    for idx in range(exp_data.shape[0]):
+        signal = exp_data[idx,:,:]
+        signal_start = np.argwhere(~np.isnan(signal[0,:]))[0,0]
+        signal = signal[:,signal_start:]
+
+        # Check the trial is long enough to run GTE. Arbitrarily,
+        # it should be at least 30 frames long.
+        if signal.shape[1] < 30:
+            continue
+
+        # Process the signal
+        if to_zscore:
+            signal = zscore(signal, axis=1)
+            signal = np.nan_to_num(signal)
+            signal = np.maximum(signal, -1.0*zscore_threshold)
+            signal = np.minimum(signal, zscore_threshold)
+        yield idx, signal
+
 def create_gte_input_files_sliding(
         exp_name, exp_data, parameters,
         frame_size, frame_step=1):
@@ -163,22 +310,15 @@ def create_gte_input_files_sliding(
             output.mx file, itself a mathematica connectivity matrix.
     """
 
-    try:
-        exp_path = "./te-causality/transferentropy-sim/experiments/" + exp_name 
-        os.mkdir(exp_path)
-        os.mkdir(exp_path + "/outputs")
-    except OSError:
-        msg = ("Experiment name already exists in GTE experiments folder. " + \
-            "Remove the existing directory or rename your experiment to " + \
-            "ensure conflicts do not arise.")
-        sys.exit(msg)
+    exp_path = make_gte_experiment_dir(exp_name, GTECache.key(exp_data,
+        parameters, frame_size=frame_size, frame_step=frame_step))
     control_file_names = []
     exclude_file_names = []
     output_file_names = []
     num_neurons = exp_data.shape[0]
     num_frames = exp_data.shape[1]
     signal = exp_data
-    for idx in range(frame_size, num_frames-frame_size, frame_step):
+    for idx, _ in gte_windows(num_frames, frame_size, frame_step):
         # Set up the necessary variables and parameters
         control_file_name = exp_path + "/control" + str(idx) + ".txt"
         signal_file_name = exp_path + "/signal" + str(idx) + ".txt"
@@ -225,38 +365,17 @@ def create_gte_input_files(exp_name, exp_data,
             output.mx file, itself a mathematica connectivity matrix.
     """
 
-    try:
-        exp_path = "./te-causality/transferentropy-sim/experiments/" + exp_name 
-        os.mkdir(exp_path)
-        os.mkdir(exp_path + "/outputs")
-    except OSError:
-        msg = ("Experiment name already exists in GTE experiments folder. "
-               "Remove the existing directory or rename your experiment to "
-               "ensure conflicts do not arise.")
-        sys.exit(msg)
+    exp_path = make_gte_experiment_dir(exp_name, GTECache.key(exp_data,
+        parameters, to_zscore=to_zscore, zscore_threshold=zscore_threshold))
     control_file_names = []
     exclude_file_names = []
     output_file_names = []
     num_trials = exp_data.shape[0]
     num_neurons = exp_data.shape[1]
     num_frames = exp_data.shape[2]
-    for idx in range(num_trials):
+    for idx, signal in prepare_gte_trials(exp_data, to_zscore,
+            zscore_threshold):
         # Set up the necessary variables and parameters
-        signal = exp_data[idx,:,:]
-        signal_start = np.argwhere(~np.isnan(signal[0,:]))[0,0]
-        signal = signal[:,signal_start:]
-
-        # Check the trial is long enough to run GTE. Arbitrarily,
-        # it should be at least 30 frames long.
-        if signal.shape[1] < 30:
-            continue
-
-        # Process the signal
-        if to_zscore:
-            signal = zscore(signal, axis=1)
-            signal = np.nan_to_num(signal)
-            signal = np.maximum(signal, -1.0*zscore_threshold)
-            signal = np.minimum(signal, zscore_threshold)
         control_file_name = exp_path + "/control" + str(idx) + ".txt"
         signal_file_name = exp_path + "/signal" + str(idx) + ".txt"
         exclude_file_name = exp_path + "/exclude" + str(idx) + ".txt"
@@ -278,7 +397,105 @@ def create_gte_input_files(exp_name, exp_data,
         output_file_names.append(output_file_name)
     return control_file_names, exclude_file_names, output_file_names
 
-def run_gte(control_file_names, exclude_file_names, output_file_names):
+def _run_gte_job(control_file_name, executable, timeout):
+    """Runs a single GTE job; returns None on success, an error string
+    otherwise."""
+    try:
+        completed = subprocess.run([executable, control_file_name],
+            stdout=subprocess.DEVNULL, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return "timeout after {}s".format(timeout)
+    if completed.returncode != 0:
+        return "exit code {}".format(completed.returncode)
+    return None
+
+def _load_gte_result(output_file_name, exclude_file_name):
+    result = parse_mathematica_list(output_file_name)
+    with open(exclude_file_name, 'rb') as p_file:
+        exclude_idxs = pickle.load(p_file)
+    for idx in exclude_idxs:
+        result[idx,:] = np.nan
+        result[:,idx] = np.nan
+    return result
+
+def load_gte_manifest(manifest_file_name):
+    """
+    Reads a GTE job manifest, a JSON dictionary mapping each output file
+    to 'done' or to the error of its last run. A missing manifest is empty.
+    """
+    if manifest_file_name is None or not os.path.isfile(manifest_file_name):
+        return {}
+    with open(manifest_file_name) as f:
+        return json.load(f)
+
+def _write_gte_manifest(manifest, manifest_file_name):
+    tmp_file_name = manifest_file_name + ".tmp"
+    with open(tmp_file_name, "w") as f:
+        json.dump(manifest, f, indent=0)
+    os.replace(tmp_file_name, manifest_file_name)
+
+def iter_gte(control_file_names, exclude_file_names, output_file_names,
+        nproc=1, timeout=None, manifest_file_name=None,
+        executable=GTE_EXECUTABLE):
+    """
+    Runs GTE on each control file with at most NPROC concurrent processes
+    and yields results as jobs finish (not in input order).
+
+    Input:
+        CONTROL_FILE_NAMES, EXCLUDE_FILE_NAMES, OUTPUT_FILE_NAMES: see run_gte
+        NPROC: an integer; maximum number of concurrent GTE processes
+        TIMEOUT: a float; seconds after which a single job is killed. None
+            waits indefinitely.
+        MANIFEST_FILE_NAME: a String; path to a JSON manifest recording
+            finished jobs. Jobs marked 'done' whose output file exists are
+            not rerun, so an interrupted batch can be resumed. By default
+            the manifest is kept next to the first control file.
+        EXECUTABLE: a String; path to the te-extended binary
+    Output:
+        Yields (IDX, RESULT) pairs, where IDX indexes the input lists and
+        RESULT is the connectivity matrix, or None if the job failed.
+    """
+
+    if manifest_file_name is None and len(control_file_names) > 0:
+        manifest_file_name = os.path.join(
+            os.path.dirname(control_file_names[0]), "manifest.json")
+    manifest = load_gte_manifest(manifest_file_name)
+    pending = []
+    for idx, output_file_name in enumerate(output_file_names):
+        if manifest.get(output_file_name) == "done" and \
+                os.path.isfile(output_file_name):
+            yield idx, _load_gte_result(output_file_name,
+                exclude_file_names[idx])
+        else:
+            pending.append(idx)
+
+    with ThreadPoolExecutor(max_workers=max(1, nproc)) as pool:
+        # Each worker thread only waits on its te-extended child process
+        futures = {
+            pool.submit(_run_gte_job, control_file_names[idx], executable,
+                timeout): idx for idx in pending
+            }
+        for future in as_completed(futures):
+            idx = futures[future]
+            output_file_name = output_file_names[idx]
+            error = future.result()
+            if error is None and not os.path.isfile(output_file_name):
+                error = "no output written"
+            if error is None:
+                result = _load_gte_result(output_file_name,
+                    exclude_file_names[idx])
+                manifest[output_file_name] = "done"
+            else:
+                print(control_file_names[idx] + ": " + error)
+                result = None
+                manifest[output_file_name] = error
+            if manifest_file_name is not None:
+                _write_gte_manifest(manifest, manifest_file_name)
+            yield idx, result
+
+def run_gte(control_file_names, exclude_file_names, output_file_names,
+        nproc=1, timeout=None, manifest_file_name=None,
+        executable=GTE_EXECUTABLE):
     """
     Runs GTE on each control file.
 
@@ -289,6 +506,7 @@ def run_gte(control_file_names, exclude_file_names, output_file_names):
             exclude.p file, itself an array of integer indices.
         OUTPUT_FILE_NAMES: an array of Strings. Each String is a path to a 
             result.mx file that contains the result of running GTE.
+        NPROC, TIMEOUT, MANIFEST_FILE_NAME, EXECUTABLE: see iter_gte
     Output:
         RESULTS: an array of connectivity matrices. The ith matrix corresponds 
             to the output of GTE given the ith control file from the input.
@@ -296,20 +514,16 @@ def run_gte(control_file_names, exclude_file_names, output_file_names):
             transfer of information from neuron i to neuron j.
     """
 
-    results = []
-    for idx, control_file_name in enumerate(control_file_names): # TODO: parallelize
-        print(control_file_name)
-        exe_code = subprocess.call([
-            "./te-causality/transferentropy-sim/te-extended", control_file_name
-            ])
-        result = parse_mathematica_list(output_file_names[idx])
-        exclude_file_name = exclude_file_names[idx]
-        with open(exclude_file_name, 'rb') as p_file:
-            exclude_idxs = pickle.load(p_file)
-        for idx in exclude_idxs:
-            result[idx,:] = np.nan
-            result[:,idx] = np.nan
-        results.append(result)
+    results = [None] * len(control_file_names)
+    for idx, result in iter_gte(control_file_names, exclude_file_names,
+            output_file_names, nproc=nproc, timeout=timeout,
+            manifest_file_name=manifest_file_name, executable=executable):
+        results[idx] = result
+    failed = [control_file_names[idx] for idx, result in enumerate(results)
+        if result is None]
+    if failed:
+        raise RuntimeError("GTE failed for {} of {} jobs, rerun to resume: {}"
+            .format(len(failed), len(results), failed))
     return results
 
 def visualize_gte_results(results, neuron_locations, cmap='r'):
@@ -480,18 +694,485 @@ def group_result(result, grouping, ignore_diagonal=True):
     if grouping.size != num_neurons:
         raise RuntimeError('Wrong dimensions for GROUPING')
 
-    grouped_result = np.zeros((num_groups, num_groups))
-    for i in range(num_groups):
-        for j in range(num_groups):
-            if (i == j) and ignore_diagonal:
-                continue
-            relevant_vals = []
-            for k in range(num_neurons): # Find k in group i
-                if grouping[k] != i:
-                    continue
-                for l in range(num_neurons): # Compare to l in group j
-                    if (grouping[l] != j) or (k==l):
-                        continue
-                    relevant_vals.append(result[k, l])
-            grouped_result[i, j] = np.nanmean(relevant_vals)
+    _, _, grouped_result = group_summary(result, grouping,
+        groups=np.arange(num_groups))
+    if ignore_diagonal:
+        grouped_result[np.arange(num_groups), np.arange(num_groups)] = 0
     return grouped_result
+
+
+def discretize_signal(signal, bins=3, auto_bins=False):
+    """
+    Discretizes each neuron's signal into integer bins.
+    Input:
+        SIGNAL: a (num_neurons x num_frames) Numpy array
+        BINS: an integer; number of bins per neuron
+        AUTO_BINS: a boolean; if True, bin edges are the per-neuron quantiles
+            (equal occupancy up to ties, which always share a bin),
+            otherwise the range of each neuron is split into BINS
+            equal-width bins
+    Output:
+        BINNED: a (num_neurons x num_frames) integer array in [0, BINS)
+    """
+    signal = np.asarray(signal, dtype=np.float64)
+    if auto_bins:
+        # Counting the quantile edges below each value keeps tied values
+        # in the same bin
+        edges = np.quantile(signal, np.arange(1, bins) / bins, axis=1)
+        return np.sum(signal[:, np.newaxis, :] > edges.T[:, :, np.newaxis],
+            axis=1)
+    lo = np.min(signal, axis=1, keepdims=True)
+    span = np.max(signal, axis=1, keepdims=True) - lo
+    span[span == 0] = 1.0
+    binned = ((signal - lo) / span * bins).astype(np.int64)
+    return np.minimum(binned, bins - 1)
+
+def _history_code(binned, lags, bins, t0):
+    """Encodes the values at BINNED[:, t - lag] for each lag as one integer
+    per neuron and time point t >= T0."""
+    num_frames = binned.shape[1]
+    code = np.zeros((binned.shape[0], num_frames - t0), dtype=np.int64)
+    for power, lag in enumerate(lags):
+        code += binned[:, t0 - lag:num_frames - lag] * bins ** power
+    return code
+
+def _entropy_rows(codes, alphabet):
+    """Plug-in entropy (in bits) of the integer codes in each row of the 2D
+    array CODES, all values lying in [0, ALPHABET)."""
+    num_rows, num_samples = codes.shape
+    offsets = (np.arange(num_rows) * alphabet)[:, np.newaxis]
+    counts = np.bincount((codes + offsets).ravel(),
+        minlength=num_rows * alphabet).reshape((num_rows, alphabet))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        plogp = np.where(counts > 0, counts * np.log2(counts), 0.0)
+    return np.log2(num_samples) - np.sum(plogp, axis=1) / num_samples
+
+def transfer_entropy_matrix(signal, parameters=None, bins=3, block_size=8):
+    """
+    NumPy backend for GTE: computes the binned transfer entropy between all
+    pairs of neurons from joint histograms, without the te-extended binary.
+    Supports the GTE parameters used by ExpGTE: 'SourceMarkovOrder',
+    'TargetMarkovOrder', 'AutoBinNumberQ' and 'StartSampleIndex', plus
+    'bins' and 'InstantFeedbackTermQ' if given.
+
+    Input:
+        SIGNAL: a (num_neurons x num_frames) Numpy array, e.g. a z-scored
+            and clipped trial
+        PARAMETERS: a dictionary of GTE parameters
+        BINS: an integer; number of bins if PARAMETERS has no 'bins' entry
+        BLOCK_SIZE: an integer; number of target neurons processed at once.
+            Memory use scales with BLOCK_SIZE x num_neurons x num_frames.
+    Output:
+        RESULT: a (num_neurons x num_neurons) connectivity matrix, where the
+            i,jth entry is the transfer of information from neuron i to
+            neuron j, in bits. Neurons with a flat signal are set to NaN,
+            as run_gte does for excluded neurons.
+    """
+    parameters = {} if parameters is None else parameters
+    source_order = int(parameters.get('SourceMarkovOrder', 1))
+    target_order = int(parameters.get('TargetMarkovOrder', 1))
+    bins = int(parameters.get('bins', bins))
+    auto_bins = bool(parameters.get('AutoBinNumberQ', False))
+    instant = bool(parameters.get('InstantFeedbackTermQ', False))
+    signal = np.asarray(signal, dtype=np.float64)
+    num_neurons, num_frames = signal.shape
+
+    # The source history ends at t (instant feedback) or t-1
+    source_lags = np.arange(source_order) + (0 if instant else 1)
+    target_lags = np.arange(1, target_order + 1)
+    t0 = max(int(parameters.get('StartSampleIndex', 0)),
+        target_order, source_lags[-1])
+    if num_frames - t0 < 2:
+        raise ValueError("Signal length is not long enough.")
+    binned = discretize_signal(signal, bins, auto_bins)
+    future = binned[:, t0:]
+    past = _history_code(binned, target_lags, bins, t0)
+    source = _history_code(binned, source_lags, bins, t0)
+    num_past, num_source = bins ** target_order, bins ** source_order
+
+    # Terms that only depend on the target neuron
+    h_past = _entropy_rows(past, num_past)
+    h_future_past = _entropy_rows(past * bins + future, num_past * bins)
+
+    result = np.empty((num_neurons, num_neurons))
+    for start in range(0, num_neurons, block_size):
+        targets = slice(start, min(start + block_size, num_neurons))
+        b = targets.stop - targets.start
+        # (targets x sources x samples) joint codes
+        past_source = past[targets, np.newaxis, :] * num_source + \
+            source[np.newaxis, :, :]
+        h_past_source = _entropy_rows(
+            past_source.reshape((b * num_neurons, -1)),
+            num_past * num_source)
+        joint = past_source * bins + future[targets, np.newaxis, :]
+        h_joint = _entropy_rows(joint.reshape((b * num_neurons, -1)),
+            num_past * num_source * bins)
+        te = (h_future_past[targets, np.newaxis] + h_past_source.reshape(
+            (b, num_neurons)) - h_past[targets, np.newaxis] -
+            h_joint.reshape((b, num_neurons)))
+        result[:, targets] = te.T # Rows are sources
+    flat = np.max(signal, axis=1) == np.min(signal, axis=1)
+    result[flat, :] = np.nan
+    result[:, flat] = np.nan
+    return result
+
+def run_gte_numpy(exp_data, parameters, to_zscore=False, zscore_threshold=0.0):
+    """
+    In-process counterpart of create_gte_input_files followed by run_gte.
+    Trials are prepared exactly as for the binary (leading NaNs removed,
+    trials shorter than 30 frames skipped, optional z-scoring and clipping).
+
+    Input:
+        EXP_DATA: a 3D numpy array of size (trials x neurons x frames)
+        PARAMETERS, TO_ZSCORE, ZSCORE_THRESHOLD: see create_gte_input_files
+    Output:
+        RESULTS: an array of connectivity matrices, one per processed trial
+    """
+    return [transfer_entropy_matrix(signal, parameters) for _, signal in
+        prepare_gte_trials(exp_data, to_zscore, zscore_threshold)]
+
+def gte_windows(num_frames, frame_size, frame_step=1):
+    """
+    Returns the (start, length) windows that create_gte_input_files_sliding
+    slides over a signal of NUM_FRAMES frames.
+    """
+    return [(idx, frame_size) for idx in
+        range(frame_size, num_frames-frame_size, frame_step)]
+
+def _range_difference(s0, e0, s1, e1):
+    """Sample ranges leaving and entering when a window moves from
+    [S0, E0) to [S1, E1)."""
+    removed = [(s0, min(s1, e0)), (max(e1, s0), e0)]
+    added = [(s1, min(s0, e1)), (max(e0, s1), e1)]
+    return ([(a, b) for a, b in removed if b > a],
+        [(a, b) for a, b in added if b > a])
+
+def _plogp(counts):
+    counts = counts.astype(np.float64)
+    return counts * np.log2(np.maximum(counts, 1.0))
+
+def _sliding_entropy_rows(codes, alphabet, sample_ranges):
+    """
+    Plug-in entropy (in bits) of each row of CODES over each [start, stop)
+    range in SAMPLE_RANGES. Histograms are updated with only the samples
+    that leave and enter between consecutive ranges, so overlapping windows
+    cost their step rather than their length.
+    """
+    num_rows = codes.shape[0]
+    flat_codes = codes + (np.arange(num_rows) * alphabet)[:, np.newaxis]
+    counts = np.zeros(num_rows * alphabet, dtype=np.int64)
+    plogp_sum = np.zeros(num_rows)
+    entropies = np.empty((len(sample_ranges), num_rows))
+    s0 = e0 = 0
+    for w, (s1, e1) in enumerate(sample_ranges):
+        removed, added = _range_difference(s0, e0, s1, e1)
+        size = counts.size
+        delta = np.zeros(size, dtype=np.int64)
+        for a, b in added:
+            delta += np.bincount(flat_codes[:, a:b].ravel(), minlength=size)
+        for a, b in removed:
+            delta -= np.bincount(flat_codes[:, a:b].ravel(), minlength=size)
+        touched = np.flatnonzero(delta)
+        rows = touched // alphabet
+        plogp_sum -= np.bincount(rows, weights=_plogp(counts[touched]),
+            minlength=num_rows)
+        counts[touched] += delta[touched]
+        plogp_sum += np.bincount(rows, weights=_plogp(counts[touched]),
+            minlength=num_rows)
+        num_samples = e1 - s1
+        entropies[w] = np.log2(num_samples) - plogp_sum / num_samples
+        s0, e0 = s1, e1
+    return entropies
+
+def transfer_entropy_sliding(signal, windows, parameters=None, bins=3,
+        block_size=8):
+    """
+    Sliding-window NumPy GTE in a single job: computes the connectivity
+    matrix of each window of one contiguous signal without writing or
+    launching anything per window. The signal is binned once, and the
+    joint histograms of consecutive windows are updated incrementally
+    with the samples that leave and enter them.
+
+    Input:
+        SIGNAL: a (num_neurons x num_frames) Numpy array
+        WINDOWS: a list of (start, length) pairs; see gte_windows
+        PARAMETERS, BINS, BLOCK_SIZE: see transfer_entropy_matrix
+    Output:
+        RESULTS: a (num_windows x num_neurons x num_neurons) array. Bins are
+            shared across windows, so each matrix equals
+            transfer_entropy_matrix of its window up to the binning, which
+            te-extended and transfer_entropy_matrix set per window.
+    """
+    parameters = {} if parameters is None else parameters
+    source_order = int(parameters.get('SourceMarkovOrder', 1))
+    target_order = int(parameters.get('TargetMarkovOrder', 1))
+    bins = int(parameters.get('bins', bins))
+    auto_bins = bool(parameters.get('AutoBinNumberQ', False))
+    instant = bool(parameters.get('InstantFeedbackTermQ', False))
+    signal = np.asarray(signal, dtype=np.float64)
+    num_neurons, num_frames = signal.shape
+    source_lags = np.arange(source_order) + (0 if instant else 1)
+    target_lags = np.arange(1, target_order + 1)
+    t0 = max(int(parameters.get('StartSampleIndex', 0)),
+        target_order, source_lags[-1])
+    windows = [(int(start), int(length)) for start, length in windows]
+    for start, length in windows:
+        if start < 0 or start + length > num_frames:
+            raise ValueError("Window ({}, {}) exceeds the signal.".format(
+                start, length))
+        if length - t0 < 2:
+            raise ValueError("Signal length is not long enough.")
+    results = np.empty((len(windows), num_neurons, num_neurons))
+    if not windows:
+        return results
+
+    # Code index k holds the sample at frame k + t0, so the samples of
+    # window (start, length) are codes [start, start + length - t0)
+    order = sorted(range(len(windows)), key=lambda w: windows[w])
+    sample_ranges = [(windows[w][0], sum(windows[w]) - t0) for w in order]
+    binned = discretize_signal(signal, bins, auto_bins)
+    future = binned[:, t0:]
+    past = _history_code(binned, target_lags, bins, t0)
+    source = _history_code(binned, source_lags, bins, t0)
+    num_past, num_source = bins ** target_order, bins ** source_order
+
+    h_past = _sliding_entropy_rows(past, num_past, sample_ranges)
+    h_future_past = _sliding_entropy_rows(past * bins + future,
+        num_past * bins, sample_ranges)
+    te = np.empty((len(windows), num_neurons, num_neurons))
+    for start in range(0, num_neurons, block_size):
+        targets = slice(start, min(start + block_size, num_neurons))
+        b = targets.stop - targets.start
+        past_source = past[targets, np.newaxis, :] * num_source + \
+            source[np.newaxis, :, :]
+        h_past_source = _sliding_entropy_rows(
+            past_source.reshape((b * num_neurons, -1)),
+            num_past * num_source, sample_ranges)
+        joint = past_source * bins + future[targets, np.newaxis, :]
+        h_joint = _sliding_entropy_rows(joint.reshape((b * num_neurons, -1)),
+            num_past * num_source * bins, sample_ranges)
+        block_te = (h_future_past[:, targets, np.newaxis] +
+            h_past_source.reshape((-1, b, num_neurons)) -
+            h_past[:, targets, np.newaxis] -
+            h_joint.reshape((-1, b, num_neurons)))
+        te[:, :, targets] = block_te.transpose((0, 2, 1)) # Rows are sources
+    results[order] = te
+    for w, (start, length) in enumerate(windows):
+        window = signal[:, start:start + length]
+        flat = np.max(window, axis=1) == np.min(window, axis=1)
+        results[w][flat, :] = np.nan
+        results[w][:, flat] = np.nan
+    return results
+
+def run_gte_numpy_sliding(exp_data, parameters, frame_size, frame_step=1,
+        shared_bins=False):
+    """
+    In-process counterpart of create_gte_input_files_sliding followed by
+    run_gte, over the same window positions. By default each window is
+    binned on its own, as te-extended does. With SHARED_BINS all windows
+    are computed in one transfer_entropy_sliding pass with bin edges set
+    over the whole of EXP_DATA; equal-width and equal-occupancy edges of a
+    window generally differ from those, and so does the estimate.
+    Output:
+        RESULTS: a (num_windows x num_neurons x num_neurons) array
+    """
+    windows = gte_windows(exp_data.shape[1], frame_size, frame_step)
+    if shared_bins:
+        return transfer_entropy_sliding(exp_data, windows, parameters)
+    return np.array([
+        transfer_entropy_matrix(exp_data[:,start:start+length], parameters)
+        for start, length in windows
+        ]).reshape((len(windows),) + (exp_data.shape[0],)*2)
+
+def compare_gte_results(results1, results2):
+    """
+    Compares two stacks of connectivity matrices, e.g. stored te-extended
+    results and the NumPy backend on the same input, matrix by matrix.
+    Output:
+        CORRS: Pearson correlation of the off-diagonal, non-NaN entries of
+            each pair of matrices
+        MAX_ABS_DIFF: the largest absolute difference of each pair
+    """
+    results1 = np.asarray(results1, dtype=np.float64)
+    results2 = np.asarray(results2, dtype=np.float64)
+    num_neurons = results1.shape[-1]
+    off_diag = ~np.eye(num_neurons, dtype=bool)
+    corrs, max_abs_diff = [], []
+    for m1, m2 in zip(results1, results2):
+        valid = off_diag & ~np.isnan(m1) & ~np.isnan(m2)
+        corrs.append(np.corrcoef(m1[valid], m2[valid])[0, 1])
+        max_abs_diff.append(np.max(np.abs(m1[valid] - m2[valid])))
+    return np.array(corrs), np.array(max_abs_diff)
+
+
+def zscore_trials(exp_data, zscore_threshold):
+    """
+    Z-scores each neuron of each trial over its non-NaN frames and clips
+    the result at ZSCORE_THRESHOLD, as prepare_gte_trials does per trial.
+    Flat signals become 0 and the NaN padding before a trial is kept.
+
+    Input:
+        EXP_DATA: a 3D numpy array of size (trials x neurons x frames)
+    Output:
+        ZSCORED: a float32 array of the same size
+    """
+    exp_data = np.asarray(exp_data, dtype=np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(exp_data, axis=2, keepdims=True)
+        std = np.nanstd(exp_data, axis=2, keepdims=True)
+        zscored = (exp_data - mean) / std
+    padding = np.isnan(exp_data)
+    zscored = np.clip(np.nan_to_num(zscored), -zscore_threshold,
+        zscore_threshold)
+    zscored[padding] = np.nan
+    return zscored.astype(np.float32)
+
+def shuffled_windows(exp_data, frame_size, iters, rng=None):
+    """
+    Builds 'shuffled' surrogate signals in one batched gather: for each of
+    ITERS surrogates, every neuron gets a window of FRAME_SIZE frames from
+    a random trial and a random start frame, independently of the other
+    neurons. Windows never include the leading NaN padding of a trial, and
+    only trials with at least FRAME_SIZE non-NaN frames are sampled.
+
+    Input:
+        EXP_DATA: a 3D numpy array of size (trials x neurons x frames)
+        RNG: a numpy Generator; defaults to a fresh, unseeded one
+    Output:
+        SHUFFLED_DATA: a (ITERS x neurons x FRAME_SIZE) array
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    num_trials, num_neurons, num_frames = exp_data.shape
+    # First non-NaN frame of each trial
+    first = np.argmax(~np.isnan(exp_data[:,0,:]), axis=1)
+    sufficient = np.flatnonzero(num_frames - first >= frame_size)
+    if sufficient.size == 0:
+        raise ValueError("No trial has {} frames to sample.".format(
+            frame_size))
+    trial_idx = sufficient[rng.integers(sufficient.size,
+        size=(iters, num_neurons))]
+    num_starts = num_frames - frame_size - first[trial_idx] + 1
+    frame_idx = first[trial_idx] + np.floor(
+        rng.random((iters, num_neurons)) * num_starts).astype(np.int64)
+    return exp_data[trial_idx[:,:,np.newaxis],
+        np.arange(num_neurons)[np.newaxis,:,np.newaxis],
+        frame_idx[:,:,np.newaxis] + np.arange(frame_size)]
+
+def result_moments(results, moments=None):
+    """
+    Streaming, NaN-aware mean and variance of a stack of connectivity
+    matrices. The moments of RESULTS are merged into MOMENTS (Chan et al.'s
+    pairwise update), so shuffles can be processed in batches without
+    keeping every matrix.
+
+    Input:
+        RESULTS: a (num_results x N x N) array or list of matrices
+        MOMENTS: the output of a previous call, or None
+    Output:
+        MOMENTS: a tuple (COUNT, MEAN, M2) of (N x N) arrays; see
+            moments_mean_std
+    """
+    results = np.asarray(results, dtype=np.float64)
+    valid = ~np.isnan(results)
+    count = valid.sum(axis=0).astype(np.float64)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(results, axis=0)
+    mean[count == 0] = 0.0
+    m2 = np.sum(np.where(valid, results - mean, 0.0)**2, axis=0)
+    if moments is None:
+        return count, mean, m2
+    count_a, mean_a, m2_a = moments
+    total = count_a + count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(total > 0, count / total, 0.0)
+    delta = mean - mean_a
+    return (total, mean_a + delta*weight,
+        m2_a + m2 + delta**2 * count_a * weight)
+
+def moments_mean_std(moments):
+    """Mean and (population) standard deviation of MOMENTS, with NaN where
+    no value was seen."""
+    count, mean, m2 = moments
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.where(count > 0, mean, np.nan),
+            np.where(count > 0, np.sqrt(m2/count), np.nan))
+
+
+class GTECache:
+    """
+    A size-bounded, content-addressed on-disk store of GTE results. Keys
+    hash the exact input block together with the GTE parameters, so the
+    same z-scored slice processed by another analysis, or on another night,
+    is looked up instead of rerun. The least recently used entries are
+    evicted once the cache exceeds MAX_BYTES.
+    """
+    # Parameters that create_gte_input_files sets per job
+    per_job_parameters = ('size', 'samples', 'inputfile', 'outputfile',
+        'outputparsfile')
+
+    def __init__(self, cache_dir, max_bytes=2**31):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @classmethod
+    def normalize_parameters(cls, parameters):
+        # Drops per-job entries and fixes the key order
+        return {str(k): str(v) for k, v in sorted(parameters.items())
+            if k not in cls.per_job_parameters}
+
+    @classmethod
+    def key(cls, signal, parameters, **extra):
+        """
+        Hash of SIGNAL (values, shape and dtype), the normalized PARAMETERS
+        and any EXTRA settings that change the result, e.g. the backend.
+        """
+        signal = np.ascontiguousarray(signal)
+        h = hashlib.sha1()
+        h.update(str((signal.shape, signal.dtype.str)).encode())
+        h.update(signal.tobytes())
+        settings = cls.normalize_parameters(parameters)
+        settings.update({k: str(v) for k, v in extra.items()})
+        h.update(json.dumps(settings, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        """Returns the cached result for KEY, or None on a miss."""
+        path = self._path(key)
+        try:
+            result = np.load(path)
+        except (IOError, ValueError):
+            return None
+        os.utime(path) # Marks the entry as recently used
+        return result
+
+    def put(self, key, result, evict=True):
+        """Stores RESULT under KEY. Batches of puts should pass
+        EVICT=False and call evict once at the end."""
+        path = self._path(key)
+        tmp_path = path + ".tmp.npy"
+        np.save(tmp_path, np.asarray(result))
+        os.replace(tmp_path, path)
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits."""
+        entries = []
+        for f in os.listdir(self.cache_dir):
+            if f.endswith(".npy") and not f.endswith(".tmp.npy"):
+                stat = os.stat(os.path.join(self.cache_dir, f))
+                entries.append((stat.st_mtime, stat.st_size, f))
+        total = sum(e[1] for e in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, f))
+            total -= size